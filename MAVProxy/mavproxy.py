@@ -40,6 +40,10 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_reactor
+from MAVProxy.modules.lib import mp_lazymsg
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import mp_msgstore
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -76,8 +80,8 @@ class MPStatus(object):
     '''hold status information about the mavproxy'''
     def __init__(self):
         self.gps	 = None
-        self.msgs = {}
-        self.msg_count = {}
+        self.msgs = mp_msgstore.MPMessageStore()
+        self.msg_count = self.msgs.msg_count
         self.counters = {'MasterIn' : [], 'MasterOut' : 0, 'FGearIn' : 0, 'FGearOut' : 0, 'Slave' : 0}
         self.bytecounters = {'MasterIn': []}
         self.setup_mode = opts.setup
@@ -156,6 +160,8 @@ class MPStatus(object):
                 f.write('%s:%s ' % (c, self.counters[c]))
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
+            busy = sorted([m for (m,pm) in mpstate.modules], key=lambda m : -m.stats.cpu_fraction())[:5]
+            f.write('Module CPU: %s\n' % ' '.join(['%s:%.1f%%' % (m.name, m.stats.cpu_fraction()*100) for m in busy]))
             f.write(str(self.gps)+'\n')
         for m in sorted(self.msgs.keys()):
             if pattern is not None:
@@ -216,6 +222,10 @@ class MAVFunctions(object):
         self.param_set = param_set
         self.get_mav_param = get_mav_param
         self.say = say_text
+        self.process_master = process_master
+        self.process_master_buffer = process_master_buffer
+        self.parse_master = parse_master
+        self.process_mavlink = process_mavlink
         # input handler can be overridden by a module
         self.input_handler = None
 
@@ -275,6 +285,18 @@ class MPState(object):
               MPSetting('speed_unit', str, 'm/s', 'height unit', choice=['m/s', 'knots', 'mph']),
 
               MPSetting('fwdpos', bool, False, 'Forward GLOBAL_POSITION_INT on all links'),
+              MPSetting('fwd_batch', bool, False, 'Batch forwarded packets into one write per link read'),
+              MPSetting('module_warn_ms', float, 0, 'Warn when a module call takes longer than this many ms (0 to disable)'),
+              MPSetting('lazy_decode', bool, False, 'Only unpack message fields when they are first used'),
+              MPSetting('link_threads', bool, False, 'Read master links in their own threads'),
+              MPSetting('link_queue', int, 200, 'Maximum reads queued by each link thread', range=(1,100000)),
+              MPSetting('log_queue', int, 100000, 'Maximum packets queued for each telemetry log', range=(100,10000000)),
+              MPSetting('log_overflow', str, 'drop_oldest', 'What to do when a telemetry log queue is full',
+                        choice=mp_logwriter.OVERFLOW_POLICIES),
+              MPSetting('log_compress', str, 'none', 'Compression for new telemetry logs',
+                        choice=mp_logwriter.COMPRESSION_TYPES),
+              MPSetting('log_rotate_size', int, 0, 'Start a new telemetry log after this many MB (0 to disable)'),
+              MPSetting('log_rotate_time', int, 0, 'Start a new telemetry log after this many seconds (0 to disable)'),
               MPSetting('checkdelay', bool, True, 'check for link delay'),
               MPSetting('param_ftp', bool, True, 'try ftp for parameter download'),
 
@@ -310,10 +332,17 @@ class MPState(object):
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system,self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
+        self.mavlink_dispatch = mp_module.MPDispatch()
+        self.idle_scheduler = mp_module.MPIdleScheduler()
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        # event reactor for the main loop. Links and outputs register
+        # with it as they are added, modules can add their own fds via
+        # select_extra
+        self.reactor = mp_reactor.MPReactor()
+        self.select_extra = mp_reactor.MPSelectExtra(self.reactor, self.select_extra_error)
         self.continue_mode = False
+        self.logwriter = None
         self.aliases = {}
         import platform
         self.system = platform.system()
@@ -334,6 +363,11 @@ class MPState(object):
             self.mav_param_by_sysid[sysid] = mavparm.MAVParmDict()
         return self.mav_param_by_sysid[sysid]
 
+    def select_extra_error(self, msg):
+        '''report an exception from a select_extra read function'''
+        if self.settings.moddebug == 1:
+            print(msg)
+
     def module(self, name):
         '''Find a public module (most modules are private)'''
         if name in self.public_modules:
@@ -429,6 +463,19 @@ def cmd_status(args):
         for pattern in args:
             mpstate.status.show(sys.stdout, pattern=pattern, verbose=verbose)
 
+def cmd_tlog(args):
+    '''telemetry log control'''
+    if mpstate.logwriter is None:
+        print("Telemetry log not open")
+        return
+    if len(args) == 0 or args[0] == 'status':
+        mpstate.logwriter.show()
+    elif args[0] == 'rotate':
+        mpstate.logwriter.rotate_requested = True
+        mpstate.logqueue.ready.set()
+    else:
+        print("usage: tlog <status|rotate>")
+
 def cmd_setup(args):
     mpstate.status.setup_mode = True
     mpstate.rl.set_prompt("")
@@ -489,6 +536,8 @@ def load_module(modname, quiet=False, **kwargs):
             module = m.init(mpstate, **kwargs)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                mpstate.mavlink_dispatch.invalidate()
+                mpstate.idle_scheduler.invalidate()
                 if not quiet:
                     if kwargs:
                         print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -520,8 +569,12 @@ def unload_module(modname):
                 if t.is_alive():
                     print("unload on module %s did not complete" % m.name)
                     mpstate.modules.remove((m,pm))
+                    mpstate.mavlink_dispatch.invalidate()
+                    mpstate.idle_scheduler.invalidate()
                     return False
             mpstate.modules.remove((m,pm))
+            mpstate.mavlink_dispatch.invalidate()
+            mpstate.idle_scheduler.invalidate()
             if modname in mpstate.public_modules:
                 del mpstate.public_modules[modname]
             print("Unloaded module %s" % modname)
@@ -531,7 +584,7 @@ def unload_module(modname):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|stats>"
     if len(args) < 1:
         print(usage)
         return
@@ -583,9 +636,47 @@ def cmd_module(args):
             return
         modname = os.path.basename(args[1])
         unload_module(modname)
+    elif args[0] == "stats":
+        cmd_module_stats(args[1:])
     else:
         print(usage)
 
+def cmd_module_stats(args):
+    '''show time spent in each module'''
+    if len(args) > 0 and args[0] == "reset":
+        for (m,pm) in mpstate.modules:
+            m.stats.reset()
+        return
+    if len(args) > 0:
+        # per message type breakdown for one module
+        mod = None
+        for (m,pm) in mpstate.modules:
+            if m.name == args[0]:
+                mod = m
+        if mod is None:
+            print("Module %s not loaded" % args[0])
+            return
+        stats = mod.stats
+        print("%-28s %9s %10s %8s %8s" % ("Hook", "Calls", "Total(ms)", "Avg(ms)", "Max(ms)"))
+        hooks = [('idle_task', stats.idle)]
+        for mtype in sorted(stats.packets.keys(), key=lambda t : -stats.packets[t].total):
+            hooks.append((mtype, stats.packets[mtype]))
+        for (name, s) in hooks:
+            if s.count == 0:
+                continue
+            print("%-28s %9u %10.1f %8.3f %8.2f" % (name, s.count, s.total*1000,
+                                                    s.total*1000/s.count, s.max*1000))
+        return
+    print("%-16s %6s %9s %10s %8s %9s %10s %8s" % ("Module", "CPU%", "Idle", "Idle(ms)", "IdleMax",
+                                                   "Packets", "Pkt(ms)", "PktMax"))
+    mods = sorted([m for (m,pm) in mpstate.modules], key=lambda m : -m.stats.cpu_fraction())
+    for m in mods:
+        idle = m.stats.idle
+        pkts = m.stats.packet_totals()
+        print("%-16s %6.2f %9u %10.1f %8.2f %9u %10.1f %8.2f" % (m.name, m.stats.cpu_fraction()*100,
+                                                                 idle.count, idle.total*1000, idle.max*1000,
+                                                                 pkts.count, pkts.total*1000, pkts.max*1000))
+
 
 def cmd_alias(args):
     '''alias commands'''
@@ -658,7 +749,8 @@ command_map = {
     'set'     : (cmd_set,      'mavproxy settings'),
     'watch'   : (cmd_watch,    'watch a MAVLink pattern'),
     'module'  : (cmd_module,   'module commands'),
-    'alias'   : (cmd_alias,    'command aliases')
+    'alias'   : (cmd_alias,    'command aliases'),
+    'tlog'    : (cmd_tlog,     'telemetry log control')
     }
 
 def shlex_quotes(value):
@@ -755,7 +847,26 @@ def process_master(m):
     if len(s) == 0:
         time.sleep(0.1)
         return
+    process_master_buffer(m, s)
+
+def parse_master(m, s):
+    '''parse data from a MAVLink master, returning a list of messages or
+    None. This may be called from a link reader thread'''
+    if (mpstate.settings.compdebug & 1) != 0 or mpstate.status.setup_mode:
+        return None
+    global mavversion
+    if m.first_byte and mavversion is None:
+        m.auto_mavlink_version(s)
+    # auto_mavlink_version() can replace m.mav, so check each time
+    if mpstate.settings.lazy_decode:
+        mp_lazymsg.install(m.mav)
+    else:
+        mp_lazymsg.uninstall(m.mav)
+    return m.mav.parse_buffer(s)
 
+def process_master_buffer(m, s, msgs=None, reader=None):
+    '''process data read from a MAVLink master. If reader is given
+    then msgs were already parsed from s by that link reader thread'''
     mpstate.status.bytecounters['MasterIn'][m.linknum].update(len(s))
 
     if (mpstate.settings.compdebug & 1) != 0:
@@ -774,13 +885,13 @@ def process_master(m):
             sys.stdout.write(str(s))
         sys.stdout.flush()
         return
-    
-    global mavversion
-    if m.first_byte and mavversion is None:
-        m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+
+    if reader is None:
+        msgs = parse_master(m, s)
     if msgs:
         for msg in msgs:
+            if reader is not None:
+                reader.dispatch(msg)
             sysid = msg.get_srcSystem()
             if sysid in mpstate.sysid_outputs:
                   # the message has been handled by a specialised handler for this system
@@ -791,6 +902,9 @@ def process_master(m):
                 if opts.show_errors:
                     mpstate.console.writeln("MAV error: %s" % msg)
                 mpstate.status.mav_error += 1
+        link = mpstate.module('link')
+        if link is not None:
+            link.flush_forwarded()
 
 
 
@@ -817,7 +931,7 @@ def process_mavlink(slave):
             mpstate.master(target_sysid).write(mbuf)
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put(struct.pack('>Q', usec) + mbuf)
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
@@ -838,19 +952,6 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
-def log_writer():
-    '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -901,15 +1002,17 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        mpstate.logwriter = mp_logwriter.TelemetryLogWriter(mpstate.settings,
+                                                            mpstate.logqueue, mpstate.logqueue_raw,
+                                                            logpath_telem, logpath_telem_raw,
+                                                            append=(mode == 'ab'))
         print("Log Directory: %s" % mpstate.status.logdir)
-        print("Telemetry log: %s" % logpath_telem)
+        print("Telemetry log: %s" % mpstate.logwriter.logfile.path)
 
         #make sure there's enough free disk space for the logfile (>200Mb)
         #statvfs doesn't work in Windows
         if platform.system() != 'Windows':
-            stat = os.statvfs(logpath_telem)
+            stat = os.statvfs(mpstate.logwriter.logfile.path)
             if stat.f_bfree*stat.f_bsize < 209715200:
                 print("ERROR: Not enough free disk space for logfile")
                 mpstate.status.exit = True
@@ -918,9 +1021,7 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         # use a separate thread for writing to the logfile to prevent
         # delays during disk writes (important as delays can be long if camera
         # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
+        mpstate.logwriter.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -988,20 +1089,28 @@ def periodic_tasks():
 
     mpstate.status.update_bytecounters()
 
-    # call optional module idle tasks. These are called at several hundred Hz
-    for (m,pm) in mpstate.modules:
-        if hasattr(m, 'idle_task'):
-            try:
-                m.idle_task()
-            except Exception as msg:
-                if mpstate.settings.moddebug == 1:
-                    print(msg)
-                elif mpstate.settings.moddebug > 1:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                              limit=2, file=sys.stdout)
-
-        # also see if the module should be unloaded:
+    # call optional module idle tasks. These are called at several
+    # hundred Hz, unless the module has asked for a lower rate with
+    # set_idle_rate()
+    warn_ms = mpstate.settings.module_warn_ms
+    for m in mpstate.idle_scheduler.due(mpstate.modules, time.time()):
+        t0 = time.perf_counter()
+        try:
+            m.idle_task()
+        except Exception as msg:
+            if mpstate.settings.moddebug == 1:
+                print(msg)
+            elif mpstate.settings.moddebug > 1:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                          limit=2, file=sys.stdout)
+        dt = time.perf_counter() - t0
+        m.stats.idle.add(dt)
+        if m.stats.should_warn(dt, warn_ms):
+            mpstate.console.writeln("module %s idle_task took %.1fms" % (m.name, dt*1000))
+
+    # also see if any module should be unloaded:
+    for (m,pm) in mpstate.modules[:]:
         if m.needs_unloading:
             unload_module(m.name)
 
@@ -1019,6 +1128,11 @@ def main_loop():
             master.wait_heartbeat(timeout=0.1)
         set_stream_rates()
 
+    periodic_timer = mpstate.reactor.add_timer(mpstate.settings.select_timeout,
+                                               lambda args : periodic_tasks())
+    # links can change fd when they reconnect from a write
+    mpstate.reactor.add_timer(0.1, lambda args : mpstate.reactor.check_sources())
+
     while True:
         if mpstate is None or mpstate.status.exit:
             return
@@ -1045,72 +1159,21 @@ def main_loop():
                 process_stdin(c)
 
         for master in mpstate.mav_master:
-            if master.fd is None:
+            if master.fd is None and getattr(master, 'reader', None) is None:
                 if master.port.inWaiting() > 0:
                     process_master(master)
 
-        periodic_tasks()
-
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
-            time.sleep(0.0001)
-            continue
+        # the periodic tasks timer follows the select_timeout setting
+        if periodic_timer.period != mpstate.settings.select_timeout:
+            periodic_timer.period = mpstate.settings.select_timeout
 
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
+        # wait for links, outputs, module fds and timers. Each ready fd
+        # is dispatched straight to the handler registered for it
+        mpstate.reactor.run_once(mpstate.settings.select_timeout)
 
         if mpstate is None:
             return
 
-        for fd in rin:
-            if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
-
 
 
 def input_loop():
@@ -1275,8 +1338,9 @@ if __name__ == '__main__':
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
     # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    log_ready = threading.Event()
+    mpstate.logqueue = mp_logwriter.LogQueue(mpstate.settings.log_queue, mpstate.settings.log_overflow, log_ready)
+    mpstate.logqueue_raw = mp_logwriter.LogQueue(mpstate.settings.log_queue, mpstate.settings.log_overflow, log_ready)
 
 
     if opts.speech:
@@ -1349,7 +1413,9 @@ if __name__ == '__main__':
 
     # open any mavlink output ports
     for port in opts.output:
-        mpstate.mav_outputs.append(mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False))
+        conn = mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False)
+        mpstate.mav_outputs.append(conn)
+        mpstate.reactor.add_source(conn, process_mavlink)
 
     if opts.sitl:
         mpstate.sitl_output = mavutil.mavudp(opts.sitl, input=False)
@@ -1467,4 +1533,7 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    if mpstate.logwriter is not None:
+        mpstate.logwriter.close()
+
     sys.exit(1)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''
+lazy MAVLink message decoding
+
+install() replaces the decode() method of a pymavlink MAVLink object
+with one that only checks the header and CRC of each frame. The
+returned message is an instance of a subclass of the normal pymavlink
+message class, so isinstance(), get_type(), get_srcSystem(),
+get_msgbuf() etc all work without touching the payload. Numeric fields
+are unpacked one at a time when first read, and anything else (string
+fields, str(), to_dict() ...) unpacks the whole payload.
+
+Types in EAGER_TYPES, signed links and unknown message ids use the
+normal pymavlink decode.
+
+Released under the GNU GPL version 3 or later
+'''
+
+import copyreg
+import re
+import struct
+import sys
+
+# types which are almost always fully read on receipt, or which have
+# string fields that the core inspects
+EAGER_TYPES = frozenset(['HEARTBEAT', 'STATUSTEXT', 'PARAM_VALUE', 'COMMAND_ACK',
+                         'MISSION_ACK', 'MISSION_COUNT', 'MISSION_ITEM', 'MISSION_ITEM_INT',
+                         'MISSION_REQUEST', 'MISSION_REQUEST_INT', 'FILE_TRANSFER_PROTOCOL',
+                         'LOG_ENTRY', 'LOG_DATA', 'TERRAIN_REQUEST', 'AUTOPILOT_VERSION'])
+
+# fields which pymavlink's post_message() looks for in __dict__ to
+# track the vehicle uptime, so they are always unpacked up front
+EAGER_FIELDS = ('time_boot_ms', 'usec')
+
+format_token = re.compile(r'(\d*)([a-zA-Z?])')
+
+def field_offsets(msgtype):
+    '''return a dict of fieldname -> (offset, struct) for the scalar
+    numeric fields of a message type'''
+    fmt = msgtype.unpacker.format
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode('ascii')
+    tokens = format_token.findall(fmt)
+    if len(tokens) != len(msgtype.ordered_fieldnames):
+        # not a layout we understand, always do a full decode
+        return {}
+    ret = {}
+    offset = 0
+    for (i, (count, code)) in enumerate(tokens):
+        size = struct.calcsize('<' + count + code)
+        if count in ['', '1'] and code not in ['s', 'c']:
+            ret[msgtype.ordered_fieldnames[i]] = (offset, struct.Struct('<' + code))
+        offset += size
+    return ret
+
+def lazy_full_decode(self):
+    '''unpack the whole payload and copy the fields onto self'''
+    d = self.__dict__
+    msgtype = d['_lazy_msgtype']
+    t = msgtype.unpacker.unpack(d['_lazy_mbuf'])
+    order_map = msgtype.orders
+    len_map = msgtype.lengths
+    tlist = list(t)
+    # handle sorted fields, as in pymavlink MAVLink.decode()
+    if sum(len_map) == len(len_map):
+        for i in range(0, len(tlist)):
+            tlist[i] = t[order_map[i]]
+    else:
+        tlist = []
+        for i in range(0, len(order_map)):
+            order = order_map[i]
+            L = len_map[order]
+            tip = sum(len_map[:order])
+            field = t[tip]
+            if L == 1 or isinstance(field, bytes):
+                tlist.append(field)
+            else:
+                tlist.append(list(t[tip:(tip + L)]))
+    for (i, elem) in enumerate(tlist):
+        if isinstance(elem, bytes):
+            tlist[i] = elem.rstrip(b"\0")
+    m = msgtype(*tlist)
+    for k in m.__dict__:
+        if k not in d:
+            d[k] = m.__dict__[k]
+    d['_lazy_decoded'] = True
+
+def lazy_getattr(self, name):
+    '''called for attributes not yet unpacked from the payload'''
+    d = self.__dict__
+    if name.startswith('__') or d.get('_lazy_decoded', True):
+        raise AttributeError(name)
+    offsets = type(self)._lazy_offsets
+    if name in offsets:
+        (ofs, unpacker) = offsets[name]
+        value = unpacker.unpack_from(d['_lazy_mbuf'], ofs)[0]
+        d[name] = value
+        return value
+    if name.startswith('_') or name in self._fieldnames:
+        lazy_full_decode(self)
+        if name in d:
+            return d[name]
+    raise AttributeError(name)
+
+def lazy_copy(self):
+    '''copy.copy() support, keeping the copy lazy'''
+    ret = type(self).__new__(type(self))
+    ret.__dict__.update(self.__dict__)
+    return ret
+
+def lazy_reduce_ex(self, protocol):
+    '''pickle as the plain pymavlink message type'''
+    if not self.__dict__.get('_lazy_decoded', True):
+        lazy_full_decode(self)
+    state = {}
+    for k in self.__dict__:
+        if not k.startswith('_lazy'):
+            state[k] = self.__dict__[k]
+    return (copyreg._reconstructor, (self._lazy_msgtype, object, None), state)
+
+def class_attribute(msgtype, name):
+    '''see if name is defined on the message class, without invoking descriptors'''
+    for c in msgtype.__mro__:
+        if name in vars(c):
+            return True
+    return False
+
+lazy_classes = {}
+
+def lazy_class(msgtype):
+    '''return the lazy subclass for a pymavlink message class, or None if
+    the type can't be decoded lazily'''
+    if msgtype in lazy_classes:
+        return lazy_classes[msgtype]
+    offsets = field_offsets(msgtype)
+    # fields with the same name as a class attribute (eg. 'id') would
+    # never reach __getattr__, so these are unpacked up front
+    eager = []
+    for f in msgtype.fieldnames:
+        if class_attribute(msgtype, f):
+            if f not in offsets:
+                lazy_classes[msgtype] = None
+                return None
+            eager.append((f, offsets[f][0], offsets[f][1]))
+        elif f in EAGER_FIELDS and f in offsets:
+            eager.append((f, offsets[f][0], offsets[f][1]))
+    cls = type('Lazy' + msgtype.__name__, (msgtype,),
+               {'__getattr__' : lazy_getattr,
+                '__copy__' : lazy_copy,
+                '__reduce_ex__' : lazy_reduce_ex,
+                '_lazy_offsets' : offsets,
+                '_lazy_eager_fields' : eager})
+    lazy_classes[msgtype] = cls
+    return cls
+
+class LazyDecoder(object):
+    '''replacement for MAVLink.decode() on one MAVLink object'''
+    def __init__(self, mav, eager_types=EAGER_TYPES):
+        self.mav = mav
+        self.full_decode = mav.decode
+        self.mavlink = sys.modules[type(mav).__module__]
+        self.eager_types = eager_types
+        self.lazy_count = 0
+        self.eager_count = 0
+
+    def __call__(self, msgbuf):
+        mavlink = self.mavlink
+        if self.mav.signing.secret_key is not None:
+            # signature checking is stateful, leave it to pymavlink
+            self.eager_count += 1
+            return self.full_decode(msgbuf)
+        if msgbuf[0] != mavlink.PROTOCOL_MARKER_V1:
+            headerlen = 10
+            try:
+                (magic, mlen, incompat_flags, compat_flags, seq, srcSystem, srcComponent,
+                 msgIdlow, msgIdhigh) = self.mav.mav20_unpacker.unpack(msgbuf[:headerlen])
+            except struct.error:
+                return self.full_decode(msgbuf)
+            msgId = msgIdlow | (msgIdhigh << 16)
+        else:
+            headerlen = 6
+            try:
+                (magic, mlen, seq, srcSystem, srcComponent, msgId) = self.mav.mav10_unpacker.unpack(msgbuf[:headerlen])
+            except struct.error:
+                return self.full_decode(msgbuf)
+            incompat_flags = 0
+            compat_flags = 0
+        msgtype = mavlink.mavlink_map.get(msgId, None)
+        cls = None
+        if msgtype is not None:
+            cls = lazy_class(msgtype)
+        if (cls is None or
+            (incompat_flags & mavlink.MAVLINK_IFLAG_SIGNED) != 0 or
+            mlen != len(msgbuf) - (headerlen + 2) or
+            msgtype.msgname in self.eager_types):
+            # let pymavlink deal with anything out of the ordinary
+            self.eager_count += 1
+            return self.full_decode(msgbuf)
+
+        crc, = self.mav.mav_csum_unpacker.unpack(msgbuf[-2:])
+        crcbuf = msgbuf[1:-2]
+        crcbuf.append(msgtype.crc_extra)
+        crc2 = mavlink.x25crc(crcbuf)
+        if crc != crc2.crc and not mavlink.MAVLINK_IGNORE_CRC:
+            raise mavlink.MAVError("invalid MAVLink CRC in msgID %u 0x%04x should be 0x%04x" % (msgId, crc, crc2.crc))
+
+        csize = msgtype.unpacker.size
+        mbuf = msgbuf[headerlen:-2]
+        if len(mbuf) < csize:
+            # MAVLink2 trims trailing zeros
+            mbuf.extend([0] * (csize - len(mbuf)))
+        mbuf = mbuf[:csize]
+
+        m = cls.__new__(cls)
+        d = m.__dict__
+        d['_header'] = mavlink.MAVLink_header(msgId, incompat_flags, compat_flags, mlen, seq, srcSystem, srcComponent)
+        d['_payload'] = msgbuf[6:-2]
+        d['_msgbuf'] = msgbuf
+        d['_crc'] = crc
+        d['_fieldnames'] = msgtype.fieldnames
+        d['_type'] = msgtype.msgname
+        d['_signed'] = False
+        d['_link_id'] = None
+        d['_instances'] = None
+        d['_instance_field'] = msgtype.instance_field
+        d['_instance_offset'] = msgtype.instance_offset
+        d['_timestamp'] = None
+        d['_lazy_msgtype'] = msgtype
+        d['_lazy_mbuf'] = mbuf
+        d['_lazy_decoded'] = False
+        for (name, ofs, unpacker) in cls._lazy_eager_fields:
+            d[name] = unpacker.unpack_from(mbuf, ofs)[0]
+        self.lazy_count += 1
+        return m
+
+def install(mav, eager_types=EAGER_TYPES):
+    '''make a pymavlink MAVLink object decode lazily. Safe to call repeatedly'''
+    if isinstance(mav.__dict__.get('decode', None), LazyDecoder):
+        return
+    mav.decode = LazyDecoder(mav, eager_types)
+
+def uninstall(mav):
+    '''restore normal decoding on a MAVLink object'''
+    decoder = mav.__dict__.get('decode', None)
+    if isinstance(decoder, LazyDecoder):
+        del mav.decode
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+'''
+reader threads for master links
+
+A LinkReader owns the receive side of one mavfile. It reads and parses
+packets in its own thread and hands each (buffer, messages) batch to the
+main thread through a bounded deque. A socketpair is used to wake the
+main loop, which then calls drain() to run the mavlink callbacks and
+modules on the main thread as usual.
+
+Released under the GNU GPL version 3 or later
+'''
+
+import collections
+import select
+import socket
+import threading
+import time
+
+
+class LinkReader(object):
+    '''read and parse packets from a mavfile in a separate thread'''
+    def __init__(self, conn, parse, max_queue=200):
+        '''parse(conn, buf) is called in the reader thread and returns
+        the list of messages parsed from buf, or None'''
+        self.conn = conn
+        self.parse = parse
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.max_depth = 0
+        self.batches = 0
+        self.drops = 0
+        self.dropped_msgs = 0
+        self.errors = 0
+        (self.wake_recv, self.wake_send) = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.wake_fd = self.wake_recv.fileno()
+        self.signalled = False
+        # the mavlink callback is run from drain(), not while parsing
+        self.mav = None
+        self.callback = None
+        self.callback_args = ()
+        self.callback_kwargs = {}
+        self.take_callback()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='link-%s' % conn.address)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def take_callback(self):
+        '''move the mavlink callback off the current mav object. The mav
+        object is replaced when the protocol version changes'''
+        mav = self.conn.mav
+        if mav is self.mav:
+            return
+        if mav.callback is not None:
+            self.callback = mav.callback
+            self.callback_args = mav.callback_args
+            self.callback_kwargs = mav.callback_kwargs
+            mav.callback = None
+        self.mav = mav
+
+    def restore_callback(self):
+        '''put the mavlink callback back on the mav object'''
+        mav = self.conn.mav
+        if self.callback is not None:
+            (mav.callback, mav.callback_args, mav.callback_kwargs) = (self.callback,
+                                                                      self.callback_args,
+                                                                      self.callback_kwargs)
+
+    def stop(self):
+        '''stop the reader thread and restore normal callbacks. Batches
+        already queued can still be drained'''
+        self.running = False
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+        self.restore_callback()
+
+    def close(self):
+        '''close the wakeup sockets, after a final drain()'''
+        self.wake_recv.close()
+        self.wake_send.close()
+
+    def wait_readable(self, timeout):
+        '''wait for data on the link, return False on timeout'''
+        conn = self.conn
+        fd = conn.fd
+        if fd is None:
+            # eg. serial ports on windows
+            try:
+                if conn.port.inWaiting() > 0:
+                    return True
+            except Exception:
+                pass
+            time.sleep(0.01)
+            return False
+        try:
+            (rin, win, xin) = select.select([fd], [], [], timeout)
+        except (OSError, ValueError, select.error):
+            # the fd may have been closed by a reconnect
+            time.sleep(timeout)
+            return False
+        return len(rin) != 0
+
+    def run(self):
+        '''reader thread main loop'''
+        while self.running:
+            if not self.wait_readable(0.1):
+                continue
+            try:
+                s = self.conn.recv(16*1024)
+            except Exception:
+                self.errors += 1
+                time.sleep(0.1)
+                continue
+            if len(s) == 0:
+                # as process_master(), don't spin on a dead port
+                time.sleep(0.1)
+                continue
+            try:
+                self.take_callback()
+                msgs = self.parse(self.conn, s)
+                self.take_callback()
+            except Exception:
+                self.errors += 1
+                msgs = None
+            self.put(s, msgs)
+
+    def put(self, s, msgs):
+        '''queue a batch, dropping the oldest batch if the queue is full'''
+        q = self.queue
+        if len(q) >= self.max_queue:
+            try:
+                (old_s, old_msgs) = q.popleft()
+                self.drops += 1
+                if old_msgs:
+                    self.dropped_msgs += len(old_msgs)
+            except IndexError:
+                # main thread emptied it first
+                pass
+        q.append((s, msgs))
+        self.batches += 1
+        depth = len(q)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if not self.signalled:
+            self.signalled = True
+            try:
+                self.wake_send.send(b'x')
+            except (OSError, socket.error):
+                pass
+
+    def drain(self, process):
+        '''called from the main thread when woken. process(conn, buf, msgs)
+        is called for each queued batch'''
+        try:
+            while self.wake_recv.recv(256):
+                pass
+        except (OSError, socket.error):
+            pass
+        # only clear the flag once the wake socket is empty. A put() after
+        # this sends a new wakeup, one before it is popped below
+        self.signalled = False
+        q = self.queue
+        while q:
+            try:
+                (s, msgs) = q.popleft()
+            except IndexError:
+                break
+            process(self.conn, s, msgs)
+
+    def dispatch(self, msg):
+        '''run the mavlink callback for a message parsed by the thread'''
+        if self.callback is not None:
+            self.callback(msg, *self.callback_args, **self.callback_kwargs)
+
+    def depth(self):
+        return len(self.queue)
+
+
+if __name__ == '__main__':
+    # stress test: flood a reader with batches from other threads, as
+    # the reader thread would, and check that every one reaches drain()
+    import selectors
+    import sys
+
+    # switch threads as often as possible to open up any races between
+    # put() and drain()
+    sys.setswitchinterval(1e-6)
+
+    class FakeMav(object):
+        def __init__(self):
+            self.callback = None
+            self.callback_args = ()
+            self.callback_kwargs = {}
+
+    class FakeConn(object):
+        def __init__(self):
+            self.address = 'stress'
+            self.mav = FakeMav()
+
+    rounds = 50
+    count = 20000
+
+    def stress():
+        reader = LinkReader(FakeConn(), None, max_queue=count)
+        received = [0]
+
+        def process(conn, buf, msgs):
+            received[0] += 1
+
+        def flood():
+            for i in range(count):
+                reader.put(b'x', None)
+                if i % 100 == 0:
+                    # let the main thread catch up so the queue keeps emptying
+                    time.sleep(0)
+
+        sender = threading.Thread(target=flood)
+        selector = selectors.DefaultSelector()
+        selector.register(reader.wake_fd, selectors.EVENT_READ)
+        sender.start()
+        while received[0] < count:
+            if not selector.select(1.0):
+                break
+            reader.drain(process)
+        sender.join()
+        selector.close()
+        reader.close()
+        assert reader.drops == 0
+        assert received[0] == count, "wakeup lost with %u of %u batches queued" % (reader.depth(), count)
+
+    t0 = time.time()
+    for i in range(rounds):
+        stress()
+    print("%u rounds of %u batches drained, %.2fs" % (rounds, count, time.time() - t0))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''
+telemetry log writer
+
+LogQueue is a bounded replacement for the Queue.Queue objects in
+mpstate.logqueue and mpstate.logqueue_raw, with an explicit policy for
+when it is full. TelemetryLogWriter drains both queues in a thread,
+packing each batch into a preallocated buffer so the files see a few
+large writes, with optional gzip or zstd compression and size or time
+based rotation of the .tlog and .tlog.raw files together.
+
+Released under the GNU GPL version 3 or later
+'''
+
+import collections
+import gzip
+import os
+import threading
+import time
+
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+OVERFLOW_POLICIES = ['drop_oldest', 'drop_newest', 'block']
+COMPRESSION_TYPES = ['none', 'gzip', 'zstd']
+
+
+class LogQueue(object):
+    '''a bounded queue of log buffers
+
+    put() is called from the main thread, so the block policy only
+    blocks for block_timeout per stall of the writer, not per packet.
+    Once a put has waited that long the queue drops the oldest buffers
+    until the writer next empties it, so a stalled SD card can't hold
+    up link I/O for as long as the stall lasts'''
+    def __init__(self, maxlen=100000, policy='drop_oldest', ready=None):
+        self.maxlen = maxlen
+        self.policy = policy
+        # event set whenever something is queued, shared between queues
+        self.ready = ready
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.count = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # a blocking put timed out and the writer hasn't caught up since
+        self.stalled = False
+        self.stalls = 0
+
+    def put(self, buf, block_timeout=1.0):
+        '''queue a buffer, applying the overflow policy if full'''
+        with self.cond:
+            if len(self.queue) >= self.maxlen:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                if self.policy == 'block' and not self.stalled:
+                    deadline = time.time() + block_timeout
+                    while len(self.queue) >= self.maxlen:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.stalled = True
+                            self.stalls += 1
+                            break
+                        self.cond.wait(remaining)
+                while len(self.queue) >= self.maxlen:
+                    self.queue.popleft()
+                    self.dropped += 1
+            self.queue.append(buf)
+            self.count += 1
+            self.bytes += len(buf)
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+        if self.ready is not None:
+            self.ready.set()
+
+    def get_all(self):
+        '''return everything queued, oldest first'''
+        with self.cond:
+            if not self.queue:
+                return []
+            ret = self.queue
+            self.queue = collections.deque()
+            self.stalled = False
+            self.cond.notify_all()
+        return ret
+
+    def qsize(self):
+        return len(self.queue)
+
+    def empty(self):
+        return len(self.queue) == 0
+
+
+class LogSegment(object):
+    '''one (possibly compressed) log file'''
+    def __init__(self, path, mode, compression):
+        self.compression = compression
+        if compression == 'zstd' and not has_zstd:
+            print("zstandard not installed, using gzip for %s" % path)
+            self.compression = 'gzip'
+        if self.compression == 'gzip':
+            path += '.gz'
+        elif self.compression == 'zstd':
+            path += '.zst'
+        self.path = path
+        self.fh = open(path, mode=mode)
+        self.stream = None
+        if self.compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.fh, mode='wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor(level=3).stream_writer(self.fh)
+
+    def write(self, buf):
+        if self.stream is not None:
+            self.stream.write(buf)
+        else:
+            self.fh.write(buf)
+
+    def flush(self):
+        if self.stream is None:
+            self.fh.flush()
+        elif self.compression == 'zstd':
+            self.stream.flush(zstandard.FLUSH_BLOCK)
+            self.fh.flush()
+        else:
+            self.stream.flush()
+            self.fh.flush()
+
+    def size(self):
+        '''size of the file on disk'''
+        try:
+            return self.fh.tell()
+        except (OSError, ValueError):
+            return 0
+
+    def close(self):
+        if self.stream is not None:
+            if self.compression == 'zstd':
+                self.stream.flush(zstandard.FLUSH_FRAME)
+            else:
+                self.stream.close()
+        self.fh.close()
+
+
+def segment_path(path, segment):
+    '''path of a rotated log segment, eg. flight.tlog.raw -> flight_0002.tlog.raw'''
+    if segment == 0:
+        return path
+    (dirname, basename) = os.path.split(path)
+    parts = basename.split('.', 1)
+    parts[0] += "_%04u" % segment
+    return os.path.join(dirname, '.'.join(parts))
+
+
+class TelemetryLogWriter(object):
+    '''write the telemetry and raw logs from a thread'''
+    def __init__(self, settings, logqueue, logqueue_raw, path, path_raw, append=False, buffer_size=256*1024):
+        self.settings = settings
+        self.logqueue = logqueue
+        self.logqueue_raw = logqueue_raw
+        self.path = path
+        self.path_raw = path_raw
+        self.append = append
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.segment = 0
+        self.rotate_requested = False
+        self.rotations = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.last_flush = time.time()
+        self.logfile = None
+        self.logfile_raw = None
+        self.running = True
+        self.thread = None
+        self.open_segment()
+
+    def segment_exists(self, segment):
+        '''true if either file of a segment is already on disk, compressed or not'''
+        for path in [self.path, self.path_raw]:
+            path = segment_path(path, segment)
+            for suffix in ['', '.gz', '.zst']:
+                if os.path.exists(path + suffix):
+                    return True
+        return False
+
+    def open_segment(self):
+        '''open the files for the current segment. When appending to a
+        log from an earlier run, its rotated segments are left alone and
+        new ones take the next unused numbers'''
+        if self.append and self.segment == 0:
+            mode = 'ab'
+        elif self.append:
+            while self.segment_exists(self.segment):
+                self.segment += 1
+            mode = 'xb'
+        else:
+            mode = 'wb'
+        compression = self.settings.log_compress
+        self.logfile = LogSegment(segment_path(self.path, self.segment), mode, compression)
+        self.logfile_raw = LogSegment(segment_path(self.path_raw, self.segment), mode, compression)
+        self.segment_start = time.time()
+
+    def rotate(self):
+        '''close the current segment and start a new one'''
+        self.logfile.close()
+        self.logfile_raw.close()
+        self.segment += 1
+        self.rotations += 1
+        self.open_segment()
+        print("Telemetry log: %s" % self.logfile.path)
+
+    def check_rotate(self):
+        '''rotate if asked to, or if the segment is too big or too old'''
+        max_size = self.settings.log_rotate_size * 1024 * 1024
+        max_time = self.settings.log_rotate_time
+        if (self.rotate_requested or
+            (max_size > 0 and self.logfile.size() + self.logfile_raw.size() >= max_size) or
+            (max_time > 0 and time.time() - self.segment_start >= max_time)):
+            self.rotate_requested = False
+            self.rotate()
+
+    def write_batch(self, logfile, bufs):
+        '''pack a batch of buffers into the write buffer and write it out'''
+        buffer = self.buffer
+        bufsize = len(buffer)
+        ofs = 0
+        for b in bufs:
+            n = len(b)
+            if ofs + n > bufsize:
+                if ofs > 0:
+                    logfile.write(self.view[:ofs])
+                    self.writes += 1
+                    ofs = 0
+                if n > bufsize:
+                    logfile.write(b)
+                    self.writes += 1
+                    self.bytes_written += n
+                    continue
+            buffer[ofs:ofs+n] = b
+            ofs += n
+            self.bytes_written += n
+        if ofs > 0:
+            logfile.write(self.view[:ofs])
+            self.writes += 1
+
+    def update_limits(self):
+        '''follow changes to the queue settings'''
+        for q in [self.logqueue, self.logqueue_raw]:
+            q.maxlen = self.settings.log_queue
+            q.policy = self.settings.log_overflow
+
+    def write_queued(self, rotate=True):
+        '''write out everything queued so far'''
+        try:
+            bufs = self.logqueue_raw.get_all()
+            if bufs:
+                self.write_batch(self.logfile_raw, bufs)
+            bufs = self.logqueue.get_all()
+            if bufs:
+                self.write_batch(self.logfile, bufs)
+            now = time.time()
+            if self.settings.flushlogs or now - self.last_flush >= 10:
+                self.logfile.flush()
+                self.logfile_raw.flush()
+                self.last_flush = now
+            if rotate:
+                self.check_rotate()
+        except (OSError, IOError) as e:
+            # eg. the SD card is full; the queues have still been
+            # emptied so they don't grow, try again next time
+            self.errors += 1
+            if self.errors == 1:
+                print("ERROR: writing telemetry log: %s" % e)
+
+    def run(self):
+        '''log writing thread'''
+        ready = self.logqueue.ready
+        while self.running:
+            ready.wait(1.0)
+            ready.clear()
+            self.update_limits()
+            self.write_queued()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        '''stop the writer thread, write anything still queued and close
+        the files, finishing any compressed streams'''
+        self.running = False
+        if self.thread is not None:
+            self.logqueue.ready.set()
+            self.thread.join(5.0)
+        self.write_queued(rotate=False)
+        self.logfile.close()
+        self.logfile_raw.close()
+
+    def show(self):
+        '''print log writer status'''
+        print("Telemetry log: %s (segment %u, %u rotations)" % (self.logfile.path, self.segment, self.rotations))
+        print("Raw log: %s" % self.logfile_raw.path)
+        print("Written %u bytes in %u writes, %u errors" % (self.bytes_written, self.writes, self.errors))
+        for (name, q) in [('tlog', self.logqueue), ('raw', self.logqueue_raw)]:
+            print("%s queue: %u/%u (max %u), %u queued, %u dropped, %u stalls (%s)" % (
+                name, q.qsize(), q.maxlen, q.max_depth, q.count, q.dropped, q.stalls, q.policy))
@@ -1,5 +1,156 @@
+import heapq
 import time
 
+class MPCallStats(object):
+    '''call count and wall time of one module hook'''
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+class MPModuleStats(object):
+    '''timing of the idle_task() and mavlink_packet() calls made on a module'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.idle = MPCallStats()
+        # message type -> MPCallStats
+        self.packets = {}
+        self.start = time.time()
+        self.last_warning = 0
+
+    def add_packet(self, mtype, dt):
+        s = self.packets.get(mtype, None)
+        if s is None:
+            s = MPCallStats()
+            self.packets[mtype] = s
+        s.add(dt)
+
+    def packet_totals(self):
+        '''return MPCallStats for mavlink_packet() over all message types'''
+        ret = MPCallStats()
+        for s in self.packets.values():
+            ret.merge(s)
+        return ret
+
+    def cpu_fraction(self):
+        '''fraction of wall time spent in this module since the last reset'''
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0
+        return (self.idle.total + self.packet_totals().total) / elapsed
+
+    def should_warn(self, dt, warn_ms):
+        '''see if a call taking dt seconds should be reported. At most
+        one warning a second is given for each module'''
+        if warn_ms <= 0 or dt * 1000 < warn_ms:
+            return False
+        now = time.time()
+        if now - self.last_warning < 1:
+            return False
+        self.last_warning = now
+        return True
+
+class MPDispatch(object):
+    '''
+    index of which modules want mavlink_packet() calls for each
+    message type. Modules that never override mavlink_packet() are
+    left out entirely, and modules that have declared their message
+    types with set_mavlink_types() are only listed under those types
+    '''
+
+    def __init__(self):
+        self.by_type = {}
+
+    def invalidate(self):
+        '''forget the index, eg. when modules are loaded or unloaded'''
+        self.by_type = {}
+
+    def modules_for(self, modules, mtype):
+        '''return list of modules to pass a message of type mtype to, in load order'''
+        ret = self.by_type.get(mtype, None)
+        if ret is not None:
+            return ret
+        ret = []
+        for (mod, pm) in modules:
+            handler = getattr(mod, 'mavlink_packet', None)
+            if handler is None or getattr(handler, '__func__', None) is MPModule.mavlink_packet:
+                continue
+            mtypes = getattr(mod, 'mavlink_types', None)
+            if mtypes is not None and mtype not in mtypes:
+                continue
+            ret.append(mod)
+        self.by_type[mtype] = ret
+        return ret
+
+class MPIdleScheduler(object):
+    '''
+    decide which modules get an idle_task() call on each pass of the
+    main loop. Modules that have not declared an idle rate are called
+    on every pass as before; modules that have are kept in a heap by
+    deadline and only called when due
+    '''
+
+    def __init__(self):
+        # modules called on every pass, None when it needs rebuilding
+        self.always = None
+        self.heap = []
+        self.seq = 0
+
+    def invalidate(self):
+        '''rebuild the schedule, eg. when modules are loaded or unloaded'''
+        self.always = None
+
+    def push(self, module, deadline):
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, module))
+
+    def rebuild(self, modules):
+        self.always = []
+        self.heap = []
+        now = time.time()
+        for (mod, pm) in modules:
+            handler = getattr(mod, 'idle_task', None)
+            if handler is None or getattr(handler, '__func__', None) is MPModule.idle_task:
+                continue
+            if getattr(mod, 'idle_period', None) is None:
+                self.always.append(mod)
+            else:
+                if mod.idle_deadline is None or mod.idle_deadline < now:
+                    mod.idle_deadline = now
+                self.push(mod, mod.idle_deadline)
+
+    def due(self, modules, now):
+        '''return list of modules whose idle_task() should be called now'''
+        if self.always is None:
+            self.rebuild(modules)
+        ret = list(self.always)
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            (deadline, seq, mod) = heapq.heappop(heap)
+            ret.append(mod)
+            # schedule the next call from the old deadline to avoid
+            # drift, without trying to catch up after a stall
+            mod.idle_deadline = max(deadline + mod.idle_period, now)
+            self.push(mod, mod.idle_deadline)
+        return ret
+
 class MPModule(object):
     '''
     The base class for all modules
@@ -16,6 +167,12 @@ class MPModule(object):
         self.needs_unloading = False
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
+        # message types wanted by mavlink_packet(), None for all
+        self.mavlink_types = None
+        self.stats = MPModuleStats()
+        # seconds between idle_task() calls, None for every main loop pass
+        self.idle_period = None
+        self.idle_deadline = None
 
         if description is None:
             self.description = name + " handling"
@@ -153,6 +310,31 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def set_mavlink_types(self, mtypes):
+        '''only pass messages of the given types to mavlink_packet(). None
+        restores the default of passing all messages'''
+        if mtypes is not None:
+            mtypes = frozenset(mtypes)
+        self.mavlink_types = mtypes
+        dispatch = getattr(self.mpstate, 'mavlink_dispatch', None)
+        if dispatch is not None:
+            dispatch.invalidate()
+
+    def set_idle_rate(self, rate):
+        '''call idle_task() rate times a second instead of on every
+        pass of the main loop. None or 0 restores the default'''
+        if rate:
+            self.idle_period = 1.0 / rate
+        else:
+            self.idle_period = None
+        self.idle_deadline = None
+        self.invalidate_idle_schedule()
+
+    def invalidate_idle_schedule(self):
+        scheduler = getattr(self.mpstate, 'idle_scheduler', None)
+        if scheduler is not None:
+            scheduler.invalidate()
+
     def dist_string(self, val_meters):
         '''return a distance as a string'''
         if self.settings.dist_unit == 'nm':
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+store of the latest message of each type
+
+MPMessageStore replaces the MPStatus.msgs and msg_count dictionaries.
+Messages are stored in slots found by message id, or (message id,
+instance) for instanced messages, so the per-packet update needs no
+string formatting. Each slot's name ("GPS_RAW_INT", "BATTERY_STATUS[1]")
+is built once when the slot is created, so lookups by name work as
+they did with the dictionaries.
+
+Released under the GNU GPL version 3 or later
+'''
+
+import array
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+
+class MPMessageStore(MutableMapping):
+    '''latest message of each type (and type[instance]), looked up by name'''
+    def __init__(self):
+        # msgid or (msgid, instance) -> slot number
+        self.slots = {}
+        # name -> slot number
+        self.by_name = {}
+        self.messages = []
+        self.counts = array.array('L')
+        self.msg_count = MPMessageCounts(self)
+        # bumped on every change, for callers caching views of the store
+        self.version = 0
+
+    def new_slot(self, key, name):
+        slot = len(self.messages)
+        self.messages.append(None)
+        self.counts.append(0)
+        self.slots[key] = slot
+        self.by_name[name] = slot
+        return slot
+
+    def store(self, m, mtype=None):
+        '''store a newly received message, counting it under its type and
+        under type[instance] for instanced messages'''
+        msgid = m.get_msgId()
+        slot = self.slots.get(msgid, None)
+        if slot is None:
+            if mtype is None:
+                mtype = m.get_type()
+            slot = self.by_name.get(mtype, None)
+            if slot is None:
+                slot = self.new_slot(msgid, mtype)
+            else:
+                self.slots[msgid] = slot
+        self.messages[slot] = m
+        self.counts[slot] += 1
+        self.version += 1
+
+        instance_field = getattr(m, '_instance_field', None)
+        if instance_field is None:
+            return
+        instance_value = getattr(m, instance_field, None)
+        if instance_value is None:
+            return
+        key = (msgid, instance_value)
+        slot = self.slots.get(key, None)
+        if slot is None:
+            if mtype is None:
+                mtype = m.get_type()
+            name = "%s[%s]" % (mtype, instance_value)
+            slot = self.by_name.get(name, None)
+            if slot is None:
+                slot = self.new_slot(key, name)
+            else:
+                self.slots[key] = slot
+        self.messages[slot] = m
+        self.counts[slot] += 1
+
+    def __getitem__(self, name):
+        slot = self.by_name.get(name, None)
+        if slot is None or self.messages[slot] is None:
+            raise KeyError(name)
+        return self.messages[slot]
+
+    def __setitem__(self, name, m):
+        slot = self.by_name.get(name, None)
+        if slot is None:
+            slot = self.new_slot(name, name)
+        self.messages[slot] = m
+        self.version += 1
+
+    def __delitem__(self, name):
+        slot = self.by_name.get(name, None)
+        if slot is None or self.messages[slot] is None:
+            raise KeyError(name)
+        # slots are never reused, just emptied
+        self.messages[slot] = None
+        self.counts[slot] = 0
+        self.version += 1
+
+    def __contains__(self, name):
+        slot = self.by_name.get(name, None)
+        return slot is not None and self.messages[slot] is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        '''names of the stored messages, in order of first arrival'''
+        messages = self.messages
+        return [name for (name, slot) in list(self.by_name.items()) if messages[slot] is not None]
+
+    def count(self, name):
+        '''number of messages received with this name'''
+        slot = self.by_name.get(name, None)
+        if slot is None:
+            return 0
+        return self.counts[slot]
+
+
+class MPMessageCounts(Mapping):
+    '''read-only name -> count view of a MPMessageStore, for MPStatus.msg_count'''
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, name):
+        slot = self.store.by_name.get(name, None)
+        if slot is None:
+            raise KeyError(name)
+        return self.store.counts[slot]
+
+    def __iter__(self):
+        return iter(self.store.keys())
+
+    def __len__(self):
+        return len(self.store)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+persistent event reactor for the MAVProxy main loop
+
+file descriptors (links, outputs and module fds) are registered once
+with a callback, ready fds are mapped straight back to their handler,
+and periodic work is run from a timer heap rather than being tied to
+the poll timeout.
+
+Released under the GNU GPL version 3 or later
+'''
+
+import heapq
+import selectors
+import time
+
+
+class MPTimer(object):
+    '''a periodic timer owned by a MPReactor'''
+    def __init__(self, period, callback, args):
+        self.period = period
+        self.callback = callback
+        self.args = args
+        self.deadline = time.time() + period
+        self.cancelled = False
+
+    def cancel(self):
+        '''stop the timer from firing again'''
+        self.cancelled = True
+
+
+class MPReactor(object):
+    '''dispatch readable file descriptors and timers to callbacks'''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # fd -> (callback, args)
+        self.handlers = {}
+        # id(obj) -> [obj, callback, registered fd]
+        self.sources = {}
+        self.timers = []
+        self.timer_seq = 0
+
+    def register_fd(self, fd, callback, args=None):
+        '''call callback(args) whenever fd becomes readable'''
+        if fd in self.handlers:
+            self.unregister_fd(fd)
+        self.handlers[fd] = (callback, args)
+        try:
+            self.selector.register(fd, selectors.EVENT_READ, (callback, args))
+        except (ValueError, OSError):
+            # not a pollable fd (eg. closed); leave it to the caller
+            self.handlers.pop(fd)
+            return False
+        return True
+
+    def unregister_fd(self, fd):
+        '''stop watching fd'''
+        if self.handlers.pop(fd, None) is None:
+            return
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def add_source(self, obj, callback):
+        '''watch a mavfile style object (anything with fd and portdead
+        attributes), calling callback(obj) when it is readable. The
+        fd is re-checked by update_source() as links reconnect'''
+        self.sources[id(obj)] = [obj, callback, None]
+        self.update_source(obj)
+
+    def remove_source(self, obj):
+        '''stop watching a mavfile style object'''
+        source = self.sources.pop(id(obj), None)
+        if source is not None and source[2] is not None:
+            self.unregister_fd(source[2])
+
+    def update_source(self, obj):
+        '''re-register a source if its fd has changed or it has died'''
+        source = self.sources.get(id(obj), None)
+        if source is None:
+            return
+        fd = getattr(obj, 'fd', None)
+        if getattr(obj, 'portdead', False):
+            fd = None
+        if fd == source[2]:
+            return
+        if source[2] is not None:
+            self.unregister_fd(source[2])
+            source[2] = None
+        if fd is not None and self.register_fd(fd, self.dispatch_source, obj):
+            source[2] = fd
+
+    def dispatch_source(self, obj):
+        '''read from a source, then pick up any fd change made by the read'''
+        source = self.sources.get(id(obj), None)
+        if source is None:
+            return
+        source[1](obj)
+        self.update_source(obj)
+
+    def check_sources(self):
+        '''pick up fd changes made outside of a read (eg. a reconnect on write)'''
+        for source in list(self.sources.values()):
+            self.update_source(source[0])
+
+    def add_timer(self, period, callback, args=None):
+        '''call callback(args) every period seconds'''
+        timer = MPTimer(period, callback, args)
+        self.push_timer(timer)
+        return timer
+
+    def push_timer(self, timer):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (timer.deadline, self.timer_seq, timer))
+
+    def next_deadline(self):
+        '''return time of the next timer, or None'''
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return self.timers[0][0]
+
+    def run_timers(self):
+        '''run all timers which are due'''
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (deadline, seq, timer) = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            timer.callback(timer.args)
+            # schedule from the old deadline to avoid drift, but don't
+            # try to catch up if we have fallen a long way behind
+            timer.deadline = max(deadline + timer.period, now)
+            if not timer.cancelled:
+                self.push_timer(timer)
+
+    def run_once(self, max_timeout):
+        '''wait for at most max_timeout seconds for fds or timers, then
+        dispatch whatever is ready'''
+        timeout = max_timeout
+        deadline = self.next_deadline()
+        if deadline is not None:
+            timeout = max(0, min(timeout, deadline - time.time()))
+        if len(self.handlers) == 0:
+            # select() on some platforms fails with no fds
+            time.sleep(timeout)
+            events = []
+        else:
+            try:
+                events = self.selector.select(timeout)
+            except (OSError, ValueError):
+                events = []
+        for (key, mask) in events:
+            (callback, args) = key.data
+            callback(args)
+        self.run_timers()
+
+    def close(self):
+        self.selector.close()
+        self.handlers = {}
+        self.sources = {}
+
+
+class MPSelectExtra(dict):
+    '''a dict of fd -> (fn, args) for modules wanting their own fds in
+    the main loop. Entries are registered with the reactor as they are
+    added, so modules can keep using mpstate.select_extra directly'''
+    def __init__(self, reactor, error_callback=None):
+        super(MPSelectExtra, self).__init__()
+        self.reactor = reactor
+        self.error_callback = error_callback
+
+    def __setitem__(self, fd, value):
+        super(MPSelectExtra, self).__setitem__(fd, value)
+        self.reactor.register_fd(fd, self.dispatch, fd)
+
+    def __delitem__(self, fd):
+        super(MPSelectExtra, self).__delitem__(fd)
+        self.reactor.unregister_fd(fd)
+
+    def pop(self, fd, *args):
+        self.reactor.unregister_fd(fd)
+        return super(MPSelectExtra, self).pop(fd, *args)
+
+    def dispatch(self, fd):
+        '''call the registered read function'''
+        try:
+            (fn, args) = self[fd]
+            fn(args)
+        except Exception as msg:
+            if self.error_callback is not None:
+                self.error_callback(msg)
+            # on an exception, remove it from the select list
+            self.pop(fd, None)
@@ -17,6 +17,8 @@ import time
 import datetime
 import requests
 import threading
+import collections
+import itertools
 
 from MAVProxy.modules.lib import mp_module
 
@@ -24,11 +26,24 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_settings
 
-from .data_random import rand_connect
-from .data_em import em_connect
+# registers the parsers for the em and rand profiles
+from . import data_random
+from . import data_em
+from .sensor_ingest import SensorSource, make_parser
 
 from .local_server import LocalServer
-from .comm import comm
+from .uplink_queue import UplinkQueue
+from .datapoint_buffer import DatapointBuffer
+from .uplink_worker import UplinkWorker
+from .wire_format import HeartbeatEncoder
+from .position_history import PositionHistory, FixHistory
+from .datastore import Datastore, flatten
+from .distance_gate import DistanceGate
+from .event_stream import EventStream
+from .rover_log import RoverLog
+from .command_tracker import CommandTracker
+from .coverage_grid import Coverage
+from .status_snapshot import StatusSnapshot
 
 
 def mavlink_to_dict(msg):
@@ -39,103 +54,39 @@ def mavlink_to_dict(msg):
     return ret
 
 
-def mavlink_to_json(msg):
-    """Translate mavlink python messages in json string
-    - from restserver module"""
-    ret = '\"%s\": {' % msg._type
-    for fieldname in msg._fieldnames:
-        data = getattr(msg, fieldname)
-        ret += '\"%s\" : \"%s\", ' % (fieldname, data)
-    ret = ret[0:-2] + '}'
-    return ret
-
-
-class MavAckAlerts():
-    def __init__(self, remote_self):
-        self.active = []
-        self.remote_self = remote_self
-
-    def add(self, trigger, timeout):
-        finish_time = time.time() + timeout
-        self.active.append({
-            'finish_time': finish_time,
-            'trigger': trigger
-        })
-
-    def check_alerts(self, ack):
-        now = time.time()
-        for alert in list(self.active):
-            trigger = alert['trigger']
-            if trigger['mav_type'] == ack['type'] and trigger['mav_cmd_name'] == ack['name']:
-                # print(f'Mav Alerts - match, {trigger["mav_type"]}')
-                self.active.remove(alert)
-                self.remote_self.update_direct_command(
-                    trigger['direct_command_pk'],
-                    None,
-                    ack['result']
-                )
-                continue
-            if now > alert['finish_time']:
-                # print(f'Mav Alerts - timeout, {trigger["mav_type"]}')
-                self.active.remove(alert)
-
-
-class ServerAlerts():
+class TextList():
     """
-    Capture vehicle alerts and report to API
+    Ring of the latest console lines. Each line gets a sequence number,
+    one higher than the line before, so readers keep the last sequence
+    they saw and ask for the lines since then.
     """
-
-    def __init__(self, remote_self):
-        self.active = []
-        self.remote_self = remote_self
-
-    def add(self, trigger, timeout):
-        finish_time = time.time() + timeout
-        self.active.append({
-            'finish_time': finish_time,
-            'trigger': trigger
-        })
-
-    def check_alerts(self, console_line):
-        now = time.time()
-        for alert in list(self.active):
-            trigger = alert['trigger']
-            if trigger['console_text'] in console_line:
-                self.active.remove(alert)
-                self.remote_self.update_direct_command(
-                    trigger['direct_command_pk'],
-                    trigger['report_status']
-                )
-                continue
-            if now > alert['finish_time']:
-                self.active.remove(alert)
-
-    def check_timeout(self):
-        now = time.time()
-        for alert in list(self.active):
-            if now > alert['finish_time']:
-                self.active.remove(alert)
-
-
-class TextList():
-    def __init__(self, remote_self):
-        self.text = []
+    def __init__(self, remote_self, maxlen=1000):
+        self.text = collections.deque(maxlen=maxlen)
+        self.seq = 0
+        self.lock = threading.Lock()
         self.remote_self = remote_self
 
     def add(self, line):
         line["time"] = datetime.datetime.utcnow().isoformat()
-        self.text.append(line)
-        # trim to 100 lines
-        # self.text = self.text[-100:]
-
-        '''
-        with self.remote_self.local_server.app.test_request_context('/'):
-            self.remote_self.local_server.socketio.emit(
-                'console',
-                line,
-                namespace='/ws'
-            )        
-        '''
+        with self.lock:
+            self.seq += 1
+            line["seq"] = self.seq
+            self.text.append(line)
+        self.remote_self.events.publish('console', line)
+
+    def since(self, seq):
+        '''lines after sequence seq, oldest first, and the latest sequence.
+        Lines that have already dropped out of the ring are skipped'''
+        with self.lock:
+            if seq > self.seq:
+                # reader saw an earlier run of MAVProxy, start again
+                seq = 0
+            count = min(self.seq - seq, len(self.text))
+            if count <= 0:
+                return [], self.seq
+            lines = list(itertools.islice(reversed(self.text), count))
+            lines.reverse()
+            return lines, self.seq
 
 
 class RemoteConsole(textconsole.SimpleConsole):
@@ -144,14 +95,13 @@ class RemoteConsole(textconsole.SimpleConsole):
         self.stored_values = {}
         self.remote_self = remote_self
         self.stored_text = TextList(self.remote_self)
-        self.server_alerts = ServerAlerts(self.remote_self)
 
     def write(self, text, fg='black', bg='white'):
         """write to the console"""
 
         # wrap in try in case bad requests from server
         try:
-            self.server_alerts.check_alerts(text)
+            self.remote_self.command_tracker.check_console(text)
         except Exception as e:
             print(e)
 
@@ -171,6 +121,20 @@ class CropqModule(mp_module.MPModule):
     def __init__(self, mpstate):
         """Initialise module"""
         super(CropqModule, self).__init__(mpstate, "cropq", "")
+        self.set_mavlink_types(['GLOBAL_POSITION_INT', 'GPS_RAW_INT', 'COMMAND_ACK', 'MISSION_ACK'])
+        self.set_idle_rate(20)
+
+        self.rover_log = RoverLog()
+
+        # outcomes of direct commands we are waiting for
+        self.command_tracker = CommandTracker(self)
+
+        # pushed to local server clients on /stream
+        self.events = EventStream()
+        self.stream_status_interval = 0.5
+        self.last_stream_status = 0
+        # type -> field dict last pushed
+        self.stream_status_sent = {}
 
         self.mpstate.console = RemoteConsole(self)
 
@@ -189,10 +153,37 @@ class CropqModule(mp_module.MPModule):
         self.vehicle_server_id = None
 
         # configure data collection
-        self.allow_data_collection_threads = True
         self.data_col_profiles = {}
 
-        self.datapoints = []
+        # datapoints and heartbeats waiting to go to the API
+        self.uplink = UplinkQueue(mp_util.dot_mavproxy('cropq_uplink.db'))
+        self.datapoints = DatapointBuffer(self.uplink)
+        self.uplink_worker = UplinkWorker(self)
+        self.wire = HeartbeatEncoder()
+        self.uplink_batch_size = 100
+        self.uplink_batch_bytes = 256 * 1024
+        self.uplink_max_posts = 20
+        # set while the API refuses everything, until uplink_retry_time
+        self.uplink_fault = None
+        self.uplink_backoff = 0
+        self.uplink_retry_time = 0
+        # shown on the local heartbeats page
+        self.datapoints_since_comm = collections.deque(maxlen=100)
+
+        self.status_snapshot = StatusSnapshot(self.mpstate.status)
+
+        # local copy of everything the data collection profiles record
+        self.datastore = Datastore()
+        # per dataset grid of where samples have been collected
+        self.coverage = Coverage()
+
+        # recent positions of the target vehicle for placing sensor readings
+        self.position_history = {
+            'GLOBAL_POSITION_INT': PositionHistory(),
+            'GPS_RAW_INT': PositionHistory()
+        }
+        # and the GPS fix it had
+        self.fix_history = FixHistory()
 
         self.last_comm = time.time()
 
@@ -200,9 +191,13 @@ class CropqModule(mp_module.MPModule):
         self.packets_mytarget = 0
         self.packets_othertarget = 0
 
-        self.status_text_sent = []
+        # sequence of the last console line queued for the API
+        self.console_seq_sent = 0
         self.io_text_sent = []
-        self.params_last_sent = {}
+        # (sysid, compid) -> ParamState version of the last params queued
+        self.params_version_sent = {}
+        # vehicles/components whose params are sent, None for all
+        self.param_sysids = [(1, 1)]
         self.mpstats_last_sent = {}
         self.heartbeats_latest_20 = []
         self.comm_log_latest_100 = []
@@ -210,14 +205,13 @@ class CropqModule(mp_module.MPModule):
         self.direct_command_queue = []
         self.direct_commands = {}
 
-        self.mav_ack_alerts = MavAckAlerts(self)
 
         self.remote_settings = mp_settings.MPSettings(
             [('verbose', bool, False),
              ])
 
         self.add_command('cropq', self.cmd_cropq, "cropq module",
-                         ['set (LOGSETTING)', 'i (seconds)', 'interval (seconds)'])
+                         ['set (LOGSETTING)', 'i (seconds)', 'interval (seconds)', 'uplink', 'datastore', 'coverage', 'sensors'])
 
     def usage(self):
         '''show help on command line options'''
@@ -225,11 +219,7 @@ class CropqModule(mp_module.MPModule):
 
     def load_config_file(self):
         print('loading config file')
-        self.data_col_profiles = {}
-        self.datapoints = []
-        self.allow_data_collection_threads = False
-        time.sleep(2)
-        self.allow_data_collection_threads = True
+        self.stop_data_collection()
         with open(self.config_file) as config_file:
             config = json.load(config_file)
             self.config = config
@@ -237,7 +227,28 @@ class CropqModule(mp_module.MPModule):
             self.username = config['local']['api']['username']
             self.password = config['local']['api']['password']
             self.vehicle_server_id = int(config['local']['api']['vehicle_id'])
+            self.uplink_worker.set_auth(self.username, self.password)
             self.comm_interval = config['vehicle']['comm_interval_sec']
+            param_sysids = config['vehicle'].get('param_sysids', [[1, 1]])
+            if param_sysids is not None:
+                param_sysids = [tuple(sysid) for sysid in param_sysids]
+            self.param_sysids = param_sysids
+            uplink_config = config['local'].get('uplink', {})
+            self.uplink_batch_size = uplink_config.get('batch_size', self.uplink_batch_size)
+            self.uplink_batch_bytes = uplink_config.get('batch_bytes', self.uplink_batch_bytes)
+            self.uplink_max_posts = uplink_config.get('max_posts', self.uplink_max_posts)
+            self.uplink.max_records = uplink_config.get('max_records', self.uplink.max_records)
+            self.uplink.max_dead = uplink_config.get('max_dead_letters', self.uplink.max_dead)
+            self.datapoints.max_records = uplink_config.get('memory_records', self.datapoints.max_records)
+            self.wire = HeartbeatEncoder(uplink_config.get('format', 'json'),
+                                         uplink_config.get('compression', 'none'))
+            coverage_config = config['local'].get('coverage', {})
+            self.coverage.cell_m = coverage_config.get('cell_m', self.coverage.cell_m)
+            datastore_config = dict(config['local'].get('datastore', {}))
+            self.datastore.close()
+            self.datastore = Datastore(datastore_config.pop('dir', '/home/pi/datastore'),
+                                       datastore_config.pop('format', 'jsonl'),
+                                       **datastore_config)
             # data collection setup
             self.data_collection_setup(config['vehicle']['data_collection'])
             if config['local']['auto_comm_start']:
@@ -259,11 +270,12 @@ class CropqModule(mp_module.MPModule):
         elif args[0] == "reload_config":
             self.load_config_file()
         elif args[0] == "comm":
-            comm()
             self.api_url = args[1]
             self.username = args[2]
             self.password = args[3]
             self.vehicle_server_id = int(args[4])
+            self.uplink_worker.set_auth(self.username, self.password)
+            self.uplink_worker.request_comm()
         elif args[0] == "comm_stop":
             self.comm_start = False
         elif args[0] == "set_comm_interval":
@@ -272,30 +284,190 @@ class CropqModule(mp_module.MPModule):
             self.download_mission_file(args[1], args[2])
         elif args[0] == "set":
             self.remote_settings.command(args[1:])
+        elif args[0] == "uplink":
+            print(self.uplink.stats())
+            print(self.datapoints.stats())
+            print(self.uplink_worker.report())
+            print(self.wire.stats.as_dict())
+            print(self.command_tracker.stats())
+            if self.uplink_fault is not None:
+                print(f'uplink held: {self.uplink_fault}, retrying in {max(0, self.uplink_retry_time - time.time()):.0f}s')
+        elif args[0] == "datastore":
+            print(self.datastore.stats())
+        elif args[0] == "coverage":
+            print(self.coverage.summary())
+        elif args[0] == "sensors":
+            for (name, stats) in self.sensor_stats().items():
+                print(name, stats)
         else:
             print(self.usage())
 
-    def mpstatus_to_json(self, status):
-        """Translate MPStatus in json string - from restserver module"""
-        msg_keys = list(status.msgs.keys())
-        data = '{'
-        for key in msg_keys[:-1]:
-            data += mavlink_to_json(status.msgs[key]) + ','
-        data += mavlink_to_json(status.msgs[msg_keys[-1]])
-        data += '}'
-        return data
+    def mpstatus_snapshot(self):
+        """latest message fields, {type: {field: value}}, shared - don't modify"""
+        return self.status_snapshot.get()
+
+    def mpstatus_message(self, name):
+        """fields of the latest message of one type, or None"""
+        return self.status_snapshot.message(name)
+
+    def add_datapoint(self, datapoint):
+        '''queue a datapoint to be sent to the API'''
+        self.datapoints.put(datapoint)
+        self.events.publish('datapoint', datapoint)
+        self.datapoints_since_comm.append(datapoint)
+
+    def position_at(self, t):
+        '''
+        (lat, lon, alt) of the vehicle at time.monotonic() time t,
+        interpolated from GLOBAL_POSITION_INT, or GPS_RAW_INT if that
+        doesn't cover t. None if neither does
+        '''
+        for mtype in ['GLOBAL_POSITION_INT', 'GPS_RAW_INT']:
+            position = self.position_history[mtype].at(t)
+            if position is not None:
+                return position
+        return None
+
+    def publish_status_changes(self):
+        '''push the status fields that changed since the last push to stream clients'''
+        changes = {}
+        for (mtype, fields) in self.mpstatus_snapshot().items():
+            sent = self.stream_status_sent.get(mtype, None)
+            if fields is sent:
+                # same message as last time
+                continue
+            if sent is None:
+                changes[mtype] = fields
+            else:
+                changed = {k: v for (k, v) in fields.items() if sent.get(k) != v}
+                if changed:
+                    changes[mtype] = changed
+            self.stream_status_sent[mtype] = fields
+        if changes:
+            self.events.publish('status', changes)
+
+    def add_coverage(self, profile_name, lat, lon, data):
+        '''add a sample to its dataset's coverage grid, with the value of
+        the profile's coverage_field (eg. "$PDLM1.hcp_conductivity",
+        default "value")'''
+        profile = self.data_col_profiles[profile_name]
+        value = None
+        field = profile.get('coverage_field', 'value')
+        if field is not None:
+            value = flatten(data).get(field, None)
+        self.coverage.add(profile['dataset_id'], lat, lon, value)
 
     def data_collection_setup(self, profile_list):
         for profile in profile_list:
             profile['file_name'] = None
-            profile['thread'] = None
-            profile['last_point'] = None
+            profile['parser'] = make_parser(profile)
+            if profile['parser'] is None:
+                print(f'No parser for data collection profile {profile["profile_name"]}')
+                continue
+            profile['source'] = None
+            device = profile['parser'].device()
+            if device is not None:
+                profile['source'] = SensorSource(profile['profile_name'], profile['parser'], device,
+                                                 on_close=self.sensor_closed)
+            profile['gate'] = DistanceGate(profile['min_log_distance_m'])
             profile['last_try'] = time.time()
             self.data_col_profiles[profile['profile_name']] = profile
 
+    def stop_data_collection(self):
+        '''close the devices of all data collection profiles'''
+        for profile in self.data_col_profiles.values():
+            source = profile['source']
+            if source is not None:
+                source.close()
+        self.data_col_profiles = {}
+
+    def data_collection_poll(self, now):
+        '''open profile devices that need it and poll the parsers'''
+        for profile in list(self.data_col_profiles.values()):
+            if not profile['on']:
+                continue
+            source = profile['source']
+            if source is not None and not source.is_open():
+                if now - profile['last_try'] <= 3:
+                    continue
+                profile['last_try'] = now
+                print(f'Starting {profile["profile_name"]}')
+                try:
+                    source.open()
+                except Exception as e:
+                    print(f'Problem opening {profile["profile_name"]} serial {source.port}', e)
+                    source.close()
+                    continue
+                if source.fd is None:
+                    # closed again by a failed write as it opened
+                    continue
+                self.mpstate.select_extra[source.fd] = (self.sensor_read, source)
+            self.record_samples(profile, profile['parser'].poll(time.monotonic(), source))
+
+    def sensor_read(self, source):
+        '''a profile's device is readable'''
+        self.record_samples(self.data_col_profiles[source.name], source.read())
+
+    def sensor_closed(self, fd):
+        '''a profile's device was closed, stop watching its fd'''
+        self.mpstate.select_extra.pop(fd, None)
+
+    def record_samples(self, profile, samples):
+        for (sample_time, data) in samples:
+            try:
+                self.record_sample(profile, sample_time, data)
+            except Exception as e:
+                print(f'{profile["profile_name"]} error', e)
+
+    def record_sample(self, profile, sample_time, data):
+        '''place a sample at the vehicle position when it was taken and
+        record it in the datastore, coverage and datapoints to send.
+        Without a GPS fix it still goes in the datastore, with no position'''
+        profile_name = profile['profile_name']
+        data['utc_datetime'] = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+        # correct for serial and sensor latency, set per profile
+        t = sample_time - profile.get('latency_ms', 0) / 1000.0
+        position = self.position_at(t)
+        lat = None
+        lon = None
+        fix = None
+        if position is not None:
+            (lat, lon, alt) = position
+            fix = self.fix_history.at(t)
+        else:
+            gps = self.mpstatus_message('GPS_RAW_INT')
+            if gps is not None:
+                lat = int(gps['lat']) / 1.0e7
+                lon = int(gps['lon']) / 1.0e7
+                fix = (int(gps['fix_type']), int(gps['satellites_visible']))
+        (fix_type, sats) = fix if fix is not None else (None, None)
+        data['position_interpolated'] = position is not None
+        data['lat'] = lat
+        data['lon'] = lon
+        data['sats_visible'] = sats
+        data['sat_fix'] = fix_type
+        if fix_type is not None and fix_type > 1:
+            self.add_coverage(profile_name, lat, lon, data)
+            if profile['gate'].keep(lat, lon):
+                geom = f'POINT({str(lon)} {str(lat)})'
+                self.add_datapoint({'dataset': profile['dataset_id'], 'position': geom, 'data': data})
+        self.datastore.write(profile_name, data)
+
+    def sensor_stats(self):
+        ret = {}
+        for (name, profile) in self.data_col_profiles.items():
+            ret[name] = dict(profile['parser'].stats)
+            if profile['source'] is not None:
+                ret[name].update(profile['source'].report())
+        return ret
+
     def download_mission_file(self, job, mission):
+        '''download a mission on the uplink thread'''
+        self.uplink_worker.submit(lambda: self.download_mission_file_job(job, mission))
+
+    def download_mission_file_job(self, job, mission):
         url = f'{self.api_url}/jobs/{job}/missions/{mission}/text_file/'
-        response = requests.get(url, auth=(self.username, self.password))
+        response = self.uplink_worker.request('mission_download', 'GET', url)
         if response.status_code == 200:
             with open('mission.txt', 'wb') as f:
                 f.write(response.content)
@@ -310,28 +482,28 @@ class CropqModule(mp_module.MPModule):
             return False
 
     def console_text_to_send(self):
+        '''console lines since the last ones sent, and the sequence to
+        record as sent once they are queued'''
         text_to_send = []
-        text_to_save = []
-        for text in self.mpstate.console.stored_text.text:
-            if text not in self.status_text_sent:
-                t = text['text']
-                if text['text'] == ' ':
-                    t = '_'
-                if text['text'] == '\n':
-                    t = '_\n'
-
-                console_text = {
-                    'time': text['time'],
-                    'text': t,
-                    'color_bg': text['bg'],
-                    'color_fg': text['fg']
-                }
-                text_to_save.append(text)
-                text_to_send.append(console_text)
-        return text_to_save, text_to_send
+        lines, seq = self.mpstate.console.stored_text.since(self.console_seq_sent)
+        for text in lines:
+            t = text['text']
+            if text['text'] == ' ':
+                t = '_'
+            if text['text'] == '\n':
+                t = '_\n'
+
+            console_text = {
+                'time': text['time'],
+                'text': t,
+                'color_bg': text['bg'],
+                'color_fg': text['fg']
+            }
+            text_to_send.append(console_text)
+        return seq, text_to_send
 
     def mpstats_to_send(self):
-        status_dict = json.loads(self.mpstatus_to_json(self.mpstate.status))
+        status_dict = self.mpstatus_snapshot()
         mpstats_to_send = []
 
         for key, value in status_dict.items():
@@ -351,22 +523,33 @@ class CropqModule(mp_module.MPModule):
         return mpstats_to_send
 
     def params_to_send(self):
-        param = self.mpstate.mav_param_by_sysid[(1, 1)]
+        '''
+        parameters changed since the last ones queued, and the versions
+        to record as sent once they are queued. Parameters of anything
+        other than 1/1 are tagged with their sysid and compid
+        '''
         params_to_send = []
-
-        for key, value in param.items():
-            try:
-                existing = self.params_last_sent[key]
-            except Exception as e:
-                existing = None
-
-            if existing != value:
-                params_to_send.append({
-                    'name': key,
+        versions = {}
+        param_module = self.module('param')
+        if param_module is None:
+            return params_to_send, versions
+
+        sysids = self.param_sysids
+        if sysids is None:
+            sysids = list(param_module.pstate.keys())
+        for sysid in sysids:
+            changes, versions[sysid] = param_module.params_changed_since(sysid, self.params_version_sent.get(sysid, 0))
+            for (name, value) in changes:
+                param = {
+                    'name': name,
                     'value': value
-                })
+                }
+                if sysid != (1, 1):
+                    param['sysid'] = sysid[0]
+                    param['compid'] = sysid[1]
+                params_to_send.append(param)
 
-        return params_to_send
+        return params_to_send, versions
 
     def update_direct_command(self, direct_command_pk, status=None, mav_status=None):
         '''
@@ -388,9 +571,7 @@ class CropqModule(mp_module.MPModule):
         if status in [2, 3, 4]:
             data["time_vehicle_finish"] = datetime.datetime.utcnow().isoformat()
 
-        url = f'{self.api_url}/vehicles/{self.vehicle_server_id}/mavproxy_commands/{direct_command_pk}/'
-        r = requests.patch(url, auth=(self.username, self.password), json=data)
-        print(r.text)
+        self.uplink_worker.update_command(direct_command_pk, data)
 
     def read_direct_commands(self, direct_commands):
         '''
@@ -418,57 +599,38 @@ class CropqModule(mp_module.MPModule):
         self.mpstate.functions.process_stdin(cmd)
         if mav_cmd_def['track_console']:
             for line in mav_cmd_def['console_text_success']:
-                self.console.server_alerts.add({
-                    'direct_command_pk': direct_command_pk,
-                    'console_text': line,
-                    'report_status': 2,
-                }, mav_cmd_def['timeout'])
+                self.command_tracker.add_console(direct_command_pk, line, 2, mav_cmd_def['timeout'])
             for line in mav_cmd_def['console_text_fail']:
-                self.console.server_alerts.add({
-                    'direct_command_pk': direct_command_pk,
-                    'console_text': line,
-                    'report_status': 3,
-                }, mav_cmd_def['timeout'])
+                self.command_tracker.add_console(direct_command_pk, line, 3, mav_cmd_def['timeout'])
         if mav_cmd_def['track_mav_msg']:
-            self.mav_ack_alerts.add({
-                'direct_command_pk': direct_command_pk,
-                'mav_type': mav_cmd_def['mav_type'],
-                'mav_cmd_name': mav_cmd_def['mav_cmd_name']
-            }, mav_cmd_def['timeout'])
+            self.command_tracker.add_ack(direct_command_pk, mav_cmd_def['mav_type'],
+                                         mav_cmd_def['mav_cmd_name'], mav_cmd_def['timeout'])
 
     def idle_task(self):
-        '''called rapidly by mavproxy'''
+        '''called 20 times a second by mavproxy'''
 
         now = time.time()
 
         # send comm at set interval
         if now - self.last_comm > self.comm_interval and self.comm_start:
             self.last_comm = now
-            x = threading.Thread(target=comm, args=(self,))
-            x.start()
+            self.uplink_worker.request_comm()
 
         # pop another job off the queue
         if len(self.direct_command_queue) > 0:
             self.direct_command_rover()
 
         # check to see if any active alerts have expired
-        self.mpstate.console.server_alerts.check_timeout()
+        self.command_tracker.expire()
 
-        # data collection
-        profile_keys = list(self.data_col_profiles.keys())
+        if self.events.clients > 0 and now - self.last_stream_status >= self.stream_status_interval:
+            self.last_stream_status = now
+            self.publish_status_changes()
 
-        for profile_key in profile_keys:
-            profile = self.data_col_profiles[profile_key]
-            if now - profile['last_try'] > 3 and profile['on'] and not profile['thread']:
-                print(f'Starting {profile["profile_name"]}')
-                profile['thread'] = True
-                profile['last_try'] = now
-                if profile['profile_name'] == 'em':
-                    y = threading.Thread(target=em_connect, args=(self,))
-                    y.start()
-                if profile['profile_name'] == 'rand':
-                    z = threading.Thread(target=rand_connect, args=(self,))
-                    z.start()
+        self.datastore.check()
+
+        # data collection
+        self.data_collection_poll(now)
 
 
     def mavlink_packet(self, m):
@@ -478,29 +640,42 @@ class CropqModule(mp_module.MPModule):
         # sysid = (m.get_srcSystem(),m.get_srcComponent())
         # print(sysid)
 
-        if m.get_type() == 'GLOBAL_POSITION_INT':
+        mtype = m.get_type()
+
+        if mtype == 'GLOBAL_POSITION_INT':
             if self.settings.target_system == 0 or self.settings.target_system == m.get_srcSystem():
                 self.packets_mytarget += 1
+                if m.lat != 0 or m.lon != 0:
+                    self.position_history[mtype].add(time.monotonic(), m.lat / 1.0e7, m.lon / 1.0e7,
+                                                     m.alt / 1000.0)
             else:
                 self.packets_othertarget += 1
-
-        mtype = m.get_type()
+        elif mtype == 'GPS_RAW_INT':
+            if self.settings.target_system == 0 or self.settings.target_system == m.get_srcSystem():
+                now = time.monotonic()
+                self.fix_history.add(now, m.fix_type, m.satellites_visible)
+                if m.fix_type > 1:
+                    self.position_history[mtype].add(now, m.lat / 1.0e7, m.lon / 1.0e7, m.alt / 1000.0)
 
         if mtype == "COMMAND_ACK" or mtype == "MISSION_ACK":
             try:
                 cmd = mavutil.mavlink.enums["MAV_CMD"][m.command].name
                 res = mavutil.mavlink.enums["MAV_RESULT"][m.result].name
                 msg = "Got COMMAND_ACK: %s: %s" % (cmd, res)
-                self.mav_ack_alerts.check_alerts({
-                    'type': mtype,
-                    'name': cmd,
-                    'result': res
-                })
+                self.command_tracker.check_ack(mtype, cmd, res)
                 print(msg)
             except Exception:
                 msg = "Got MAVLink msg: %s" % m
                 print(msg)
 
+    def unload(self):
+        '''close the uplink queue, anything unsent is kept for next time'''
+        self.uplink_worker.stop()
+        self.stop_data_collection()
+        self.datapoints.flush()
+        self.uplink.close()
+        self.datastore.close()
+
 
 def init(mpstate):
     '''initialise module'''
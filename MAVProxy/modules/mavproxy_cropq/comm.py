@@ -1,22 +1,28 @@
-import json
-import os
 import datetime
+import time
+
 import requests
 
+# the API objects to the records sent. The datapoint batch is split to
+# find the records at fault, and only those are dead lettered
+REJECTED = {400, 413, 422}
+# nothing will get through until the config (api url, vehicle id,
+# credentials, wire format) is fixed. Stop sending and back off
+CONFIG_FAULTS = {401, 403, 404, 405, 410, 415}
+# the API is busy or behind a gateway that can't reach it, try later
+# without counting it against the heartbeat
+UNAVAILABLE = {408, 429, 502, 503, 504}
+# most seconds between tries while there is a config fault
+MAX_BACKOFF = 600
+
+
 def comm(self):
     '''
     Schedule POST to API
     Currently set it command line, TODO: manage by config file
     '''
-    filename = '/tmp/rover-log.txt'
-
-    if os.path.exists(filename):
-        append_write = 'a'  # append if already exists
-    else:
-        append_write = 'w'  # make a new file if not
-
-    with open(filename, append_write) as log:
-        status_dict = json.loads(self.mpstatus_to_json(self.mpstate.status))
+    with self.rover_log.writer() as log:
+        status_dict = self.mpstatus_snapshot()
         try:
             lat = int(status_dict['GPS_RAW_INT']['lat']) / 1.0e7
             lon = int(status_dict['GPS_RAW_INT']['lon']) / 1.0e7
@@ -51,11 +57,12 @@ def comm(self):
             log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 3 -- comm -- {e}\n')
             print(e)
 
-        text_to_save, text_to_send = self.console_text_to_send()
-        params_to_send = self.params_to_send()
+        console_seq, text_to_send = self.console_text_to_send()
+        params_to_send, params_versions = self.params_to_send()
         mpstats_to_send = self.mpstats_to_send()
 
-        datapoints_freeze = json.loads(json.dumps(self.datapoints))
+        datapoints_freeze = list(self.datapoints_since_comm)
+        self.datapoints_since_comm.clear()
 
         data = {
             "time_vehicle": datetime.datetime.utcnow().isoformat(),
@@ -70,8 +77,7 @@ def comm(self):
             "custom_mode": custom_mode,
             "console_texts": text_to_send,
             "parameters": params_to_send,
-            "mpstats": mpstats_to_send,
-            "datapoints": datapoints_freeze
+            "mpstats": mpstats_to_send
         }
 
         data_small = {
@@ -86,35 +92,189 @@ def comm(self):
         }
 
         self.heartbeats_latest_20 = [data_small] + self.heartbeats_latest_20
+        self.events.publish('heartbeat', data_small)
         self.heartbeats_latest_20 = self.heartbeats_latest_20[:19]
-        # print(data)
+
+        # the heartbeat is now on disk, so its texts, params and mpstats
+        # count as sent even if the API can't be reached yet. It keeps
+        # what was sent before it, to go back to if it is dead lettered
+        data['_resend'] = {
+            'console_seq': self.console_seq_sent,
+            'params': [[sysid[0], sysid[1], self.params_version_sent.get(sysid, 0)] for sysid in params_versions],
+            'mpstats': [mpstat['name'] for mpstat in mpstats_to_send]
+        }
+        self.uplink.put('heartbeat', data)
+        self.console_seq_sent = console_seq
+        self.params_version_sent.update(params_versions)
+        for mpstat in mpstats_to_send:
+            self.mpstats_last_sent[mpstat['name']] = mpstat['value']
+
+        send_queued(self, log)
+
+    return
+
+
+def send_queued(self, log):
+    '''
+    POST queued heartbeats to the API, oldest first, each carrying a
+    bounded batch of queued datapoints. Records are only removed from
+    the queue once the API has accepted them; stop at the first failure
+    and try again next interval.
+
+    When the API rejects what was sent, the datapoint batch is halved
+    until the record at fault is found, and only that is dead lettered,
+    as is a heartbeat that has failed uplink.max_attempts times. A
+    config fault (eg. a wrong url or vehicle id) holds everything and
+    backs off until it is fixed
+    '''
+    now = time.time()
+    if now < self.uplink_retry_time:
+        return
+    json_bytes = 0
+    wire_bytes = 0
+    batch_size = self.uplink_batch_size
+    # a single datapoint rejected along with its heartbeat, held while
+    # the heartbeat is tried on its own
+    suspect = None
+    for i in range(self.uplink_max_posts):
+        heartbeats = self.uplink.take('heartbeat', 1)
+        if not heartbeats:
+            break
+        (heartbeat_id, data) = heartbeats[0]
+        resend = data.pop('_resend', None)
+        datapoints = self.datapoints.take(batch_size, self.uplink_batch_bytes)
+        data['datapoints'] = datapoints.records
+        url = f'{self.api_url}/vehicles/{self.vehicle_server_id}/heartbeats/'
         try:
-            r = requests.post(f'{self.api_url}/vehicles/{self.vehicle_server_id}/heartbeats/',
-                          auth=(self.username, self.password),
-                          json=data
-                          )
-
-            if r.status_code == 201 or r.status_code == 200:
-                # update sent mpstats & params
-                self.status_text_sent += text_to_save
-                for param in params_to_send:
-                    self.params_last_sent[param['name']] = param['value']
-                for mpstat in mpstats_to_send:
-                    self.mpstats_last_sent[mpstat['name']] = mpstat['value']
-                for dp in datapoints_freeze:
-                    if dp in self.datapoints:
-                        self.datapoints.remove(dp)
-
-                # get new commands in response
-                response = r.json()
-                print(response)
-                log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm response -- {response}\n')
-                self.read_direct_commands(response['direct_commands'])
+            body, headers, pending = self.wire.encode(data)
+            json_bytes += self.wire.stats.last_json_bytes
+            wire_bytes += len(body)
+            r = self.uplink_worker.request('heartbeats', 'POST', url, data=body, headers=headers)
+        except requests.exceptions.RequestException as e:
+            # API not reached, not the heartbeat's fault
+            self.uplink.release([heartbeat_id])
+            self.datapoints.release(datapoints)
+            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 4 -- Caught making POST -- {e}\n')
+            break
+        except Exception as e:
+            release_failed(self, heartbeat_id, resend, datapoints, log)
+            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 4 -- Caught encoding heartbeat -- {e}\n')
+            break
+
+        status = r.status_code
+        if status == 201 or status == 200:
+            self.uplink.ack([heartbeat_id])
+            self.datapoints.ack(datapoints)
+            self.wire.ack(pending)
+            self.uplink_backoff = 0
+            self.uplink_fault = None
+            if suspect is not None:
+                # the heartbeat was fine on its own, so the datapoint wasn't
+                self.datapoints.dead_letter(suspect, f'http {suspect_status}')
+                log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 5 -- comm response -- datapoint rejected, dead lettered -- {suspect_status}\n')
+                suspect = None
+                batch_size = self.uplink_batch_size
+            read_response(self, r, log)
+        elif status in REJECTED:
+            print(status, r.content)
+            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 5 -- comm response -- rejected -- {status} {r.content}\n')
+            self.uplink.release([heartbeat_id])
+            if len(datapoints.records) > 1:
+                # try again with half the datapoints
+                self.datapoints.release(datapoints)
+                batch_size = len(datapoints.records) // 2
+            elif len(datapoints.records) == 1:
+                # try the heartbeat on its own
+                suspect = datapoints
+                suspect_status = status
+                batch_size = 0
             else:
-                print(r.status_code, r.content)
-                log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm response -- bad response from server -- {r.status_code} {r.content}\n')
+                # the heartbeat itself
+                self.uplink.dead_letter([heartbeat_id], f'http {status}')
+                resend_later(self, resend)
+                if suspect is not None:
+                    self.datapoints.release(suspect)
+                    suspect = None
+                batch_size = self.uplink_batch_size
+                log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 5 -- comm response -- heartbeat dead lettered\n')
+        elif status in CONFIG_FAULTS:
+            self.uplink.release([heartbeat_id])
+            self.datapoints.release(datapoints)
+            config_fault(self, status, url, r.content, log)
+            break
+        elif status in UNAVAILABLE:
+            self.uplink.release([heartbeat_id])
+            self.datapoints.release(datapoints)
+            print(status, r.content)
+            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm response -- API unavailable -- {status}\n')
+            break
+        else:
+            release_failed(self, heartbeat_id, resend, datapoints, log)
+            print(status, r.content)
+            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm response -- bad response from server -- {status} {r.content}\n')
+            break
 
-        except Exception as e:
-            log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 4 -- Caught making POST or dealing with response -- {e}\n')
+    if suspect is not None:
+        self.datapoints.release(suspect)
+    if json_bytes:
+        log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm bytes -- json {json_bytes} wire {wire_bytes} ({self.wire.wire_format}, {self.wire.compression})\n')
 
-    return
+
+def read_response(self, r, log):
+    '''
+    handle the reply to an accepted heartbeat. The records are already
+    acked, so a reply that can't be read is logged and otherwise ignored
+    '''
+    try:
+        response = r.json()
+        if not isinstance(response, dict):
+            raise ValueError(f'unexpected response {response!r}')
+        if response.get('wire_reset'):
+            # the API lost our name dictionary
+            self.wire.reset()
+        print(response)
+        log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} INFO -- comm response -- {response}\n')
+        self.read_direct_commands(response.get('direct_commands', []))
+    except Exception as e:
+        log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 6 -- reading comm response -- {e}\n')
+
+
+def config_fault(self, status, url, content, log):
+    '''the API can't take anything as configured, hold the queue and back off'''
+    self.uplink_backoff = min(max(2 * self.uplink_backoff, self.comm_interval), MAX_BACKOFF)
+    self.uplink_retry_time = time.time() + self.uplink_backoff
+    self.uplink_fault = f'{status} from {url}'
+    message = (f'cropq uplink: {status} from {url} - check the api url, vehicle id, credentials and '
+               f'wire format. Holding {self.uplink.count("heartbeat")} heartbeats, '
+               f'retrying in {self.uplink_backoff}s')
+    self.console.writeln(message)
+    log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 7 -- {message} -- {content}\n')
+
+
+def resend_later(self, resend):
+    '''
+    a heartbeat was dead lettered, so the console text, params and mpstats
+    it carried go in the next heartbeat instead
+    '''
+    if not resend:
+        return
+    self.console_seq_sent = min(self.console_seq_sent, resend['console_seq'])
+    for (sys, comp, version) in resend['params']:
+        sysid = (sys, comp)
+        self.params_version_sent[sysid] = min(self.params_version_sent.get(sysid, 0), version)
+    for name in resend['mpstats']:
+        self.mpstats_last_sent.pop(name, None)
+
+
+def release_failed(self, heartbeat_id, resend, datapoints, log):
+    '''
+    the API answered but didn't take the heartbeat. Release it for another
+    attempt, or dead letter it with its datapoints once it has used up
+    uplink.max_attempts
+    '''
+    if self.uplink.release([heartbeat_id], failed=True):
+        self.datapoints.dead_letter(datapoints, f'{self.uplink.max_attempts} attempts')
+        resend_later(self, resend)
+        log.write(f'{datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")} ERROR 5 -- comm response -- heartbeat failed {self.uplink.max_attempts} times, dead lettered\n')
+    else:
+        self.datapoints.release(datapoints, failed=True)
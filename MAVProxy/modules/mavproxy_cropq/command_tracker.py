@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+
+
+class CommandTracker():
+    """
+    Watches for the outcome of direct commands from the API and reports
+    it through update_direct_command, which queues it for the uplink.
+
+    Alerts waiting on a mavlink ack are indexed by (mav_type, command
+    name). Alerts waiting on console text are screened with one compiled
+    regex of all the pending texts, so a console line that matches none
+    of them costs a single search. Every alert also goes on a deadline
+    heap and is dropped when it times out.
+    """
+
+    def __init__(self, remote_self):
+        self.remote_self = remote_self
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # alert id -> alert dict, for alerts still waiting
+        self.active = {}
+        # (mav_type, mav_cmd_name) -> [alert id]
+        self.by_ack = {}
+        # console text -> [alert id]
+        self.by_text = {}
+        self.text_regex = None
+        # (finish_time, alert id), may hold ids that already matched
+        self.deadlines = []
+        self.matched = 0
+        self.expired = 0
+
+    def add(self, alert, timeout):
+        alert_id = next(self.ids)
+        alert['finish_time'] = time.time() + timeout
+        self.active[alert_id] = alert
+        heapq.heappush(self.deadlines, (alert['finish_time'], alert_id))
+        return alert_id
+
+    def add_ack(self, direct_command_pk, mav_type, mav_cmd_name, timeout):
+        '''report the result of the next mav_type ack for mav_cmd_name'''
+        with self.lock:
+            key = (mav_type, mav_cmd_name)
+            alert_id = self.add({'direct_command_pk': direct_command_pk, 'key': key}, timeout)
+            self.by_ack.setdefault(key, []).append(alert_id)
+
+    def add_console(self, direct_command_pk, console_text, report_status, timeout):
+        '''report report_status when console_text appears on the console'''
+        with self.lock:
+            alert_id = self.add({'direct_command_pk': direct_command_pk,
+                                 'console_text': console_text,
+                                 'report_status': report_status}, timeout)
+            if console_text not in self.by_text:
+                self.text_regex = None
+            self.by_text.setdefault(console_text, []).append(alert_id)
+
+    def remove(self, alert_id):
+        '''forget an alert, lock held'''
+        alert = self.active.pop(alert_id, None)
+        if alert is None:
+            return
+        if 'key' in alert:
+            index = self.by_ack
+            key = alert['key']
+        else:
+            index = self.by_text
+            key = alert['console_text']
+        ids = index.get(key, None)
+        if ids is None:
+            return
+        if alert_id in ids:
+            ids.remove(alert_id)
+        if not ids:
+            del index[key]
+            if index is self.by_text:
+                self.text_regex = None
+
+    def check_ack(self, mav_type, mav_cmd_name, result):
+        '''a mavlink ack arrived'''
+        with self.lock:
+            ids = self.by_ack.pop((mav_type, mav_cmd_name), None)
+            if ids is None:
+                return
+            alerts = [self.active.pop(alert_id) for alert_id in ids if alert_id in self.active]
+            self.matched += len(alerts)
+        for alert in alerts:
+            self.remote_self.update_direct_command(alert['direct_command_pk'], None, result)
+
+    def check_console(self, line):
+        '''a line was written to the console'''
+        if not self.by_text or not isinstance(line, str):
+            return
+        with self.lock:
+            if self.text_regex is None:
+                if not self.by_text:
+                    return
+                # longest first, so one pending text inside another can't hide it
+                texts = sorted(self.by_text.keys(), key=len, reverse=True)
+                self.text_regex = re.compile('|'.join(re.escape(t) for t in texts))
+            if self.text_regex.search(line) is None:
+                return
+            alerts = []
+            for text in [t for t in self.by_text.keys() if t in line]:
+                for alert_id in list(self.by_text[text]):
+                    alerts.append(self.active[alert_id])
+                    self.remove(alert_id)
+            self.matched += len(alerts)
+        for alert in alerts:
+            self.remote_self.update_direct_command(alert['direct_command_pk'], alert['report_status'])
+
+    def expire(self):
+        '''drop alerts past their deadline'''
+        now = time.time()
+        if not self.deadlines or self.deadlines[0][0] > now:
+            return
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                (finish_time, alert_id) = heapq.heappop(self.deadlines)
+                if alert_id in self.active:
+                    self.remove(alert_id)
+                    self.expired += 1
+
+    def stats(self):
+        return {
+            'active': len(self.active),
+            'ack_keys': len(self.by_ack),
+            'console_texts': len(self.by_text),
+            'matched': self.matched,
+            'expired': self.expired
+        }
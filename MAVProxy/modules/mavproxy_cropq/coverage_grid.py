@@ -0,0 +1,170 @@
+import math
+import threading
+
+from MAVProxy.modules.lib import mp_util
+
+METERS_PER_DEGREE = math.radians(mp_util.radius_of_earth)
+# cells per side of an index block
+BLOCK = 64
+# most cells per side returned in one tile, coarser cells are merged
+TILE_CELLS = 64
+
+
+def tile_bounds(z, x, y):
+    """(south, west, north, east) of a web mercator XYZ tile"""
+    n = 2.0 ** z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return (lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0)
+
+
+class CoverageGrid():
+    """
+    Samples of one dataset aggregated into square cells of cell_m
+    metres: count, and mean/min/max of one value per sample. Cells are
+    on a flat projection around the first sample, which is fine for
+    the size of a paddock, and are indexed in blocks so a tile only
+    looks at the cells near it.
+    """
+
+    def __init__(self, cell_m=2.0):
+        self.cell_m = cell_m
+        self.origin = None
+        self.lon_scale = METERS_PER_DEGREE
+        self.lock = threading.Lock()
+        # (bx, by) -> {(ix, iy): [count, value count, sum, min, max]}
+        self.blocks = {}
+        self.cells = 0
+        self.samples = 0
+        # index range of the cells, (ix_min, iy_min, ix_max, iy_max)
+        self.bounds = None
+
+    def cell_index(self, lat, lon):
+        (lat0, lon0) = self.origin
+        x = (lon - lon0) * self.lon_scale
+        y = (lat - lat0) * METERS_PER_DEGREE
+        return (int(math.floor(x / self.cell_m)), int(math.floor(y / self.cell_m)))
+
+    def cell_corner(self, ix, iy):
+        """lat, lon of the south west corner of a cell"""
+        (lat0, lon0) = self.origin
+        return (lat0 + iy * self.cell_m / METERS_PER_DEGREE, lon0 + ix * self.cell_m / self.lon_scale)
+
+    def add(self, lat, lon, value=None):
+        with self.lock:
+            if self.origin is None:
+                self.origin = (lat, lon)
+                self.lon_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+            (ix, iy) = self.cell_index(lat, lon)
+            block = self.blocks.setdefault((ix // BLOCK, iy // BLOCK), {})
+            cell = block.get((ix, iy), None)
+            if cell is None:
+                cell = [0, 0, 0.0, None, None]
+                block[(ix, iy)] = cell
+                self.cells += 1
+                if self.bounds is None:
+                    self.bounds = (ix, iy, ix, iy)
+                else:
+                    b = self.bounds
+                    self.bounds = (min(b[0], ix), min(b[1], iy), max(b[2], ix), max(b[3], iy))
+            cell[0] += 1
+            self.samples += 1
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cell[1] += 1
+                cell[2] += value
+                cell[3] = value if cell[3] is None else min(cell[3], value)
+                cell[4] = value if cell[4] is None else max(cell[4], value)
+
+    def extent(self):
+        """(south, west, north, east) of the cells, or None"""
+        b = self.bounds
+        if b is None:
+            return None
+        (south, west) = self.cell_corner(b[0], b[1])
+        (north, east) = self.cell_corner(b[2] + 1, b[3] + 1)
+        return (south, west, north, east)
+
+    def tile(self, z, x, y):
+        """
+        cells inside a tile as columns: south, west, north, east, count,
+        mean, min, max. Where the tile would hold more than TILE_CELLS
+        cells per side, groups of cells are merged into one, with the
+        bounds of the cells that have samples rather than the whole group
+        """
+        ret = {'size_m': self.cell_m, 'south': [], 'west': [], 'north': [], 'east': [],
+               'count': [], 'mean': [], 'min': [], 'max': []}
+        if self.origin is None:
+            return ret
+        (south, west, north, east) = tile_bounds(z, x, y)
+        (ix0, iy0) = self.cell_index(south, west)
+        (ix1, iy1) = self.cell_index(north, east)
+        span = max(ix1 - ix0, iy1 - iy0) + 1
+        size = 1
+        while span // size > TILE_CELLS:
+            size *= 2
+        merged = {}
+        with self.lock:
+            # only look at blocks that can hold cells
+            b = self.bounds
+            for bx in range(max(ix0, b[0]) // BLOCK, min(ix1, b[2]) // BLOCK + 1):
+                for by in range(max(iy0, b[1]) // BLOCK, min(iy1, b[3]) // BLOCK + 1):
+                    block = self.blocks.get((bx, by), None)
+                    if block is None:
+                        continue
+                    for ((ix, iy), cell) in block.items():
+                        if ix < ix0 or ix > ix1 or iy < iy0 or iy > iy1:
+                            continue
+                        key = (ix // size, iy // size)
+                        m = merged.get(key, None)
+                        if m is None:
+                            merged[key] = list(cell) + [ix, iy, ix, iy]
+                            continue
+                        m[5] = min(m[5], ix)
+                        m[6] = min(m[6], iy)
+                        m[7] = max(m[7], ix)
+                        m[8] = max(m[8], iy)
+                        m[0] += cell[0]
+                        m[1] += cell[1]
+                        m[2] += cell[2]
+                        if cell[3] is not None:
+                            m[3] = cell[3] if m[3] is None else min(m[3], cell[3])
+                            m[4] = cell[4] if m[4] is None else max(m[4], cell[4])
+        ret['size_m'] = self.cell_m * size
+        for (count, nvalues, total, vmin, vmax, ix0, iy0, ix1, iy1) in merged.values():
+            (south, west) = self.cell_corner(ix0, iy0)
+            (north, east) = self.cell_corner(ix1 + 1, iy1 + 1)
+            ret['south'].append(round(south, 7))
+            ret['west'].append(round(west, 7))
+            ret['north'].append(round(north, 7))
+            ret['east'].append(round(east, 7))
+            ret['count'].append(count)
+            ret['mean'].append(total / nvalues if nvalues else None)
+            ret['min'].append(vmin)
+            ret['max'].append(vmax)
+        return ret
+
+    def summary(self):
+        return {'cell_m': self.cell_m, 'cells': self.cells, 'samples': self.samples, 'extent': self.extent()}
+
+
+class Coverage():
+    """CoverageGrids by dataset id"""
+
+    def __init__(self, cell_m=2.0):
+        self.cell_m = cell_m
+        self.lock = threading.Lock()
+        self.grids = {}
+
+    def add(self, dataset, lat, lon, value=None):
+        grid = self.grids.get(dataset, None)
+        if grid is None:
+            with self.lock:
+                grid = self.grids.setdefault(dataset, CoverageGrid(self.cell_m))
+        grid.add(lat, lon, value)
+
+    def get(self, dataset):
+        return self.grids.get(dataset, None)
+
+    def summary(self):
+        return {str(dataset): grid.summary() for (dataset, grid) in list(self.grids.items())}
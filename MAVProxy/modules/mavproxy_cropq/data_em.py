@@ -1,98 +1,71 @@
-import serial
-import datetime
 import time
-import json
 
-import geopy.distance
+from .sensor_ingest import NmeaParser, register_parser
 
+# sentences making up one reading, by EM model
+MODEL_ROUNDS = {
+    '1s': ('$PDLM1', '$PDLMA'),
+}
 
-def nmea_to_json(line):
-    split = line.split('*')
-    data = split[0].split(',')
-    if data[0] == '$PDLMA':
-        return data[0], {
-            'voltage': float(data[1]),
-            'temperature': float(data[2]),
-            'pitch': float(data[3]),
-            'roll': float(data[4])
+
+def nmea_to_json(fields):
+    if fields[0] == '$PDLMA':
+        return {
+            'voltage': float(fields[1]),
+            'temperature': float(fields[2]),
+            'pitch': float(fields[3]),
+            'roll': float(fields[4])
         }
-    elif data[0][:5] == '$PDLM':
-        return data[0], {
-            'array_length': str(data[0][5]), # needs to be string as half meter is 'H'
-            'time': data[1],
-            'hcp_conductivity': float(data[2]),
-            'hcp_inphase': float(data[3]),
-            'prp_conductivity': float(data[4]),
-            'prp_inphase': float(data[5])
+    elif fields[0][:5] == '$PDLM':
+        return {
+            'array_length': str(fields[0][5]), # needs to be string as half meter is 'H'
+            'time': fields[1],
+            'hcp_conductivity': float(fields[2]),
+            'hcp_inphase': float(fields[3]),
+            'prp_conductivity': float(fields[4]),
+            'prp_inphase': float(fields[5])
         }
+    return None
 
 
-def em_connect(self):
-    connection = serial.Serial('/dev/ttyUSB0', 9600, timeout=2)
-    connection.write(b'%')
-    self.em_file = f'em_{datetime.datetime.utcnow().replace(microsecond=0).isoformat()}'
-
-    time_tracker = time.time()
+@register_parser('em')
+class EmParser(NmeaParser):
+    """DualEM conductivity sensor, one sample per round of sentences"""
+    default_device = {'port': '/dev/ttyUSB0', 'baud': 9600}
 
-    count = 0
+    def __init__(self, profile):
+        super().__init__(profile)
+        self.round = set(profile.get('round_sentences', MODEL_ROUNDS.get(profile.get('model'), MODEL_ROUNDS['1s'])))
+        self.data = {}
+        self.sample_time = None
+        self.last_request = 0
 
-    while True:
-        if self.allow_data_collection_threads:
-            try:
-                if time.time() - time_tracker > 1:
-                    connection.write(b'%') # tells em to send extra line with pitch, roll etc
-                data = {}
-                round_complete = False
-                while not round_complete:
-                    # print('round not complete', data.keys())
-                    line = connection.readline().decode('utf-8')
-                    # print(line)
-                    if '$' in line:
-                        key, json_line = nmea_to_json(line)
-                        data[key] = json_line
+    def opened(self, source):
+        self.data = {}
+        self.sample_time = None
+        self.request(source)
 
-                    if self.data_col_profiles['em']['model'] == '1s':
-                        if '$PDLM1' in data.keys() and '$PDLMA' in data.keys():
-                            round_complete = True
-                else:
-                    # print('round_complete')
-                    data['utc_datetime'] = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
-                    status_dict = json.loads(self.mpstatus_to_json(self.mpstate.status))
-                    gps = status_dict['GPS_RAW_INT']
-                    lat = int(gps['lat']) / 1.0e7
-                    lon = int(gps['lon']) / 1.0e7
-                    data['lat'] = lat
-                    data['lon'] = lon
-                    data['sats_visible'] = int(gps['satellites_visible'])
-                    data['sat_fix'] = int(gps['fix_type'])
-                    if int(gps['fix_type']) > 1:
-                        geom = f'POINT({str(lon)} {str(lat)})'
-                        distance = 0
-                        if self.data_col_profiles['em']['last_point']:
-                            distance = geopy.distance.geodesic(self.data_col_profiles['em']['last_point'], (lat, lon))
-                            print('DISTANCE', distance)
-                            if distance > self.data_col_profiles['em']['min_log_distance_m'] / 1000:
-                                self.datapoints.append({'dataset': self.data_col_profiles['em']['dataset_id'], 'position': geom, 'data': data})
-                                self.data_col_profiles['em']['last_point'] = (lat, lon)
-                        else:
-                            self.data_col_profiles['em']['last_point'] = (lat, lon)
-                            self.datapoints.append({'dataset': self.data_col_profiles['em']['dataset_id'], 'position': geom, 'data': data})
-                    f = open(f'/home/pi/datastore/{self.em_file}.txt', 'a')
-                    f.write(json.dumps(data) +'\n')
-                    f.close()
+    def request(self, source):
+        # tells em to send extra line with pitch, roll etc
+        self.last_request = time.monotonic()
+        source.write(b'%')
 
-                count = 0
-                    # time.sleep(1)
-            except Exception as e:
-                print('Problem accessing EM serial - this may resolve itself', count)
-                print(e)
-                count = count + 1
-                if count == 10:
-                    print('10 error in row - reconnect')
-                    break
-            # time.sleep(0.2)
-        else:
-            break
+    def poll(self, now, source):
+        if source is not None and time.monotonic() - self.last_request > 1:
+            self.request(source)
+        return []
 
-    connection.close()
-    self.em_thread = False
+    def sentence(self, talker, fields, now):
+        data = nmea_to_json(fields)
+        if data is None:
+            return None
+        if self.sample_time is None:
+            # the reading was taken when its first sentence arrived
+            self.sample_time = now
+        self.data[talker] = data
+        if not self.round.issubset(self.data.keys()):
+            return None
+        sample = (self.sample_time, self.data)
+        self.data = {}
+        self.sample_time = None
+        return sample
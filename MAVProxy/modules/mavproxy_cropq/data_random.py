@@ -1,39 +1,22 @@
 import random
-import json
 import time
 
-import geopy.distance
+from .sensor_ingest import SensorParser, register_parser
 
 
-def rand_connect(self):
-    while True:
-        if self.allow_data_collection_threads:
-            try:
-                # generate random number and write to datastore and append to datapoints to send
-                r = random.random()
-                status_dict = json.loads(self.mpstatus_to_json(self.mpstate.status))
-                gps = status_dict['GPS_RAW_INT']
-                lat = int(gps['lat']) / 1.0e7
-                lon = int(gps['lon']) / 1.0e7
-                if int(gps['fix_type']) > 1:
-                    geom = f'POINT({str(lon)} {str(lat)})'
-                    distance = 0
-                    if self.data_col_profiles['rand']['last_point']:
-                        distance = geopy.distance.geodesic(self.data_col_profiles['rand']['last_point'], (lat, lon))
-                        print('DISTANCE', distance)
-                        if distance >= self.data_col_profiles['rand']['min_log_distance_m'] / 1000:
-                            self.datapoints.append(
-                                {'dataset': self.data_col_profiles['rand']['dataset_id'], 'position': geom,
-                                 'data': {'value': r, 'lat': lat, 'lon': lon}})
-                            self.data_col_profiles['rand']['last_point'] = (lat, lon)
-                    else:
-                        self.data_col_profiles['rand']['last_point'] = (lat, lon)
-                        self.datapoints.append({'dataset': self.data_col_profiles['rand']['dataset_id'], 'position': geom,
-                                                'data': {'value': r, 'lat': lat, 'lon': lon}})
+@register_parser('rand')
+class RandomParser(SensorParser):
+    """random number every interval seconds, for testing without a sensor"""
 
-            except Exception as e:
-                print('Rand error', e)
+    def __init__(self, profile):
+        super().__init__(profile)
+        self.interval = profile.get('interval_sec', 2)
+        self.last_sample = 0
 
-            time.sleep(2)
-        else:
-            break
+    def poll(self, now, source):
+        now = time.monotonic()
+        if now - self.last_sample < self.interval:
+            return []
+        self.last_sample = now
+        self.stats['samples'] += 1
+        return [(now, {'value': random.random()})]
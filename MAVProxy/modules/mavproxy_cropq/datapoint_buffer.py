@@ -0,0 +1,137 @@
+import collections
+import json
+import threading
+
+
+class DatapointBatch():
+    """datapoints taken for one send, to be acked or released together"""
+    def __init__(self):
+        self.disk_ids = []
+        # sequence range taken from memory, first > last when none
+        self.mem_first = 1
+        self.mem_last = 0
+        self.records = []
+
+
+class DatapointBuffer():
+    """
+    Buffer between the data collection threads and the uplink.
+
+    Datapoints get increasing sequence numbers and are held in memory up
+    to max_records, beyond which the oldest are spilled to the durable
+    uplink queue in chunks. The uplink takes spilled datapoints first,
+    then those in memory, and acknowledges a batch as a whole; memory
+    records are always taken from the front, so acking them is a range.
+    """
+
+    def __init__(self, uplink, max_records=5000, spill_chunk=500):
+        self.uplink = uplink
+        self.max_records = max_records
+        self.spill_chunk = spill_chunk
+        self.lock = threading.Lock()
+        # (seq, payload size, record)
+        self.memory = collections.deque()
+        self.seq = 0
+        # records up to this sequence have been taken and not yet acked
+        self.in_flight_seq = 0
+        self.produced = 0
+        self.sent = 0
+        self.spilled = 0
+        self.dead_lettered = 0
+
+    def put(self, record):
+        """add a datapoint, may be called from any thread"""
+        size = len(json.dumps(record))
+        spill = None
+        with self.lock:
+            self.seq += 1
+            self.memory.append((self.seq, size, record))
+            self.produced += 1
+            if len(self.memory) > self.max_records:
+                spill = self.take_spill()
+        if spill:
+            self.uplink.put_many('datapoint', spill)
+
+    def take_spill(self):
+        """remove the oldest datapoints not being sent, lock held"""
+        keep = []
+        while self.memory and self.memory[0][0] <= self.in_flight_seq:
+            keep.append(self.memory.popleft())
+        count = min(len(self.memory), len(self.memory) + len(keep) - self.max_records + self.spill_chunk)
+        spill = [self.memory.popleft()[2] for i in range(count)]
+        self.memory.extendleft(reversed(keep))
+        self.spilled += len(spill)
+        return spill
+
+    def take(self, max_records=100, max_bytes=256 * 1024):
+        """take the oldest datapoints, spilled ones first, as a DatapointBatch"""
+        batch = DatapointBatch()
+        for (rowid, record) in self.uplink.take('datapoint', max_records, max_bytes):
+            batch.disk_ids.append(rowid)
+            batch.records.append(record)
+        size = sum(len(json.dumps(r)) for r in batch.records)
+        with self.lock:
+            batch.mem_first = self.in_flight_seq + 1
+            for (seq, rsize, record) in self.memory:
+                if seq <= self.in_flight_seq:
+                    continue
+                if len(batch.records) >= max_records:
+                    break
+                if batch.records and size + rsize > max_bytes:
+                    break
+                batch.records.append(record)
+                size += rsize
+                batch.mem_last = seq
+            if batch.mem_last >= batch.mem_first:
+                self.in_flight_seq = batch.mem_last
+        return batch
+
+    def ack(self, batch):
+        """the batch was accepted by the API"""
+        if batch.disk_ids:
+            self.uplink.ack(batch.disk_ids)
+        with self.lock:
+            while self.memory and self.memory[0][0] <= batch.mem_last:
+                self.memory.popleft()
+            self.sent += len(batch.records)
+
+    def release(self, batch, failed=False):
+        """the batch wasn't sent, make it available to take() again"""
+        if batch.disk_ids:
+            self.dead_lettered += len(self.uplink.release(batch.disk_ids, failed))
+        with self.lock:
+            if batch.mem_last >= batch.mem_first:
+                self.in_flight_seq = min(self.in_flight_seq, batch.mem_first - 1)
+
+    def dead_letter(self, batch, reason):
+        """the API will never take the batch, move it to the dead letters"""
+        if batch.disk_ids:
+            self.uplink.dead_letter(batch.disk_ids, reason)
+        memory = []
+        with self.lock:
+            while self.memory and self.memory[0][0] <= batch.mem_last:
+                memory.append(self.memory.popleft()[2])
+        if memory:
+            self.uplink.put_dead('datapoint', memory, reason)
+        self.dead_lettered += len(batch.records)
+
+    def flush(self):
+        """move everything in memory to the uplink queue, eg. on unload"""
+        with self.lock:
+            spill = [record for (seq, size, record) in self.memory]
+            self.memory.clear()
+            self.in_flight_seq = self.seq
+            self.spilled += len(spill)
+        if spill:
+            self.uplink.put_many('datapoint', spill)
+
+    def stats(self):
+        return {
+            'produced': self.produced,
+            'sent': self.sent,
+            'in_memory': len(self.memory),
+            'spilled': self.spilled,
+            'on_disk': self.uplink.count('datapoint'),
+            'dropped': self.uplink.dropped.get('datapoint', 0),
+            'dead_lettered': self.dead_lettered
+        }
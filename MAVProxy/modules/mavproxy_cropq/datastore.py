@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Local datastore for data collection profiles.
+
+Samples are buffered and written in batches, flushed when enough have
+built up or enough time has passed, fsynced at rotation, close and at
+a set interval, and rotated by size or age. Files are either JSON lines
+(.jsonl) or column blocks (.cqds): a magic header followed by blocks of
+a 4 byte length and zlib compressed JSON {"rows": n, "columns": [...]}.
+Each column is [path, values] with path the list of keys down to the
+value, plus a list of the rows it is in when not every row has it, so
+records read back exactly as written, None, empty dicts and keys with
+dots in them included.
+
+Run as a script to convert files back to JSON lines:
+    datastore.py export em_20210101T000000_0000.cqds > em.jsonl
+"""
+import datetime
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+FORMATS = ['jsonl', 'columnar']
+MAGIC = b'CQDS2\n'
+# column blocks as {column: [values]}, dotted names and no None
+MAGIC_V1 = b'CQDS1\n'
+EXTENSIONS = {'jsonl': '.jsonl', 'columnar': '.cqds'}
+
+
+def flatten(data, prefix=''):
+    """nested dicts to {'a.b': value}"""
+    ret = {}
+    for (key, value) in data.items():
+        if isinstance(value, dict):
+            ret.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            ret[f'{prefix}{key}'] = value
+    return ret
+
+
+def unflatten(data):
+    """{'a.b': value} back to nested dicts"""
+    ret = {}
+    for (key, value) in data.items():
+        parts = key.split('.')
+        d = ret
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+        d[parts[-1]] = value
+    return ret
+
+
+def leaves(data, path=()):
+    """(path, value) for every value in nested dicts, empty dicts included"""
+    for (key, value) in data.items():
+        if isinstance(value, dict) and value:
+            yield from leaves(value, path + (key,))
+        else:
+            yield (path + (key,), value)
+
+
+def to_columns(records):
+    """list of records to a column block, see the module docstring"""
+    columns = {}
+    for (i, record) in enumerate(records):
+        for (path, value) in leaves(record):
+            column = columns.get(path, None)
+            if column is None:
+                column = ([], [])
+                columns[path] = column
+            column[0].append(i)
+            column[1].append(value)
+    block = []
+    for (path, (rows, values)) in columns.items():
+        if len(rows) == len(records):
+            block.append([list(path), values])
+        else:
+            block.append([list(path), values, rows])
+    return {'rows': len(records), 'columns': block}
+
+
+def from_columns(block):
+    """a column block back to its list of records"""
+    records = [{} for i in range(block['rows'])]
+    for column in block['columns']:
+        (path, values) = column[:2]
+        rows = column[2] if len(column) > 2 else range(len(values))
+        for (i, value) in zip(rows, values):
+            d = records[i]
+            for key in path[:-1]:
+                d = d.setdefault(key, {})
+            d[path[-1]] = value
+    return records
+
+
+class DatastoreFile():
+    """one profile's output, rotated by size and age"""
+
+    def __init__(self, directory, profile, fmt='jsonl', flush_records=200, flush_interval=5.0,
+                 fsync_interval=60.0, rotate_size=16 * 1024 * 1024, rotate_time=3600.0):
+        self.directory = directory
+        self.profile = profile
+        self.fmt = fmt
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.fh = None
+        self.path = None
+        self.opened = 0
+        self.last_flush = time.time()
+        self.last_fsync = time.time()
+        self.records = 0
+        self.flushes = 0
+        self.files = 0
+        self.errors = 0
+
+    def open(self):
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        self.path = os.path.join(self.directory, f'{self.profile}_{stamp}_{self.files:04d}{EXTENSIONS[self.fmt]}')
+        self.fh = open(self.path, 'ab')
+        if self.fmt == 'columnar' and self.fh.tell() == 0:
+            self.fh.write(MAGIC)
+        self.opened = time.time()
+        self.files += 1
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            self.records += 1
+            if len(self.buffer) >= self.flush_records:
+                self.flush_locked()
+
+    def check(self):
+        """flush if the buffer is old enough, called regularly"""
+        with self.lock:
+            if self.buffer and time.time() - self.last_flush >= self.flush_interval:
+                self.flush_locked()
+
+    def encode(self, records):
+        if self.fmt == 'columnar':
+            block = zlib.compress(json.dumps(to_columns(records), separators=(',', ':')).encode('utf-8'))
+            return struct.pack('<I', len(block)) + block
+        return ''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')
+
+    def flush_locked(self):
+        records = self.buffer
+        self.buffer = []
+        now = time.time()
+        self.last_flush = now
+        try:
+            if self.fh is None:
+                self.open()
+            self.fh.write(self.encode(records))
+            self.fh.flush()
+            self.flushes += 1
+            if now - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.fh.fileno())
+                self.last_fsync = now
+            if ((self.rotate_size > 0 and self.fh.tell() >= self.rotate_size) or
+                    (self.rotate_time > 0 and now - self.opened >= self.rotate_time)):
+                self.close_file()
+        except (OSError, IOError) as e:
+            # eg. the SD card is full or missing, drop the batch rather than grow
+            self.errors += 1
+            if self.errors == 1:
+                print(f'datastore {self.profile}: {e}')
+
+    def close_file(self):
+        if self.fh is not None:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+            self.fh = None
+            self.last_fsync = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.buffer:
+                self.flush_locked()
+            try:
+                self.close_file()
+            except (OSError, IOError) as e:
+                print(f'datastore {self.profile}: {e}')
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'records': self.records,
+            'buffered': len(self.buffer),
+            'flushes': self.flushes,
+            'files': self.files,
+            'errors': self.errors
+        }
+
+
+class Datastore():
+    """DatastoreFiles for all the data collection profiles"""
+
+    def __init__(self, directory='/home/pi/datastore', fmt='jsonl', **kwargs):
+        self.directory = directory
+        self.fmt = fmt
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def write(self, profile, record):
+        f = self.files.get(profile, None)
+        if f is None:
+            with self.lock:
+                f = self.files.get(profile, None)
+                if f is None:
+                    f = DatastoreFile(self.directory, profile, self.fmt, **self.kwargs)
+                    self.files[profile] = f
+        f.write(record)
+
+    def check(self):
+        for f in list(self.files.values()):
+            f.check()
+
+    def close(self):
+        for f in list(self.files.values()):
+            f.close()
+
+    def stats(self):
+        return {profile: f.stats() for (profile, f) in list(self.files.items())}
+
+
+def read_blocks(path):
+    """column blocks of a .cqds file, and the magic it was written with"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic not in (MAGIC, MAGIC_V1):
+            raise ValueError(f'{path} is not a columnar datastore file')
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            (length,) = struct.unpack('<I', header)
+            block = f.read(length)
+            if len(block) < length:
+                # cut short by a power loss, the earlier blocks are fine
+                break
+            yield (magic, json.loads(zlib.decompress(block)))
+
+
+def read_records(path):
+    """records of a datastore file of either format"""
+    if path.endswith(EXTENSIONS['columnar']):
+        for (magic, block) in read_blocks(path):
+            if magic == MAGIC:
+                yield from from_columns(block)
+                continue
+            names = list(block.keys())
+            if not names:
+                continue
+            for i in range(len(block[names[0]])):
+                row = {name: block[name][i] for name in names if block[name][i] is not None}
+                yield unflatten(row)
+        return
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a partly written last line
+                    break
+
+
+def export_jsonl(path, out):
+    """write a datastore file out as JSON lines"""
+    for record in read_records(path):
+        out.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'export':
+        print('Usage: datastore.py export FILE...')
+        sys.exit(1)
+    for path in sys.argv[2:]:
+        export_jsonl(path, sys.stdout)
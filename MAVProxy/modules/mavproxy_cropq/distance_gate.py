@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Minimum distance gate for data collection profiles.
+
+A sample is kept when it is at least min_distance_m from the last kept
+sample. Over the few metres this gate deals with, a local tangent plane
+around the last kept point is within a fraction of a percent of the
+geodesic, so that is used, with the full geodesic only past
+geodesic_threshold_m (eg. after a long gap in GPS).
+
+Run as a script for a per-sample timing against geopy.
+"""
+import math
+
+from MAVProxy.modules.lib import mp_util
+
+try:
+    import geopy.distance
+    has_geopy = True
+except ImportError:
+    has_geopy = False
+
+METERS_PER_DEGREE = math.radians(mp_util.radius_of_earth)
+
+
+def geodesic_distance(lat1, lon1, lat2, lon2):
+    """distance in meters, on the ellipsoid if geopy is available"""
+    if has_geopy:
+        return geopy.distance.geodesic((lat1, lon1), (lat2, lon2)).meters
+    return mp_util.gps_distance(lat1, lon1, lat2, lon2)
+
+
+class DistanceGate():
+    def __init__(self, min_distance_m, geodesic_threshold_m=1000.0):
+        self.min_distance_m = min_distance_m
+        self.geodesic_threshold_m = geodesic_threshold_m
+        self.last_point = None
+        # meters per degree of longitude at the last kept point
+        self.lon_scale = METERS_PER_DEGREE
+        self.kept = 0
+        self.skipped = 0
+
+    def distance(self, lat, lon):
+        """meters from the last kept point, None if there isn't one"""
+        if self.last_point is None:
+            return None
+        (lat0, lon0) = self.last_point
+        dlon = lon - lon0
+        if dlon > 180:
+            dlon -= 360
+        elif dlon < -180:
+            dlon += 360
+        dx = dlon * self.lon_scale
+        dy = (lat - lat0) * METERS_PER_DEGREE
+        d = math.sqrt(dx * dx + dy * dy)
+        if d > self.geodesic_threshold_m:
+            return geodesic_distance(lat0, lon0, lat, lon)
+        return d
+
+    def keep(self, lat, lon):
+        """True if a sample at lat, lon should be kept; it becomes the last kept point"""
+        d = self.distance(lat, lon)
+        if d is not None and d < self.min_distance_m:
+            self.skipped += 1
+            return False
+        self.last_point = (lat, lon)
+        self.lon_scale = METERS_PER_DEGREE * math.cos(math.radians(lat))
+        self.kept += 1
+        return True
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(1)
+    # a rover wandering around a paddock, about 0.5m between samples
+    points = []
+    (lat, lon) = (-35.363261, 149.165230)
+    for i in range(100000):
+        lat += random.uniform(-5e-6, 5e-6)
+        lon += random.uniform(-5e-6, 5e-6)
+        points.append((lat, lon))
+
+    gate = DistanceGate(2.0)
+    t0 = time.perf_counter()
+    for (lat, lon) in points:
+        gate.keep(lat, lon)
+    dt = time.perf_counter() - t0
+    print(f'DistanceGate: {dt / len(points) * 1e6:.2f} us/sample, kept {gate.kept} of {len(points)}')
+
+    error = 0
+    for i in range(1, 1000):
+        gate.last_point = None
+        gate.keep(*points[i - 1])
+        d = gate.distance(*points[i])
+        error = max(error, abs(d - geodesic_distance(*points[i - 1], *points[i])))
+    print(f'max difference from geodesic: {error * 1000:.3f} mm')
+
+    if has_geopy:
+        last = None
+        kept = 0
+        t0 = time.perf_counter()
+        for (lat, lon) in points:
+            if last is None or geopy.distance.geodesic(last, (lat, lon)).meters >= 2.0:
+                last = (lat, lon)
+                kept += 1
+        dt = time.perf_counter() - t0
+        print(f'geopy geodesic: {dt / len(points) * 1e6:.2f} us/sample, kept {kept} of {len(points)}')
+    else:
+        print('geopy not installed, no geodesic comparison')
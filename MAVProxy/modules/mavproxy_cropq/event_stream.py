@@ -0,0 +1,73 @@
+import collections
+import itertools
+import json
+import threading
+
+
+class EventStream():
+    """
+    Fan-out buffer of events for the local server's /stream endpoint.
+
+    Each event is serialised once when it is published and kept in a
+    bounded ring with an increasing id. Every client reads the same
+    ring from its own position, so the cost of a client is the rate of
+    events rather than how often it would otherwise poll. A client that
+    falls more than the ring behind skips the events it missed.
+    """
+
+    def __init__(self, maxlen=2000, keepalive=15.0):
+        self.events = collections.deque(maxlen=maxlen)
+        self.seq = 0
+        self.keepalive = keepalive
+        self.cond = threading.Condition()
+        self.clients = 0
+        self.published = 0
+
+    def publish(self, event, data):
+        """queue an event for all clients; cheap when nobody is listening"""
+        if self.clients == 0:
+            return
+        message = json.dumps(data)
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, f'id: {self.seq}\nevent: {event}\ndata: {message}\n\n'))
+            self.published += 1
+            self.cond.notify_all()
+
+    def since(self, seq):
+        """events after seq, lock held"""
+        if seq > self.seq:
+            # client saw an earlier run
+            seq = 0
+        count = min(self.seq - seq, len(self.events))
+        if count <= 0:
+            return []
+        events = [text for (seq, text) in itertools.islice(reversed(self.events), count)]
+        events.reverse()
+        return events
+
+    def subscribe(self, since=None, first=None):
+        """
+        generator of SSE text for one client, starting after event id
+        since (or from now), after the event text first if given
+        """
+        with self.cond:
+            self.clients += 1
+            if since is None:
+                since = self.seq
+        try:
+            if first is not None:
+                yield first
+            while True:
+                with self.cond:
+                    if self.seq == since:
+                        self.cond.wait(self.keepalive)
+                    events = self.since(since)
+                    since = self.seq
+                if events:
+                    yield ''.join(events)
+                else:
+                    yield ': keepalive\n\n'
+        finally:
+            with self.cond:
+                self.clients -= 1
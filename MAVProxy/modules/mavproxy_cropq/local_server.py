@@ -3,7 +3,7 @@ import io
 import pathlib
 import json
 
-from flask import Flask, request, render_template, redirect
+from flask import Flask, Response, request, render_template, redirect
 from flask_cors import CORS
 from werkzeug.serving import make_server
 from flask_socketio import SocketIO, Namespace, emit, send
@@ -92,7 +92,27 @@ class LocalServer():
         return render_template('console.html')
 
     def request_console_data(self):
-        return {"data": self.remote_self.mpstate.console.stored_text.text}
+        '''console lines, only those after sequence ?since=N if given'''
+        since = request.args.get('since', 0, type=int)
+        lines, seq = self.remote_self.mpstate.console.stored_text.since(since)
+        return {"data": lines, "seq": seq}
+
+    def request_stream(self):
+        '''
+        Server-Sent Events of console lines, status changes, heartbeats
+        and datapoints. A new client gets the whole status first; a
+        reconnecting one carries on from Last-Event-ID
+        '''
+        since = request.headers.get('Last-Event-ID', None, type=int)
+        if since is None:
+            since = request.args.get('since', None, type=int)
+        first = None
+        if since is None:
+            status = json.dumps(self.remote_self.mpstatus_snapshot())
+            first = f'event: status\ndata: {status}\n\n'
+        return Response(self.remote_self.events.subscribe(since, first),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
 
     def request_config(self):
         return render_template('config.html')
@@ -126,20 +146,39 @@ class LocalServer():
     def request_dataset(self):
         return render_template('dataset.html')
 
+    def request_coverage(self):
+        '''datasets with coverage, their cell counts and extents'''
+        return self.remote_self.coverage.summary()
+
+    def request_coverage_tile(self, dataset, z, x, y):
+        '''cells of a dataset's coverage in XYZ tile z/x/y, as columns'''
+        grid = self.remote_self.coverage.get(dataset)
+        if grid is None:
+            return {"error": "no such dataset"}, 404
+        return grid.tile(z, x, y)
+
     def request_heartbeats(self):
         return {"data": self.remote_self.heartbeats_latest_20}
 
     def request_mpstatus(self):
-        return json.loads(self.remote_self.mpstatus_to_json(self.remote_self.mpstate.status))
+        return self.remote_self.mpstatus_snapshot()
 
     def request_log(self):
         return render_template('log.html')
 
     def request_log_data(self):
-        with open('/tmp/rover-log.txt') as log_file:
-            lines = log_file.readlines()
-
-        return {"data": lines[-50:]}
+        '''
+        last 50 log lines, or with ?since=OFFSET&gen=G the lines added
+        since an earlier call returned that offset and generation
+        '''
+        rover_log = self.remote_self.rover_log
+        gen = rover_log.generation()
+        since = request.args.get('since', None, type=int)
+        if since is not None and request.args.get('gen', None, type=int) == gen:
+            lines, offset = rover_log.since(since)
+        else:
+            lines, offset = rover_log.tail(50)
+        return {"data": lines, "offset": offset, "gen": gen}
 
     def request_index(self):
         redirect('/vehicle')
@@ -147,12 +186,16 @@ class LocalServer():
     def add_endpoint(self):
         self.app.add_url_rule('/console', view_func=self.request_console, methods=['GET'])
         self.app.add_url_rule('/console_data', view_func=self.request_console_data, methods=['GET'])
+        self.app.add_url_rule('/stream', view_func=self.request_stream, methods=['GET'])
         self.app.add_url_rule('/config_json', view_func=self.request_config_json, methods=['GET'])
         self.app.add_url_rule('/update_config_json', view_func=self.send_config_json, methods=['POST'])
         self.app.add_url_rule('/command', view_func=self.send_command, methods=['POST'])
         self.app.add_url_rule('/vehicle', view_func=self.request_vehicle, methods=['GET'])
         self.app.add_url_rule('/map', view_func=self.request_map, methods=['GET'])
         self.app.add_url_rule('/dataset', view_func=self.request_dataset, methods=['GET'])
+        self.app.add_url_rule('/coverage', view_func=self.request_coverage, methods=['GET'])
+        self.app.add_url_rule('/coverage/<int:dataset>/<int:z>/<int:x>/<int:y>',
+                              view_func=self.request_coverage_tile, methods=['GET'])
         self.app.add_url_rule('/heartbeats', view_func=self.request_heartbeats, methods=['GET'])
         self.app.add_url_rule('/mpstatus', view_func=self.request_mpstatus, methods=['GET'])
         self.app.add_url_rule('/config', view_func=self.request_config, methods=['GET'])
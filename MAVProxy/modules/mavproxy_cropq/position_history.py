@@ -0,0 +1,145 @@
+import array
+import threading
+
+
+class PositionHistory():
+    """
+    Ring buffer of recent positions indexed by receive time, so a sensor
+    reading can be placed where the vehicle was when it was taken rather
+    than where it is when the reading is processed.
+
+    Times are time.monotonic() seconds, lat/lon are degrees.
+    """
+
+    def __init__(self, maxlen=600, max_gap=2.0, max_extrapolate=1.0):
+        self.maxlen = maxlen
+        # interpolate only between samples this close together
+        self.max_gap = max_gap
+        # how far past the newest sample to extrapolate
+        self.max_extrapolate = max_extrapolate
+        self.times = array.array('d', [0.0] * maxlen)
+        self.lats = array.array('d', [0.0] * maxlen)
+        self.lons = array.array('d', [0.0] * maxlen)
+        self.alts = array.array('d', [0.0] * maxlen)
+        # index of the oldest sample, and number of samples held
+        self.start = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, t, lat, lon, alt=0.0):
+        with self.lock:
+            if self.count and t <= self.times[(self.start + self.count - 1) % self.maxlen]:
+                # out of order or duplicate, keep the buffer sorted
+                return
+            if self.count < self.maxlen:
+                i = (self.start + self.count) % self.maxlen
+                self.count += 1
+            else:
+                i = self.start
+                self.start = (self.start + 1) % self.maxlen
+            self.times[i] = t
+            self.lats[i] = lat
+            self.lons[i] = lon
+            self.alts[i] = alt
+
+    def sample(self, n):
+        """nth oldest sample as (t, lat, lon, alt), lock held"""
+        i = (self.start + n) % self.maxlen
+        return (self.times[i], self.lats[i], self.lons[i], self.alts[i])
+
+    def blend(self, a, b, t):
+        """position between samples a and b (or beyond b) at time t"""
+        dt = b[0] - a[0]
+        if dt <= 0:
+            return b[1:]
+        f = (t - a[0]) / dt
+        return (a[1] + (b[1] - a[1]) * f,
+                a[2] + (b[2] - a[2]) * f,
+                a[3] + (b[3] - a[3]) * f)
+
+    def at(self, t):
+        """(lat, lon, alt) at time t, or None if the history doesn't cover it"""
+        with self.lock:
+            if self.count == 0:
+                return None
+            newest = self.sample(self.count - 1)
+            if t >= newest[0]:
+                if t - newest[0] > self.max_extrapolate:
+                    return None
+                if self.count == 1:
+                    return newest[1:]
+                previous = self.sample(self.count - 2)
+                if newest[0] - previous[0] > self.max_gap:
+                    return newest[1:]
+                return self.blend(previous, newest, t)
+            if t < self.times[self.start]:
+                return None
+            # binary search for the first sample after t
+            lo = 0
+            hi = self.count - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.times[(self.start + mid) % self.maxlen] > t:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            after = self.sample(lo)
+            before = self.sample(lo - 1)
+            if after[0] - before[0] > self.max_gap:
+                return None
+            return self.blend(before, after, t)
+
+    def latest_time(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.times[(self.start + self.count - 1) % self.maxlen]
+
+
+class FixHistory():
+    """
+    Ring buffer of recent GPS fix types and satellite counts indexed by
+    receive time, so a sensor reading gets the fix it was placed with
+    rather than the latest. Unlike positions these aren't interpolated:
+    a reading gets the last fix received at or before its time.
+    """
+
+    def __init__(self, maxlen=600):
+        self.maxlen = maxlen
+        self.times = array.array('d', [0.0] * maxlen)
+        self.fix_types = array.array('i', [0] * maxlen)
+        self.sats = array.array('i', [0] * maxlen)
+        self.start = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, t, fix_type, sats):
+        with self.lock:
+            if self.count and t < self.times[(self.start + self.count - 1) % self.maxlen]:
+                return
+            if self.count < self.maxlen:
+                i = (self.start + self.count) % self.maxlen
+                self.count += 1
+            else:
+                i = self.start
+                self.start = (self.start + 1) % self.maxlen
+            self.times[i] = t
+            self.fix_types[i] = fix_type
+            self.sats[i] = sats
+
+    def at(self, t):
+        """(fix_type, sats) last received at or before time t, or None"""
+        with self.lock:
+            if self.count == 0 or t < self.times[self.start]:
+                return None
+            # binary search for the first sample after t
+            lo = 0
+            hi = self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.times[(self.start + mid) % self.maxlen] > t:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            i = (self.start + lo - 1) % self.maxlen
+            return (self.fix_types[i], self.sats[i])
@@ -0,0 +1,105 @@
+import os
+import threading
+
+
+class RoverLog():
+    """
+    The cropq text log (/tmp/rover-log.txt), capped in size.
+
+    When the log passes max_size it is renamed to .1 (replacing the
+    previous one) and a new file started. Readers get the last lines by
+    seeking back from the end rather than reading the whole file, or the
+    lines after an offset they were given earlier. Offsets belong to one
+    file, identified by its generation (the file's inode), so a reader
+    whose generation is out of date starts again from the tail.
+    """
+
+    def __init__(self, path='/tmp/rover-log.txt', max_size=4 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fh = None
+        self.rotations = 0
+
+    def writer(self):
+        """context manager giving something to write() lines to"""
+        return RoverLogWriter(self)
+
+    def write(self, text):
+        with self.lock:
+            if self.fh is None:
+                self.fh = open(self.path, 'a')
+            self.fh.write(text)
+
+    def flush(self):
+        with self.lock:
+            if self.fh is None:
+                return
+            self.fh.flush()
+            if self.fh.tell() >= self.max_size:
+                self.fh.close()
+                self.fh = None
+                os.replace(self.path, self.path + '.1')
+                self.rotations += 1
+
+    def generation(self):
+        try:
+            return os.stat(self.path).st_ino
+        except OSError:
+            return 0
+
+    def tail(self, count=50, block_size=4096):
+        """last count lines and the offset of the end of the file"""
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return [], 0
+        with f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            pos = end
+            data = b''
+            # one more newline than lines wanted, for the partial first line
+            while pos > 0 and data.count(b'\n') <= count:
+                step = min(block_size, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = data.decode('utf-8', errors='replace').splitlines(keepends=True)
+        if pos > 0:
+            lines = lines[1:]
+        return lines[-count:], end
+
+    def since(self, offset, max_bytes=256 * 1024):
+        """
+        whole lines written after offset, and the offset to ask from
+        next time. At most max_bytes are read per call
+        """
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return [], 0
+        with f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            if offset > end:
+                # file was replaced under the reader
+                offset = 0
+            f.seek(offset)
+            data = f.read(min(end - offset, max_bytes))
+        # leave a partly written last line for next time
+        cut = data.rfind(b'\n') + 1
+        data = data[:cut]
+        return data.decode('utf-8', errors='replace').splitlines(keepends=True), offset + cut
+
+
+class RoverLogWriter():
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self.log
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.log.flush()
+        return False
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Sensor ingestion for cropq data collection profiles.
+
+Each profile in the config uses the parser registered here with
+register_parser under its "sensor" entry, or else its profile_name. A
+parser turns the lines read from its device into samples, and may write
+to the device or make samples of its own from poll(), which the module
+calls from idle_task. Profiles with a device are read through a
+SensorSource: the serial port is opened non-blocking and its fd added
+to the main loop's select_extra, so a read takes whatever bytes are
+waiting, splits them into lines and hands the whole batch to the
+parser at once.
+
+Device settings come from the profile's "device" entry in the config
+(eg. {"port": "/dev/ttyUSB0", "baud": 9600}), over the parser's
+default_device.
+
+Run as a script to feed a fake EM sensor over a pty and print the
+throughput.
+"""
+import os
+import time
+
+import serial
+
+# profile name -> parser class
+PARSERS = {}
+
+
+def register_parser(name):
+    """class decorator adding a SensorParser to PARSERS under name"""
+    def register(cls):
+        PARSERS[name] = cls
+        return cls
+    return register
+
+
+def make_parser(profile):
+    """the registered parser for a profile, or None if there isn't one"""
+    cls = PARSERS.get(profile.get('sensor', profile['profile_name']), None)
+    if cls is None:
+        return None
+    return cls(profile)
+
+
+def nmea_checksum_ok(sentence):
+    """True if a $...*hh sentence has the right checksum, or has none"""
+    star = sentence.rfind('*')
+    if star == -1:
+        return True
+    checksum = 0
+    for c in sentence[1:star].encode('ascii', errors='replace'):
+        checksum ^= c
+    try:
+        return int(sentence[star + 1:star + 3], 16) == checksum
+    except ValueError:
+        return False
+
+
+class SensorParser():
+    """
+    Base for a profile's parser. stats holds counters shown by the
+    cropq sensors command; parsers add to 'sentences' and the error
+    counts as they go.
+    """
+    # device settings used when the profile doesn't give them, None for
+    # profiles that don't read a device
+    default_device = None
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.stats = {'sentences': 0, 'samples': 0, 'checksum_errors': 0, 'parse_errors': 0}
+
+    def device(self):
+        """device settings for this profile, or None"""
+        if self.default_device is None:
+            return None
+        device = dict(self.default_device)
+        device.update(self.profile.get('device', {}))
+        return device
+
+    def opened(self, source):
+        """the device has just been opened"""
+        pass
+
+    def poll(self, now, source):
+        """called from idle_task, source is None for profiles without a
+        device. Returns a list of (sample_time, data)"""
+        return []
+
+    def parse(self, lines, now):
+        """lines read from the device, all of them read at monotonic time
+        now. Returns a list of (sample_time, data)"""
+        return []
+
+
+class NmeaParser(SensorParser):
+    """
+    Parser for devices sending NMEA style sentences. Each good sentence
+    is passed to sentence(talker, fields, now) with the checksum
+    stripped; anything else on the line before the $ is ignored.
+    """
+    def parse(self, lines, now):
+        samples = []
+        for line in lines:
+            start = line.find('$')
+            if start == -1:
+                continue
+            line = line[start:].rstrip()
+            self.stats['sentences'] += 1
+            if not nmea_checksum_ok(line):
+                self.stats['checksum_errors'] += 1
+                continue
+            fields = line.split('*', 1)[0].split(',')
+            try:
+                sample = self.sentence(fields[0], fields, now)
+            except (ValueError, IndexError):
+                self.stats['parse_errors'] += 1
+                continue
+            if sample is not None:
+                samples.append(sample)
+        self.stats['samples'] += len(samples)
+        return samples
+
+    def sentence(self, talker, fields, now):
+        """one sentence, returns a (sample_time, data) when it completes a sample"""
+        return None
+
+
+class SensorSource():
+    """
+    A profile's serial device, opened non-blocking. read() is called
+    when the fd is readable and returns the samples parsed from
+    everything that was waiting. Errors close the device; the module
+    opens it again on a later idle_task. on_close(fd) is called as the
+    device is closed, whatever the reason, so the fd can be taken out of
+    the main loop.
+    """
+    def __init__(self, name, parser, device, max_line=4096, on_close=None):
+        self.name = name
+        self.parser = parser
+        self.on_close = on_close
+        self.port = device['port']
+        self.baud = device.get('baud', 9600)
+        self.max_line = max_line
+        self.connection = None
+        self.fd = None
+        self.partial = b''
+        self.open_time = None
+        self.stats = {'bytes': 0, 'lines': 0, 'reads': 0, 'opens': 0, 'read_errors': 0, 'overflows': 0}
+
+    def open(self):
+        self.connection = serial.Serial(self.port, self.baud, timeout=0)
+        self.fd = self.connection.fileno()
+        self.partial = b''
+        self.open_time = time.monotonic()
+        self.stats['opens'] += 1
+        self.parser.opened(self)
+
+    def close(self):
+        if self.fd is not None and self.on_close is not None:
+            self.on_close(self.fd)
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.fd = None
+
+    def is_open(self):
+        return self.connection is not None
+
+    def write(self, data):
+        if self.connection is None:
+            return
+        try:
+            self.connection.write(data)
+        except Exception as e:
+            self.error(e)
+
+    def error(self, e):
+        print(f'Problem accessing {self.name} serial {self.port} - closing', e)
+        self.stats['read_errors'] += 1
+        self.close()
+
+    def read(self):
+        """parse whatever is waiting on the device"""
+        if self.connection is None:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            self.error(e)
+            return []
+        if not data:
+            # a readable fd with nothing to read has gone away
+            self.error('device closed')
+            return []
+        now = time.monotonic()
+        self.stats['reads'] += 1
+        self.stats['bytes'] += len(data)
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if len(self.partial) > self.max_line:
+            # no newline in sight, not a line based sensor or wrong baud
+            self.stats['overflows'] += 1
+            self.partial = b''
+        if end == 0:
+            return []
+        # decode the batch once rather than line by line
+        lines = data[:end].decode('ascii', errors='replace').splitlines()
+        self.stats['lines'] += len(lines)
+        return self.parser.parse(lines, now)
+
+    def report(self):
+        ret = dict(self.stats)
+        ret['port'] = self.port
+        ret['open'] = self.is_open()
+        if self.open_time is not None:
+            elapsed = time.monotonic() - self.open_time
+            if elapsed > 0:
+                ret['bytes_per_sec'] = round(self.stats['bytes'] / elapsed, 1)
+        return ret
+
+
+if __name__ == '__main__':
+    import pty
+    import selectors
+    import threading
+
+    from MAVProxy.modules.mavproxy_cropq import data_em
+
+    def with_checksum(body):
+        checksum = 0
+        for c in body.encode('ascii'):
+            checksum ^= c
+        return f'${body}*{checksum:02X}\r\n'
+
+    count = 20000
+    (master, slave) = pty.openpty()
+
+    def fake_sensor():
+        """an EM 1s sending its two sentences per reading, with the odd corrupt one"""
+        out = []
+        for i in range(count):
+            out.append(with_checksum(f'PDLM1,{i:06d},{i % 50:.3f},{i % 7:.3f},{i % 11:.3f},{i % 13:.3f}'))
+            line = with_checksum(f'PDLMA,12.{i % 10},25.0,{i % 3:.2f},{i % 5:.2f}')
+            if i % 1000 == 999:
+                line = line.replace('PDLMA', 'PDLMB')
+            out.append(line)
+        os.write(master, ''.join(out).encode('ascii'))
+
+    profile = {'profile_name': 'em', 'model': '1s', 'device': {'port': os.ttyname(slave), 'baud': 115200}}
+    parser = data_em.EmParser(profile)
+    source = SensorSource('em', parser, parser.device())
+    source.open()
+    writer = threading.Thread(target=fake_sensor)
+    selector = selectors.DefaultSelector()
+    selector.register(source.fd, selectors.EVENT_READ)
+
+    samples = 0
+    t0 = time.perf_counter()
+    writer.start()
+    while samples < count - count // 1000:
+        if not selector.select(2):
+            break
+        samples += len(source.read())
+    dt = time.perf_counter() - t0
+    writer.join()
+    print(f'{samples} samples in {dt:.2f}s, {samples / dt:.0f} samples/s')
+    print(source.report())
+    print(parser.stats)
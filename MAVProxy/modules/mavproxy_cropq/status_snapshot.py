@@ -0,0 +1,68 @@
+import math
+import threading
+
+
+def message_fields(msg):
+    """
+    Fields of a mavlink message as a dict, keeping numeric types.
+    Byte strings are decoded and NaN/inf become None so the result can
+    always go straight to json.dumps.
+    """
+    ret = {}
+    for fieldname in msg._fieldnames:
+        value = getattr(msg, fieldname)
+        if isinstance(value, float):
+            if math.isnan(value) or math.isinf(value):
+                value = None
+        elif isinstance(value, (bytes, bytearray)):
+            value = value.decode('utf-8', errors='replace')
+        ret[fieldname] = value
+    return ret
+
+
+class StatusSnapshot():
+    """
+    Dict view of the latest messages in MPStatus, {type: {field: value}}.
+
+    Field dicts are built once per received message and reused until a
+    newer message of that type arrives, and the whole snapshot is cached
+    until the message store's version changes. Returned dicts are shared
+    between callers and must not be modified.
+    """
+
+    def __init__(self, status):
+        self.status = status
+        self.lock = threading.Lock()
+        # type -> (message, fields)
+        self.fields = {}
+        self.version = None
+        self.snapshot = {}
+
+    def message(self, name):
+        """fields of the latest message of one type, or None"""
+        msg = self.status.msgs.get(name, None)
+        if msg is None:
+            return None
+        with self.lock:
+            cached = self.fields.get(name, None)
+            if cached is not None and cached[0] is msg:
+                return cached[1]
+            fields = message_fields(msg)
+            self.fields[name] = (msg, fields)
+            return fields
+
+    def get(self):
+        """fields of the latest message of every type"""
+        msgs = self.status.msgs
+        version = getattr(msgs, 'version', None)
+        if version is not None and version == self.version:
+            return self.snapshot
+        snapshot = {}
+        for name in list(msgs.keys()):
+            fields = self.message(name)
+            if fields is not None:
+                snapshot[name] = fields
+        with self.lock:
+            self.version = version
+            self.snapshot = snapshot
+        return snapshot
@@ -0,0 +1,218 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class UplinkQueue():
+    """
+    Durable store-and-forward queue for records waiting to go to the API.
+
+    Records are kept in a SQLite database in WAL mode, so they survive
+    a restart and memory use doesn't grow with the length of an outage.
+    Records are taken oldest first in bounded batches and deleted only
+    when acknowledged; a failed send releases them to be taken again.
+
+    Records the API will never take (it rejected them outright, or they
+    failed max_attempts times) are moved to a dead letter table so they
+    don't hold up everything queued behind them. They are kept until
+    someone looks at them, unless max_dead is set, when the oldest past
+    that many are deleted with a warning.
+    """
+
+    def __init__(self, path, max_records=200000, max_attempts=10, max_dead=None):
+        self.path = path
+        self.max_records = max_records
+        self.max_attempts = max_attempts
+        self.max_dead = max_dead
+        self.lock = threading.Lock()
+        # id -> kind of records taken but not yet acked or released
+        self.in_flight = {}
+        # kind -> records dropped because the queue was full
+        self.dropped = {}
+        self.acked = 0
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS uplink (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               kind TEXT NOT NULL,
+                               created REAL NOT NULL,
+                               attempts INTEGER NOT NULL DEFAULT 0,
+                               payload TEXT NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS uplink_kind ON uplink (kind, id)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS uplink_dead (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               kind TEXT NOT NULL,
+                               created REAL NOT NULL,
+                               attempts INTEGER NOT NULL,
+                               payload TEXT NOT NULL,
+                               reason TEXT NOT NULL,
+                               failed REAL NOT NULL)''')
+        self.counts = dict(self.db.execute('SELECT kind, COUNT(*) FROM uplink GROUP BY kind').fetchall())
+        # kind -> records dead lettered by this run
+        self.dead = {}
+        # dead letters deleted to stay under max_dead
+        self.trimmed = 0
+
+    def put(self, kind, record):
+        """add a record, dropping the oldest of its kind if the queue is full"""
+        self.put_many(kind, [record])
+
+    def put_many(self, kind, records):
+        """add records in one transaction"""
+        now = time.time()
+        rows = [(kind, now, json.dumps(record)) for record in records]
+        with self.lock:
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.executemany('INSERT INTO uplink (kind, created, payload) VALUES (?, ?, ?)', rows)
+            count = self.counts.get(kind, 0) + len(rows)
+            if count > self.max_records:
+                # records being sent are left alone, they will be acked or released
+                rows = self.db.execute('SELECT id FROM uplink WHERE kind = ? ORDER BY id LIMIT ?',
+                                       (kind, count - self.max_records + len(self.in_flight)))
+                ids = [rowid for (rowid,) in rows if rowid not in self.in_flight]
+                ids = ids[:count - self.max_records]
+                self.db.executemany('DELETE FROM uplink WHERE id = ?', [(rowid,) for rowid in ids])
+                self.dropped[kind] = self.dropped.get(kind, 0) + len(ids)
+                count -= len(ids)
+            self.counts[kind] = count
+
+    def take(self, kind, max_records=100, max_bytes=256 * 1024):
+        """
+        take up to max_records of the oldest records of a kind, limited to
+        roughly max_bytes of payload. Returns a list of (id, record). The
+        records must then be passed to ack() or release()
+        """
+        ret = []
+        size = 0
+        with self.lock:
+            rows = self.db.execute('SELECT id, payload FROM uplink WHERE kind = ? ORDER BY id LIMIT ?',
+                                   (kind, max_records + len(self.in_flight)))
+            for (rowid, payload) in rows:
+                if rowid in self.in_flight:
+                    continue
+                if ret and size + len(payload) > max_bytes:
+                    break
+                ret.append((rowid, json.loads(payload)))
+                size += len(payload)
+                if len(ret) >= max_records:
+                    break
+            for (rowid, record) in ret:
+                self.in_flight[rowid] = kind
+        return ret
+
+    def ack(self, ids):
+        """records have been accepted by the API, remove them"""
+        with self.lock:
+            if ids and max(ids) - min(ids) + 1 == len(ids):
+                # the usual case, a contiguous run of ids
+                self.db.execute('DELETE FROM uplink WHERE id BETWEEN ? AND ?', (min(ids), max(ids)))
+            else:
+                self.db.executemany('DELETE FROM uplink WHERE id = ?', [(rowid,) for rowid in ids])
+            for rowid in ids:
+                kind = self.in_flight.pop(rowid, None)
+                if kind is not None:
+                    self.counts[kind] -= 1
+            self.acked += len(ids)
+
+    def release(self, ids, failed=False):
+        """
+        records weren't sent, make them available to take() again. If
+        failed (the API answered but didn't take them, rather than not
+        being reached) it counts as an attempt, and records that have
+        used up max_attempts are dead lettered. Returns the ids dead
+        lettered
+        """
+        dead = []
+        with self.lock:
+            if failed and ids:
+                self.db.executemany('UPDATE uplink SET attempts = attempts + 1 WHERE id = ?',
+                                    [(rowid,) for rowid in ids])
+                for rowid in ids:
+                    row = self.db.execute('SELECT attempts FROM uplink WHERE id = ?', (rowid,)).fetchone()
+                    if row is not None and row[0] >= self.max_attempts:
+                        dead.append(rowid)
+                if dead:
+                    self.move_dead(dead, f'{self.max_attempts} attempts')
+            for rowid in ids:
+                self.in_flight.pop(rowid, None)
+        return dead
+
+    def dead_letter(self, ids, reason):
+        """the API will never take these records, move them out of the way"""
+        with self.lock:
+            self.move_dead(ids, reason)
+
+    def put_dead(self, kind, records, reason):
+        """dead letter records that never made it into the queue"""
+        now = time.time()
+        rows = [(kind, now, json.dumps(record), reason, now) for record in records]
+        with self.lock:
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.executemany('''INSERT INTO uplink_dead (kind, created, attempts, payload, reason, failed)
+                                       VALUES (?, ?, 1, ?, ?, ?)''', rows)
+            self.dead[kind] = self.dead.get(kind, 0) + len(rows)
+            self.trim_dead()
+
+    def move_dead(self, ids, reason):
+        """move records to the dead letter table, lock held"""
+        now = time.time()
+        with self.db:
+            self.db.execute('BEGIN')
+            for rowid in ids:
+                row = self.db.execute('SELECT kind FROM uplink WHERE id = ?', (rowid,)).fetchone()
+                if row is None:
+                    continue
+                self.db.execute('''INSERT INTO uplink_dead (kind, created, attempts, payload, reason, failed)
+                                   SELECT kind, created, attempts, payload, ?, ? FROM uplink WHERE id = ?''',
+                                (reason, now, rowid))
+                self.db.execute('DELETE FROM uplink WHERE id = ?', (rowid,))
+                kind = row[0]
+                self.counts[kind] -= 1
+                self.dead[kind] = self.dead.get(kind, 0) + 1
+                self.in_flight.pop(rowid, None)
+        self.trim_dead()
+
+    def trim_dead(self):
+        """keep the newest max_dead dead letters, if set, lock held"""
+        if self.max_dead is None:
+            return
+        with self.db:
+            deleted = self.db.execute('DELETE FROM uplink_dead WHERE id <= (SELECT MAX(id) FROM uplink_dead) - ?',
+                                      (self.max_dead,)).rowcount
+        if deleted > 0:
+            self.trimmed += deleted
+            print(f'uplink: deleted {deleted} undelivered dead letters, over max_dead_letters {self.max_dead}')
+
+    def count(self, kind=None):
+        if kind is None:
+            return sum(self.counts.values())
+        return self.counts.get(kind, 0)
+
+    def clear(self, kind):
+        with self.lock:
+            self.db.execute('DELETE FROM uplink WHERE kind = ?', (kind,))
+            self.counts[kind] = 0
+            for rowid in [r for (r, k) in self.in_flight.items() if k == kind]:
+                self.in_flight.pop(rowid)
+
+    def stats(self):
+        with self.lock:
+            rows = self.db.execute('SELECT kind, MIN(created) FROM uplink GROUP BY kind').fetchall()
+        now = time.time()
+        return {
+            'queued': dict(self.counts),
+            'oldest_sec': {kind: now - oldest for (kind, oldest) in rows},
+            'in_flight': len(self.in_flight),
+            'acked': self.acked,
+            'dropped': dict(self.dropped),
+            'dead_lettered': dict(self.dead),
+            'dead_trimmed': self.trimmed
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
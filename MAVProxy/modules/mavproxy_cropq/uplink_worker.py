@@ -0,0 +1,292 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .comm import comm
+
+
+class RequestStats():
+    """latency and size of the requests to one endpoint"""
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.count, 1) if self.count else 0,
+            'max_ms': round(self.max_ms, 1),
+            'last_ms': round(self.last_ms, 1),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received
+        }
+
+
+class UplinkWorker():
+    """
+    The one thread that talks to the API.
+
+    All requests share a keep-alive requests.Session, so a cellular link
+    pays for the TLS handshake once rather than per request. A comm
+    round is only started when the previous one has finished, and
+    command status updates are queued from any thread, merged per
+    command and sent back to back on the open connection. Updates that
+    fail are queued again, under any newer fields for the same command,
+    and retried after retry_interval.
+
+    Run as a script to exercise the worker against a local HTTP server.
+    """
+
+    def __init__(self, remote_self, timeout=30, retry_interval=5.0):
+        self.remote_self = remote_self
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # the comm round, comm(remote_self)
+        self.comm = comm
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.comm_requested = False
+        self.comm_running = False
+        self.skipped_comms = 0
+        # direct command pk -> fields to PATCH
+        self.command_updates = {}
+        # no command updates are sent before this time, after a failure
+        self.retry_time = 0
+        self.command_retries = 0
+        self.command_drops = 0
+        # other work to do on the worker thread, eg. downloads
+        self.jobs = []
+        # endpoint name -> RequestStats
+        self.stats = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='cropq_uplink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set_auth(self, username, password):
+        self.session.auth = (username, password)
+
+    def request(self, name, method, url, **kwargs):
+        """make a request on the shared session, recording its stats under name"""
+        stats = self.stats.get(name, None)
+        if stats is None:
+            stats = RequestStats()
+            self.stats[name] = stats
+        kwargs.setdefault('timeout', self.timeout)
+        t0 = time.time()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except Exception:
+            stats.count += 1
+            stats.errors += 1
+            raise
+        dt = (time.time() - t0) * 1000
+        stats.count += 1
+        if r.status_code >= 400:
+            stats.errors += 1
+        stats.total_ms += dt
+        stats.last_ms = dt
+        stats.max_ms = max(stats.max_ms, dt)
+        if r.request.body is not None:
+            stats.bytes_sent += len(r.request.body)
+        stats.bytes_received += len(r.content)
+        return r
+
+    def request_comm(self):
+        """start a comm round unless one is already waiting or running"""
+        with self.lock:
+            if self.comm_requested or self.comm_running:
+                self.skipped_comms += 1
+                return False
+            self.comm_requested = True
+        self.wake.set()
+        return True
+
+    def update_command(self, direct_command_pk, data):
+        """queue a PATCH of a direct command's status fields"""
+        with self.lock:
+            self.command_updates.setdefault(direct_command_pk, {}).update(data)
+        self.wake.set()
+
+    def submit(self, job):
+        """run job() on the worker thread"""
+        with self.lock:
+            self.jobs.append(job)
+        self.wake.set()
+
+    def send_command_updates(self):
+        if time.time() < self.retry_time:
+            return
+        with self.lock:
+            updates = self.command_updates
+            self.command_updates = {}
+        remote_self = self.remote_self
+        failed = {}
+        items = list(updates.items())
+        for (i, (pk, data)) in enumerate(items):
+            url = f'{remote_self.api_url}/vehicles/{remote_self.vehicle_server_id}/mavproxy_commands/{pk}/'
+            try:
+                r = self.request('mavproxy_commands', 'PATCH', url, json=data)
+            except Exception as e:
+                print('command update failed', pk, e)
+                # API not reached, keep the rest for the retry too
+                failed.update(items[i:])
+                break
+            if r.status_code < 300:
+                print(r.text)
+            elif 400 <= r.status_code < 500 and r.status_code not in (401, 403, 408, 429):
+                # the API will never take it, eg. the command is gone
+                print('command update rejected', pk, r.status_code, r.text)
+                self.command_drops += 1
+            else:
+                print('command update failed', pk, r.status_code)
+                failed[pk] = data
+        if not failed:
+            return
+        with self.lock:
+            for (pk, data) in failed.items():
+                # fields queued since this update was taken are newer
+                data.update(self.command_updates.get(pk, {}))
+                self.command_updates[pk] = data
+            self.command_retries += len(failed)
+        self.retry_time = time.time() + self.retry_interval
+
+    def run(self):
+        while self.running:
+            self.wake.wait(1.0)
+            self.wake.clear()
+            with self.lock:
+                jobs = self.jobs
+                self.jobs = []
+                do_comm = self.comm_requested
+                self.comm_requested = False
+                self.comm_running = do_comm
+            self.send_command_updates()
+            for job in jobs:
+                try:
+                    job()
+                except Exception as e:
+                    print('uplink job failed', e)
+            if do_comm:
+                try:
+                    self.comm(self.remote_self)
+                except Exception as e:
+                    print('comm failed', e)
+                with self.lock:
+                    self.comm_running = False
+            # status updates queued by the comm round go out straight away
+            self.send_command_updates()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join(5.0)
+        self.session.close()
+
+    def report(self):
+        ret = {name: stats.as_dict() for (name, stats) in self.stats.items()}
+        ret['skipped_comms'] = self.skipped_comms
+        ret['command_retries'] = self.command_retries
+        ret['command_drops'] = self.command_drops
+        ret['command_updates_queued'] = len(self.command_updates)
+        return ret
+
+
+if __name__ == '__main__':
+    import http.server
+    import json
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        '''stand-in API: counts client connections, fails the first PATCH
+        of each command with a 503'''
+        protocol_version = 'HTTP/1.1'
+        ports = set()
+        patches = {}
+        patch_failures = set()
+
+        def reply(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            Handler.ports.add(self.client_address[1])
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.reply(201, {'direct_commands': []})
+
+        def do_PATCH(self):
+            Handler.ports.add(self.client_address[1])
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path not in Handler.patch_failures:
+                Handler.patch_failures.add(self.path)
+                self.reply(503, {})
+                return
+            Handler.patches.setdefault(self.path, {}).update(data)
+            self.reply(200, data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class Remote():
+        api_url = f'http://127.0.0.1:{server.server_address[1]}'
+        vehicle_server_id = 1
+
+    running = [0]
+    overlaps = [0]
+
+    def fake_comm(remote_self):
+        '''a slow comm round, posting one heartbeat'''
+        running[0] += 1
+        if running[0] > 1:
+            overlaps[0] += 1
+        worker.request('heartbeats', 'POST', f'{remote_self.api_url}/vehicles/1/heartbeats/', json={})
+        time.sleep(0.05)
+        running[0] -= 1
+
+    worker = UplinkWorker(Remote(), timeout=5, retry_interval=0.2)
+    worker.comm = fake_comm
+    started = 0
+    for i in range(100):
+        if worker.request_comm():
+            started += 1
+        time.sleep(0.005)
+    worker.update_command(7, {'status': 1})
+    worker.update_command(8, {'status': 1})
+    time.sleep(0.1)
+    # newer status for a command whose first update is waiting to retry
+    worker.update_command(7, {'status': 2, 'result': 0})
+    deadline = time.time() + 5
+    while (worker.command_updates or running[0] or worker.comm_requested) and time.time() < deadline:
+        time.sleep(0.05)
+    worker.stop()
+    server.shutdown()
+
+    report = worker.report()
+    print(report)
+    print(f'comm rounds started {started}, skipped {worker.skipped_comms}, connections {len(Handler.ports)}')
+    assert overlaps[0] == 0, 'comm rounds overlapped'
+    assert worker.skipped_comms > 0 and started + worker.skipped_comms == 100
+    assert report['heartbeats']['count'] == started and report['heartbeats']['errors'] == 0
+    assert len(Handler.ports) == 1, 'connection not reused'
+    assert Handler.patches == {'/vehicles/1/mavproxy_commands/7/': {'status': 2, 'result': 0},
+                               '/vehicles/1/mavproxy_commands/8/': {'status': 1}}, Handler.patches
+    assert report['command_retries'] >= 2 and report['command_updates_queued'] == 0
+    print('ok')
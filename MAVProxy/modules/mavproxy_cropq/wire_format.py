@@ -0,0 +1,243 @@
+import datetime
+import gzip
+import json
+import time
+
+from .datastore import flatten
+
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+FORMATS = ['json', 'compact']
+COMPRESSION_TYPES = ['none', 'gzip', 'zstd']
+
+# short keys for the fixed heartbeat fields in the compact format
+HEARTBEAT_KEYS = {
+    'armed': 'a',
+    'heading': 'h',
+    'speed': 'v',
+    'packets': 'n',
+    'fix_type': 'f',
+    'sats_visible': 's',
+    'system_status': 'ss',
+    'custom_mode': 'cm',
+}
+
+
+def iso_to_ms(text):
+    """ISO timestamp (UTC, as made by utcnow().isoformat()) to epoch ms"""
+    t = datetime.datetime.fromisoformat(text).replace(tzinfo=datetime.timezone.utc)
+    return int(t.timestamp() * 1000)
+
+
+def parse_point(wkt):
+    """'POINT(lon lat)' to (lon, lat), or None"""
+    if not wkt or not wkt.startswith('POINT('):
+        return None
+    (lon, lat) = wkt[6:-1].split()
+    return (float(lon), float(lat))
+
+
+def deltas(values):
+    """[a, b, c] to [a, b-a, c-b]; None stays None and doesn't move the base"""
+    ret = []
+    last = 0
+    for v in values:
+        if v is None:
+            ret.append(None)
+            continue
+        ret.append(v - last)
+        last = v
+    return ret
+
+
+class WireStats():
+    """bytes a heartbeat would take as plain JSON against what was sent"""
+    def __init__(self):
+        self.posts = 0
+        self.json_bytes = 0
+        self.wire_bytes = 0
+        self.last_json_bytes = 0
+        self.last_wire_bytes = 0
+
+    def add(self, json_bytes, wire_bytes):
+        self.posts += 1
+        self.json_bytes += json_bytes
+        self.wire_bytes += wire_bytes
+        self.last_json_bytes = json_bytes
+        self.last_wire_bytes = wire_bytes
+
+    def as_dict(self):
+        saved = 0
+        if self.json_bytes:
+            saved = round(100.0 * (1 - self.wire_bytes / self.json_bytes), 1)
+        return {
+            'posts': self.posts,
+            'json_bytes': self.json_bytes,
+            'wire_bytes': self.wire_bytes,
+            'saved_percent': saved,
+            'last_json_bytes': self.last_json_bytes,
+            'last_wire_bytes': self.last_wire_bytes
+        }
+
+
+class HeartbeatEncoder():
+    """
+    Encodes heartbeats for the POST to the API.
+
+    'json' is the original format. 'compact' replaces names (mpstats,
+    params, datapoint columns) with ids from a dictionary that is sent
+    alongside until the API has acknowledged it, sends numeric mpstats
+    as deltas from the last acknowledged value, packs datapoints and
+    console texts into columns, and uses epoch ms and integer degE7
+    in place of ISO times and WKT points. The dictionary epoch changes
+    every run so the API knows when to start a new dictionary.
+
+    The encoder state only moves on once a POST is acknowledged, so a
+    heartbeat that fails is encoded again against the same state.
+    """
+
+    def __init__(self, wire_format='json', compression='none'):
+        self.wire_format = wire_format
+        self.compression = compression
+        if compression == 'zstd' and not has_zstd:
+            print("zstandard not installed, using gzip for cropq uplink")
+            self.compression = 'gzip'
+        self.stats = WireStats()
+        self.reset()
+
+    def reset(self):
+        """forget everything the API has acknowledged"""
+        self.epoch = int(time.time())
+        self.names = {}
+        self.acked_names = 0
+        self.acked_values = {}
+
+    def name_id(self, name):
+        ret = self.names.get(name, None)
+        if ret is None:
+            ret = len(self.names) + 1
+            self.names[name] = ret
+        return ret
+
+    def param_name(self, param):
+        """dictionary name of a param, sysid.compid.NAME if not from 1/1"""
+        if 'sysid' in param:
+            return f"{param['sysid']}.{param['compid']}.{param['name']}"
+        return param['name']
+
+    def encode_datapoints(self, datapoints):
+        """datapoints grouped by dataset, in columns"""
+        by_dataset = {}
+        for dp in datapoints:
+            by_dataset.setdefault(dp.get('dataset'), []).append(dp)
+        ret = []
+        for (dataset, dps) in by_dataset.items():
+            lon = []
+            lat = []
+            rows = []
+            for dp in dps:
+                point = parse_point(dp.get('position'))
+                lon.append(None if point is None else int(round(point[0] * 1.0e7)))
+                lat.append(None if point is None else int(round(point[1] * 1.0e7)))
+                rows.append(flatten(dp.get('data') or {}))
+            columns = {}
+            for (i, row) in enumerate(rows):
+                for (key, value) in row.items():
+                    column = columns.get(key, None)
+                    if column is None:
+                        column = [None] * len(rows)
+                        columns[key] = column
+                    column[i] = value
+            ret.append({
+                'd': dataset,
+                'lon': deltas(lon),
+                'lat': deltas(lat),
+                'c': {self.name_id(key): column for (key, column) in columns.items()}
+            })
+        return ret
+
+    def encode_compact(self, data):
+        """returns the compact heartbeat and the mpstat values it carries"""
+        t = iso_to_ms(data['time_vehicle'])
+        ret = {'t': t, 'e': self.epoch}
+        for (key, short) in HEARTBEAT_KEYS.items():
+            if data.get(key) is not None:
+                ret[short] = data[key]
+        point = parse_point(data.get('position'))
+        if point is not None:
+            ret['p'] = [int(round(point[0] * 1.0e7)), int(round(point[1] * 1.0e7))]
+
+        texts = data.get('console_texts') or []
+        if texts:
+            ret['ct'] = {
+                't': [iso_to_ms(c['time']) - t for c in texts],
+                'x': [c['text'] for c in texts],
+                'fg': [c['color_fg'] for c in texts],
+                'bg': [c['color_bg'] for c in texts]
+            }
+
+        params = data.get('parameters') or []
+        if params:
+            ret['pr'] = [[self.name_id(self.param_name(p)), p['value']] for p in params]
+
+        values = {}
+        mpstats_set = []
+        mpstats_delta = []
+        for mpstat in data.get('mpstats') or []:
+            name = self.name_id(mpstat['name'])
+            value = mpstat['value']
+            values[name] = value
+            base = self.acked_values.get(name, None)
+            if (isinstance(value, (int, float)) and not isinstance(value, bool) and
+                    isinstance(base, (int, float)) and not isinstance(base, bool)):
+                mpstats_delta.append([name, value - base])
+            else:
+                mpstats_set.append([name, value])
+        if mpstats_set:
+            ret['ms'] = mpstats_set
+        if mpstats_delta:
+            ret['md'] = mpstats_delta
+
+        datapoints = data.get('datapoints') or []
+        if datapoints:
+            ret['dp'] = self.encode_datapoints(datapoints)
+
+        # names the API hasn't acknowledged yet, including any just added
+        new_names = {i: name for (name, i) in self.names.items() if i > self.acked_names}
+        if new_names:
+            ret['nm'] = new_names
+        return ret, values
+
+    def encode(self, data):
+        """
+        returns (body, headers, pending) for a heartbeat; pass pending
+        to ack() once the API has accepted it
+        """
+        headers = {'Content-Type': 'application/json'}
+        values = {}
+        plain = json.dumps(data).encode('utf-8')
+        if self.wire_format == 'compact':
+            compact, values = self.encode_compact(data)
+            body = json.dumps(compact, separators=(',', ':')).encode('utf-8')
+            headers['X-Cropq-Wire'] = 'compact-1'
+        else:
+            body = plain
+        if self.compression == 'gzip':
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        elif self.compression == 'zstd':
+            body = zstandard.ZstdCompressor(level=3).compress(body)
+            headers['Content-Encoding'] = 'zstd'
+        self.stats.add(len(plain), len(body))
+        pending = (len(self.names), values)
+        return body, headers, pending
+
+    def ack(self, pending):
+        """the API accepted a heartbeat, move the shared state on"""
+        (names, values) = pending
+        self.acked_names = max(self.acked_names, names)
+        self.acked_values.update(values)
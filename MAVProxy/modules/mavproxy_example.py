@@ -28,6 +28,9 @@ class example(mp_module.MPModule):
     def __init__(self, mpstate):
         """Initialise module"""
         super(example, self).__init__(mpstate, "example", "")
+        # only GLOBAL_POSITION_INT is passed to mavlink_packet(); leave
+        # this out to see every message
+        self.set_mavlink_types(['GLOBAL_POSITION_INT'])
         self.status_callcount = 0
         self.boredom_interval = 10 # seconds
         self.last_bored = time.time()
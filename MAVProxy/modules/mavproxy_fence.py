@@ -11,6 +11,9 @@ if mp_util.has_wxpython:
 class FenceModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FenceModule, self).__init__(mpstate, "fence", "geo-fence management", public = True)
+        self.set_mavlink_types(['FENCE_STATUS', 'SYS_STATUS'])
+        # idle_task only adds menus
+        self.set_idle_rate(2)
         self.fenceloader_by_sysid = {}
         self.last_fence_breach = 0
         self.last_fence_status = 0
@@ -11,6 +11,7 @@ import time, struct, math, sys, fnmatch, traceback, json
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_linkreader
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -33,6 +34,38 @@ preferred_ports = [
     '*mRo*',
     '*FMU*']
 
+class ForwardBatch(object):
+    '''frames waiting to be written to the mav_outputs as one write'''
+    def __init__(self, max_size=1200):
+        # keep UDP datagrams below a typical MTU
+        self.max_size = max_size
+        self.bufs = []
+        self.size = 0
+        self.writes = 0
+        self.frames = 0
+
+    def add(self, msgbuf, outputs):
+        '''queue a frame, flushing first if it would make the batch too large'''
+        if self.size + len(msgbuf) > self.max_size:
+            self.flush(outputs)
+        self.bufs.append(msgbuf)
+        self.size += len(msgbuf)
+
+    def flush(self, outputs):
+        '''write all queued frames to each output'''
+        if not self.bufs:
+            return
+        if len(self.bufs) == 1:
+            buf = self.bufs[0]
+        else:
+            buf = b''.join(self.bufs)
+        for r in outputs:
+            r.write(buf)
+        self.writes += 1
+        self.frames += len(self.bufs)
+        self.bufs = []
+        self.size = 0
+
 class LinkModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
@@ -51,6 +84,8 @@ class LinkModule(mp_module.MPModule):
         self.add_completion_function('(LINK)', self.complete_links)
         self.last_altitude_announce = 0.0
         self.vehicle_list = set()
+        self.fwd_batch = ForwardBatch()
+        self.set_mavlink_types(['HEARTBEAT'])
 
         self.menu_added_console = False
         if mp_util.has_wxpython:
@@ -73,6 +108,7 @@ class LinkModule(mp_module.MPModule):
             self.menu_rm.items = [ MPMenuItem(p, p, '# link remove %s' % p) for p in self.complete_links('') ]
             self.module('console').add_menu(self.menu)
         for m in self.mpstate.mav_master:
+            self.check_reader(m)
             m.source_system = self.settings.source_system
             m.mav.srcSystem = m.source_system
             m.mav.srcComponent = self.settings.source_component
@@ -150,6 +186,12 @@ class LinkModule(mp_module.MPModule):
             except AttributeError as e:
                 # some mav objects may not have a "signing" attribute
                 pass
+            reader = getattr(master, 'reader', None)
+            if reader is not None:
+                sign_string += ", queue %u/%u (max %u), %u drops" % (reader.depth(),
+                                                                     reader.max_queue,
+                                                                     reader.max_depth,
+                                                                     reader.drops)
             print("link %s %s (%u packets, %u bytes, %.2fs delay, %u lost, %.1f%% loss, rate:%uB/s%s)" % (self.link_label(master),
                                                                                     status,
                                                                                     self.status.counters['MasterIn'][master.linknum],
@@ -236,8 +278,13 @@ class LinkModule(mp_module.MPModule):
         conn.last_message = 0
         conn.highest_msec = {}
         conn.target_system = self.settings.target_system
+        conn.reader = None
         self.apply_link_attributes(conn, optional_attributes)
         self.mpstate.mav_master.append(conn)
+        if self.settings.link_threads:
+            self.start_reader(conn)
+        else:
+            self.mpstate.reactor.add_source(conn, self.mpstate.functions.process_master)
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         try:
@@ -300,6 +347,8 @@ class LinkModule(mp_module.MPModule):
                 mp_util.child_fd_list_remove(conn.port.fileno())
             except Exception:
                 pass
+            self.mpstate.reactor.remove_source(conn)
+            self.stop_reader(conn)
             self.mpstate.mav_master[i].close()
         except Exception as msg:
             print(msg)
@@ -312,6 +361,43 @@ class LinkModule(mp_module.MPModule):
             conn = self.mpstate.mav_master[j]
             conn.linknum = j
 
+    def start_reader(self, conn):
+        '''move reading of a link into its own thread'''
+        self.mpstate.reactor.remove_source(conn)
+        reader = mp_linkreader.LinkReader(conn, self.mpstate.functions.parse_master,
+                                          max_queue=self.settings.link_queue)
+        conn.reader = reader
+        self.mpstate.reactor.register_fd(reader.wake_fd, self.process_reader, reader)
+        reader.start()
+
+    def stop_reader(self, conn):
+        '''go back to reading a link from the main loop'''
+        reader = getattr(conn, 'reader', None)
+        if reader is None:
+            return
+        self.mpstate.reactor.unregister_fd(reader.wake_fd)
+        reader.stop()
+        # don't lose anything queued before the thread stopped
+        self.process_reader(reader)
+        reader.close()
+        conn.reader = None
+
+    def check_reader(self, conn):
+        '''start or stop the link reader thread to follow the link_threads setting'''
+        reader = getattr(conn, 'reader', None)
+        if self.settings.link_threads and reader is None:
+            self.start_reader(conn)
+        elif not self.settings.link_threads and reader is not None:
+            self.stop_reader(conn)
+            self.mpstate.reactor.add_source(conn, self.mpstate.functions.process_master)
+        elif reader is not None:
+            reader.max_queue = self.settings.link_queue
+
+    def process_reader(self, reader):
+        '''handle batches queued by a link reader thread'''
+        process = self.mpstate.functions.process_master_buffer
+        reader.drain(lambda conn, s, msgs : process(conn, s, msgs, reader))
+
     def get_usec(self):
         '''time since 1970 in microseconds'''
         return int(time.time() * 1.0e6)
@@ -328,7 +414,12 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put(struct.pack('>Q', usec) + m.get_msgbuf())
+
+    def flush_forwarded(self):
+        '''write any batched frames to the outputs. Called once the
+        buffer from a link read has been parsed'''
+        self.fwd_batch.flush(self.mpstate.mav_outputs)
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -657,8 +748,11 @@ class LinkModule(mp_module.MPModule):
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         mtype = m.get_type()
+        # the frame as received; pymavlink keeps the raw bytes on the
+        # message so this is shared by every output and the log
+        msgbuf = m.get_msgbuf()
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            self.mpstate.sysid_outputs[sysid].write(msgbuf)
             if mtype == "GLOBAL_POSITION_INT":
                 for modname in 'map', 'asterix', 'NMEA', 'NMEA2':
                     mod = self.module(modname)
@@ -673,12 +767,12 @@ class LinkModule(mp_module.MPModule):
         if mtype == 'GLOBAL_POSITION_INT':
             # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
             for sysid in self.mpstate.sysid_outputs:
-                self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+                self.mpstate.sysid_outputs[sysid].write(msgbuf)
 
             if self.mpstate.settings.fwdpos:
                 for link in self.mpstate.mav_master:
                     if link != master:
-                        link.write(m.get_msgbuf())
+                        link.write(msgbuf)
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
@@ -686,24 +780,11 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put(struct.pack('>Q', usec) + msgbuf)
 
         # keep the last message of each type around
-        self.status.msgs[mtype] = m
-        instance_field = getattr(m, '_instance_field', None)
-        if mtype not in self.status.msg_count:
-            self.status.msg_count[mtype] = 0
-        self.status.msg_count[mtype] += 1
-
-        if instance_field is not None:
-            instance_value = getattr(m, instance_field, None)
-            if instance_value is not None:
-                mtype_instance = "%s[%s]" % (mtype, instance_value)
-                self.status.msgs[mtype_instance] = m
-                if mtype_instance not in self.status.msg_count:
-                    self.status.msg_count[mtype_instance] = 0
-                self.status.msg_count[mtype_instance] += 1
-        
+        self.status.msgs.store(m, mtype)
+
         if m.get_srcComponent() == mavutil.mavlink.MAV_COMP_ID_GIMBAL and mtype == 'HEARTBEAT':
             # silence gimbal heartbeat packets for now
             return
@@ -733,20 +814,23 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
-                    for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                    if self.mpstate.settings.fwd_batch:
+                        self.fwd_batch.add(msgbuf, self.mpstate.mav_outputs)
+                    else:
+                        for r in self.mpstate.mav_outputs:
+                            r.write(msgbuf)
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
 
-            # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # pass to modules which want this message type
+            warn_ms = self.settings.module_warn_ms
+            for mod in self.mpstate.mavlink_dispatch.modules_for(self.mpstate.modules, mtype):
                 if not mod.multi_vehicle and sysid != target_sysid:
                     # only pass packets not from our target to modules that
                     # have marked themselves as being multi-vehicle capable
                     continue
+                t0 = time.perf_counter()
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -756,6 +840,10 @@ class LinkModule(mp_module.MPModule):
                         exc_type, exc_value, exc_traceback = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
+                dt = time.perf_counter() - t0
+                mod.stats.add_packet(mtype, dt)
+                if mod.stats.should_warn(dt, warn_ms):
+                    self.console.writeln("module %s mavlink_packet(%s) took %.1fms" % (mod.name, mtype, dt*1000))
 
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
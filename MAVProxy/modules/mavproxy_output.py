@@ -15,6 +15,8 @@ from MAVProxy.modules.lib import mp_util
 class OutputModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(OutputModule, self).__init__(mpstate, "output", "output control", public=True)
+        # idle_task only follows changes to source_system/source_component
+        self.set_idle_rate(2)
         self.add_command('output', self.cmd_output, "output control",
                          ["<list|add|remove|sysid>"])
 
@@ -63,6 +65,7 @@ class OutputModule(mp_module.MPModule):
             print("Failed to connect to %s" % device)
             return
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.reactor.add_source(conn, self.mpstate.functions.process_mavlink)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +87,10 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.reactor.remove_source(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.reactor.add_source(conn, self.mpstate.functions.process_mavlink)
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -98,6 +103,7 @@ class OutputModule(mp_module.MPModule):
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
                     pass
+                self.mpstate.reactor.remove_source(conn)
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
                 return
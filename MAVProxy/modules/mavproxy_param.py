@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 '''param command handling'''
 
-import time, os, fnmatch, time, struct, sys
+import time, os, fnmatch, time, struct, sys, collections, threading
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
@@ -30,6 +30,33 @@ class ParamState:
         self.ftp_started = False
         self.mpstate = mpstate
         self.sysid = sysid
+        # bumped whenever a parameter value changes
+        self.version = 0
+        # name -> version it last changed in, oldest change first
+        self.param_versions = collections.OrderedDict()
+        self.version_lock = threading.Lock()
+
+    def note_change(self, name, value):
+        '''record a parameter value, bumping its version if it changed'''
+        if name in self.mav_param and self.mav_param[name] == value:
+            return
+        with self.version_lock:
+            self.version += 1
+            self.param_versions[name] = self.version
+            self.param_versions.move_to_end(name)
+
+    def changed_since(self, version):
+        '''return ([(name, value)...], version) of parameters changed after
+        version, newest last. Pass the returned version next time'''
+        ret = []
+        with self.version_lock:
+            for (name, v) in reversed(self.param_versions.items()):
+                if v <= version:
+                    break
+                ret.append(name)
+            current = self.version
+        ret.reverse()
+        return ([(name, self.mav_param[name]) for name in ret if name in self.mav_param], current)
 
     def use_ftp(self):
         '''return true if we should try ftp for download'''
@@ -92,6 +119,7 @@ class ParamState:
                 added_new_parameter = False
             if m.param_count != -1:
                 self.mav_param_count = m.param_count
+            self.note_change(str(param_id), value)
             self.mav_param[str(param_id)] = value
             if param_id in self.fetch_one and self.fetch_one[param_id] > 0:
                 self.fetch_one[param_id] -= 1
@@ -403,6 +431,7 @@ class ParamState:
         self.mav_param_set = set()
         self.fetch_one = dict()
         self.fetch_set = None
+        old_params = dict(self.mav_param)
         self.mav_param.clear()
         self.mav_param_count = total_params
 
@@ -412,6 +441,8 @@ class ParamState:
             name = str(name.decode('utf-8'))
             self.param_types[name] = mavutil.mavlink.MAV_PARAM_TYPE_REAL32
             self.mav_param_set.add(idx)
+            if old_params.get(name, None) != v:
+                self.note_change(name, v)
             self.mav_param[name] = v
             idx += 1
 
@@ -629,6 +660,14 @@ class ParamModule(mp_module.MPModule):
             return
         self.add_new_target_system(sysid)
 
+    def params_changed_since(self, sysid, version):
+        '''return ([(name, value)...], version) of the parameters of a
+        (sysid, compid) changed after version, for uplinks that only
+        send changes'''
+        if sysid not in self.pstate:
+            return ([], version)
+        return self.pstate[sysid].changed_since(version)
+
     def param_status(self):
         sysid = self.get_sysid()
         pset, pcount = self.pstate[sysid].status(self.master, self.mpstate)
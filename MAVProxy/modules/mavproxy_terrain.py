@@ -12,6 +12,7 @@ from MAVProxy.modules.lib import mp_settings
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.set_mavlink_types(['TERRAIN_REQUEST', 'TERRAIN_REPORT'])
 
         self.ElevationModel = mp_elevation.ElevationModel()
         self.current_request = None
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+'''
+benchmark the MAVProxy routing core
+
+Starts a headless mavproxy with a UDP master and a number of UDP
+outputs on the loopback interface, sends it a synthetic (or recorded)
+MAVLink stream at a fixed rate and measures what comes out of each
+output: throughput, per-packet latency percentiles, lost packets and
+mavproxy CPU time per message.
+
+  mavbench.py --rate 2000 --duration 10 --outputs 3
+  mavbench.py --tlog flight.tlog --modules link --set lazy_decode=1
+  mavbench.py --json result.json
+  mavbench.py --baseline result.json --max-regression 10
+
+Linux only (CPU time is read from /proc).
+'''
+
+import json
+import os
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pymavlink import mavutil
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+parser = ArgumentParser(description=__doc__, formatter_class=RawDescriptionHelpFormatter)
+parser.add_argument("--rate", type=float, default=1000, help="messages per second to send")
+parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+parser.add_argument("--outputs", type=int, default=1, help="number of --out links")
+parser.add_argument("--vehicles", type=int, default=1, help="number of sysids in the synthetic stream")
+parser.add_argument("--modules", default=None,
+                    help="comma separated module list (mavproxy --default-modules), default is mavproxy's own list")
+parser.add_argument("--set", action='append', default=[], help="mavproxy setting as NAME=VALUE, may be repeated")
+parser.add_argument("--cmd", action='append', default=[], help="extra mavproxy startup command, may be repeated")
+parser.add_argument("--tlog", default=None, help="replay messages from a telemetry log instead of a synthetic stream")
+parser.add_argument("--port", type=int, default=16550, help="first UDP port to use")
+parser.add_argument("--startup", type=float, default=4, help="seconds to allow mavproxy to start")
+parser.add_argument("--mavproxy", default=None, help="path to mavproxy.py")
+parser.add_argument("--json", default=None, help="write results to this file")
+parser.add_argument("--baseline", default=None, help="compare with results from a previous --json run")
+parser.add_argument("--max-regression", type=float, default=10,
+                    help="percentage drop in throughput or rise in CPU/msg against the baseline that fails the run")
+parser.add_argument("--verbose", action='store_true', help="show mavproxy output")
+args = parser.parse_args()
+
+mavlink = mavutil.mavlink
+
+
+def synthetic_stream(count, vehicles):
+    '''generate a typical telemetry mix, as a list of packed frames'''
+    mavs = []
+    for v in range(vehicles):
+        mav = mavlink.MAVLink(None, srcSystem=v+1, srcComponent=1)
+        mav.robust_parsing = True
+        mavs.append(mav)
+    frames = []
+    t = 0
+    i = 0
+    while len(frames) < count:
+        mav = mavs[i % vehicles]
+        i += 1
+        t += 20
+        # roughly the proportions of an ArduPilot stream at SR 10/50
+        msgs = [mav.attitude_encode(t, 0.1, 0.2, 0.3, 0.01, 0.02, 0.03),
+                mav.raw_imu_encode(t*1000, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+                mav.attitude_encode(t+10, 0.1, 0.2, 0.3, 0.01, 0.02, 0.03),
+                mav.raw_imu_encode(t*1000+10000, 1, 2, 3, 4, 5, 6, 7, 8, 9)]
+        if i % 5 == 0:
+            msgs.append(mav.global_position_int_encode(t, -353632610, 1491652440, 584000, 10000, 100, 200, 0, 9000))
+            msgs.append(mav.vfr_hud_encode(12.0, 12.5, 90, 50, 10.0, 0.5))
+            msgs.append(mav.gps_raw_int_encode(t*1000, 3, -353632610, 1491652440, 584000, 100, 100, 1200, 9000, 12))
+        if i % 50 == 0:
+            msgs.append(mav.heartbeat_encode(mavlink.MAV_TYPE_QUADROTOR, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, 0, 0, 0))
+            msgs.append(mav.sys_status_encode(0, 0, 0, 500, 12000, 1000, 90, 0, 0, 0, 0, 0, 0))
+        for m in msgs:
+            frames.append(bytes(m.pack(mav)))
+            mav.seq = (mav.seq + 1) % 256
+    return frames[:count]
+
+
+def tlog_stream(filename, count):
+    '''load frames from a telemetry log, repeating it to make count frames'''
+    mlog = mavutil.mavlink_connection(filename)
+    frames = []
+    while True:
+        m = mlog.recv_match()
+        if m is None:
+            break
+        if m.get_type() == 'BAD_DATA':
+            continue
+        frames.append(bytes(m.get_msgbuf()))
+    if len(frames) == 0:
+        print("No messages in %s" % filename)
+        sys.exit(1)
+    ret = []
+    while len(ret) < count:
+        ret.extend(frames[:count-len(ret)])
+    return ret
+
+
+def cpu_time(pid):
+    '''user+system CPU seconds used by a process'''
+    with open('/proc/%u/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    i = int(round((p / 100.0) * (len(values) - 1)))
+    return values[i]
+
+
+class OutputReceiver(object):
+    '''receive from one mavproxy output, matching frames to their send times'''
+    def __init__(self, port, sent_times):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.settimeout(0.2)
+        self.sent_times = sent_times
+        # index into sent_times of the next copy of each frame
+        self.next_index = {}
+        self.mav = mavlink.MAVLink(None)
+        self.mav.robust_parsing = True
+        self.received = 0
+        self.last_receive = 0
+        self.latencies = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                buf = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            now = time.time()
+            msgs = self.mav.parse_buffer(buf)
+            if not msgs:
+                continue
+            for m in msgs:
+                if m.get_type() == 'BAD_DATA':
+                    continue
+                key = bytes(m.get_msgbuf())
+                times = self.sent_times.get(key, None)
+                idx = self.next_index.get(key, 0)
+                if times is None or idx >= len(times):
+                    # eg. heartbeats sent by mavproxy itself
+                    continue
+                self.next_index[key] = idx + 1
+                self.received += 1
+                self.last_receive = now
+                self.latencies.append(now - times[idx])
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+def run_benchmark():
+    count = int(args.rate * args.duration)
+    if args.tlog is not None:
+        frames = tlog_stream(args.tlog, count)
+    else:
+        frames = synthetic_stream(count, args.vehicles)
+
+    master_port = args.port
+    out_ports = [args.port + 1 + i for i in range(args.outputs)]
+
+    mavproxy = args.mavproxy
+    if mavproxy is None:
+        mavproxy = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mavproxy.py')
+    logdir = tempfile.mkdtemp(prefix='mavbench')
+    cmd = [sys.executable, mavproxy,
+           '--master', 'udpin:127.0.0.1:%u' % master_port,
+           '--daemon', '--nowait', '--non-interactive',
+           '--logfile', os.path.join(logdir, 'bench.tlog')]
+    for p in out_ports:
+        cmd.extend(['--out', 'udpout:127.0.0.1:%u' % p])
+    if args.modules is not None:
+        cmd.extend(['--default-modules', args.modules])
+    startup = ['set %s %s' % tuple(s.split('=', 1)) for s in args.set] + args.cmd
+    if startup:
+        cmd.extend(['--cmd', ';'.join(startup)])
+
+    # send times of each distinct frame, in order of sending
+    sent_times = {}
+    for f in frames:
+        if f not in sent_times:
+            sent_times[f] = []
+
+    receivers = [OutputReceiver(p, sent_times) for p in out_ports]
+
+    if args.verbose:
+        output = None
+    else:
+        output = open(os.devnull, 'w')
+    proc = subprocess.Popen(cmd, stdout=output, stderr=subprocess.STDOUT)
+    time.sleep(args.startup)
+    if proc.poll() is not None:
+        print("mavproxy exited during startup")
+        sys.exit(1)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dest = ('127.0.0.1', master_port)
+
+    cpu_start = cpu_time(proc.pid)
+    t_start = time.time()
+    # send in 1ms ticks to keep to the requested rate
+    tick = 0.001
+    per_tick = max(1, int(args.rate * tick))
+    i = 0
+    while i < len(frames):
+        now = time.time()
+        due = min(len(frames), int((now - t_start) * args.rate) + per_tick)
+        while i < due:
+            f = frames[i]
+            sent_times[f].append(time.time())
+            sock.sendto(f, dest)
+            i += 1
+        time.sleep(tick)
+    t_sent = time.time()
+
+    # wait for the outputs to go quiet
+    last = -1
+    while True:
+        time.sleep(0.5)
+        total = sum([r.received for r in receivers])
+        if total == last:
+            break
+        last = total
+    cpu_end = cpu_time(proc.pid)
+    t_end = time.time()
+
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    for r in receivers:
+        r.stop()
+    shutil.rmtree(logdir, ignore_errors=True)
+
+    sent = len(frames)
+    latencies = []
+    for r in receivers:
+        latencies.extend(r.latencies)
+    latencies.sort()
+    received = sum([r.received for r in receivers])
+    expected = sent * len(receivers)
+    cpu = cpu_end - cpu_start
+    results = {
+        'rate' : args.rate,
+        'duration' : t_sent - t_start,
+        'outputs' : args.outputs,
+        'vehicles' : args.vehicles,
+        'modules' : args.modules,
+        'settings' : args.set,
+        'sent' : sent,
+        'send_rate' : sent / (t_sent - t_start),
+        'received' : received,
+        'lost' : expected - received,
+        'throughput' : received / max(0.001, max([r.last_receive for r in receivers]) - t_start),
+        'latency_ms_p50' : percentile(latencies, 50) * 1000,
+        'latency_ms_p90' : percentile(latencies, 90) * 1000,
+        'latency_ms_p99' : percentile(latencies, 99) * 1000,
+        'latency_ms_max' : percentile(latencies, 100) * 1000,
+        'cpu' : cpu,
+        'cpu_percent' : 100 * cpu / (t_end - t_start),
+        'cpu_us_per_msg' : 1.0e6 * cpu / sent,
+    }
+    return results
+
+
+def show_results(r):
+    print("Sent %u messages at %.0f msg/s to %u output(s)" % (r['sent'], r['send_rate'], r['outputs']))
+    print("Received %u, lost %u (%.2f%%), throughput %.0f msg/s" % (r['received'], r['lost'],
+                                                                     100.0 * r['lost'] / max(1, r['sent'] * r['outputs']),
+                                                                     r['throughput']))
+    print("Latency ms: p50 %.2f p90 %.2f p99 %.2f max %.2f" % (r['latency_ms_p50'], r['latency_ms_p90'],
+                                                               r['latency_ms_p99'], r['latency_ms_max']))
+    print("CPU: %.2fs (%.1f%%), %.1f us/msg" % (r['cpu'], r['cpu_percent'], r['cpu_us_per_msg']))
+
+
+def compare_baseline(r, filename):
+    '''return True if r is within max_regression of the baseline'''
+    with open(filename) as f:
+        base = json.load(f)
+    ok = True
+    limit = args.max_regression / 100.0
+    base_received = base['received'] / float(max(1, base['sent'] * base['outputs']))
+    received = r['received'] / float(max(1, r['sent'] * r['outputs']))
+    if received < base_received * (1 - limit):
+        print("REGRESSION: delivered %.1f%% of messages, baseline %.1f%%" % (received*100, base_received*100))
+        ok = False
+    if r['cpu_us_per_msg'] > base['cpu_us_per_msg'] * (1 + limit):
+        print("REGRESSION: %.1f us/msg, baseline %.1f us/msg" % (r['cpu_us_per_msg'], base['cpu_us_per_msg']))
+        ok = False
+    if ok:
+        print("OK against baseline: %.1f us/msg (baseline %.1f)" % (r['cpu_us_per_msg'], base['cpu_us_per_msg']))
+    return ok
+
+
+results = run_benchmark()
+show_results(results)
+if args.json is not None:
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
+if args.baseline is not None and not compare_baseline(results, args.baseline):
+    sys.exit(1)